@@ -5,6 +5,7 @@ DJANGODIR=/edrop                              # Django project directory
 NUM_WORKERS=3                                 # Number of Gunicorn workers
 DJANGO_SETTINGS_MODULE=edrop.settings         # Django settings module
 DJANGO_WSGI_MODULE=edrop.wsgi                 # WSGI module name
+DJANGO_ASGI_MODULE=edrop.asgi                 # ASGI module name (used if ASGI=true)
 
 echo "Starting $NAME as `whoami`"
 
@@ -16,11 +17,20 @@ export PYTHONPATH=$DJANGODIR:$PYTHONPATH
 mkdir -p /edrop/logs
 python -m pip install -r requirements.txt
 python manage.py migrate
+python manage.py createcachetable
 python manage.py collectstatic --noinput
 
+# With ASGI=true, the app is served through uvicorn workers, so webhook calls waiting for
+# REDCap and GBF don't block a worker (see ORDER_PLACEMENT_MODE)
+if [ "$ASGI" = "true" ]; then
+  APPLICATION="${DJANGO_ASGI_MODULE}:application --worker-class uvicorn.workers.UvicornWorker"
+else
+  APPLICATION="${DJANGO_WSGI_MODULE}:application"
+fi
+
 # Start your Django Unicorn
 # Programs meant to be run under supervisor should not daemonize themselves (do not use --daemon)
-exec gunicorn ${DJANGO_WSGI_MODULE}:application \
+exec gunicorn ${APPLICATION} \
   --name $NAME \
   --workers $NUM_WORKERS \
   --bind=0.0.0.0:8000 \
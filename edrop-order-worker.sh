@@ -0,0 +1,29 @@
+#!/bin/bash
+
+NAME="edrop-order-worker"                     # Name of the worker
+DJANGODIR=/edrop                              # Django project directory
+DJANGO_SETTINGS_MODULE=edrop.settings         # Django settings module
+
+echo "Starting $NAME as `whoami`"
+
+cd $DJANGODIR
+source .env_app
+export DJANGO_SETTINGS_MODULE=$DJANGO_SETTINGS_MODULE
+export PYTHONPATH=$DJANGODIR:$PYTHONPATH
+mkdir -p /edrop/logs
+
+# Like the cron job, the worker needs all dependencies to be installed and migrations to be run,
+# which happens when the web app starts. So we wait till the web app responds before starting the worker.
+while true; do 
+    sleep 5;
+    http_response=$(curl -s -o /dev/null -I -w "%{http_code}\n" http://localhost:8000/$APP_ROOT);
+    if [ $http_response == "200" ]; then
+        break
+    else
+        echo "eDROP Connector is not yet responding."
+    fi
+done
+echo "eDROP Connector has started successfully"
+
+# start the order worker
+python manage.py runorderworker
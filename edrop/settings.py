@@ -99,6 +99,15 @@ DATABASES = {
     }
 }
 
+# Cache shared by all processes (e.g. to ignore duplicate webhook calls)
+# the table is created with `python manage.py createcachetable`
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'edrop_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -181,4 +190,108 @@ GBF_ITEM_NR = os.environ.get('GBF_ITEM_NR', "") #Fix for the correct one
 GBF_ITEM_QUANTITY = 1.0
 GBF_SHIPPING_METHOD = os.environ.get('GBF_SHIPPING_METHOD', "FedEx Ground")
 
-CRON_JOB_FREQUENCY = "*/1" # Should run the GBG check job once a day
\ No newline at end of file
+CRON_JOB_FREQUENCY = "*/1" # Should run the GBG check job once a day
+# "cron" runs the tracking info job with CRON_JOB_FREQUENCY, "adaptive" picks the time of each next run
+# from the number of orders that are due to be checked for shipping info
+TRACKING_JOB_MODE = os.environ.get('TRACKING_JOB_MODE', 'cron')
+# shortest and longest time in seconds between two runs of the tracking info job in adaptive mode
+TRACKING_JOB_MIN_INTERVAL = int(os.environ.get('TRACKING_JOB_MIN_INTERVAL', 300))
+TRACKING_JOB_MAX_INTERVAL = int(os.environ.get('TRACKING_JOB_MAX_INTERVAL', 86_400))
+# in adaptive mode, the next run starts as soon as this many orders are due to be checked
+TRACKING_JOB_TARGET_DUE_ORDERS = int(os.environ.get('TRACKING_JOB_TARGET_DUE_ORDERS', 100))
+
+# Order worker configurations
+# how many order jobs are processed at the same time
+ORDER_WORKER_CONCURRENCY = int(os.environ.get('ORDER_WORKER_CONCURRENCY', 3))
+# seconds the worker waits before checking for new jobs if the queue is empty
+ORDER_WORKER_POLL_INTERVAL = float(os.environ.get('ORDER_WORKER_POLL_INTERVAL', 2))
+# how often placing an order is attempted before a job is marked as failed
+ORDER_JOB_MAX_ATTEMPTS = int(os.environ.get('ORDER_JOB_MAX_ATTEMPTS', 5))
+# seconds to wait before a failed job is retried (multiplied by the number of attempts)
+ORDER_JOB_RETRY_DELAY = int(os.environ.get('ORDER_JOB_RETRY_DELAY', 60))
+# seconds after which a running job is considered abandoned (e.g. the worker crashed) and requeued
+ORDER_JOB_STALE_AFTER = int(os.environ.get('ORDER_JOB_STALE_AFTER', 600))
+
+# HTTP client configurations (used for all requests to REDCap and GBF)
+# seconds to wait for a connection to be established
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+# seconds to wait for a response once connected
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
+# number of connections kept alive per host
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+
+# number of requests the async client sends to GBF and REDCap at the same time (per process)
+GBF_MAX_CONCURRENT_REQUESTS = int(os.environ.get('GBF_MAX_CONCURRENT_REQUESTS', 20))
+REDCAP_MAX_CONCURRENT_REQUESTS = int(os.environ.get('REDCAP_MAX_CONCURRENT_REQUESTS', 10))
+# "queue" to have the order worker place orders, "webhook" to place them while handling the REDCap
+# webhook (only use with ASGI, see edrop-gunicorn.sh); orders that fail are then queued for the order worker
+ORDER_PLACEMENT_MODE = os.environ.get('ORDER_PLACEMENT_MODE', 'queue')
+
+# webhook calls for a record are ignored for this many seconds after a call for the record has been handled
+WEBHOOK_DEDUPE_TTL = int(os.environ.get('WEBHOOK_DEDUPE_TTL', 30))
+# seconds after which a record that is being handled by the webhook is released (e.g. if the worker died)
+WEBHOOK_IN_FLIGHT_TIMEOUT = int(os.environ.get('WEBHOOK_IN_FLIGHT_TIMEOUT', 300))
+
+# number of orders the order worker sends to GBF in one request (1 places each order on its own)
+GBF_BATCH_SIZE = int(os.environ.get('GBF_BATCH_SIZE', 1))
+# seconds the order worker waits for a batch to fill up before sending it anyway
+GBF_BATCH_WINDOW = float(os.environ.get('GBF_BATCH_WINDOW', 10))
+
+# number of records requested from REDCap per request when exporting many records
+REDCAP_EXPORT_CHUNK_SIZE = int(os.environ.get('REDCAP_EXPORT_CHUNK_SIZE', 100))
+# number of export requests that are sent to REDCap at the same time
+REDCAP_EXPORT_MAX_WORKERS = int(os.environ.get('REDCAP_EXPORT_MAX_WORKERS', 4))
+# bytes read at a time when exporting the ids of all complete records from REDCap
+REDCAP_EXPORT_STREAM_CHUNK_SIZE = int(os.environ.get('REDCAP_EXPORT_STREAM_CHUNK_SIZE', 65_536))
+
+# seconds between runs of the job that queues orders for complete REDCap records that have not
+# been ordered, e.g. because the webhook call failed; 0 to not run the job
+RECONCILIATION_JOB_INTERVAL = int(os.environ.get('RECONCILIATION_JOB_INTERVAL', 3600))
+# number of complete records that are compared to the orders in one query
+RECONCILIATION_PAGE_SIZE = int(os.environ.get('RECONCILIATION_PAGE_SIZE', 1000))
+# seconds after a job for a record failed before the record is queued again by the reconciliation job
+RECONCILIATION_FAILED_COOLDOWN = int(os.environ.get('RECONCILIATION_FAILED_COOLDOWN', 86400))
+
+# number of order numbers sent to GBF per request when checking for order confirmations
+GBF_CONFIRMATION_CHUNK_SIZE = int(os.environ.get('GBF_CONFIRMATION_CHUNK_SIZE', 100))
+# number of order confirmation requests that are sent to GBF at the same time
+GBF_CONFIRMATION_MAX_WORKERS = int(os.environ.get('GBF_CONFIRMATION_MAX_WORKERS', 4))
+# "batch" to get the confirmations of all due orders before updating orders and REDCap, "pipeline" to
+# update orders and REDCap for every GBF_CONFIRMATION_CHUNK_SIZE orders as soon as GBF responds
+SHIPPING_INFO_CHECK_MODE = os.environ.get('SHIPPING_INFO_CHECK_MODE', 'batch')
+# seconds after which a check for shipping info is considered to have died, so that a new one can be started
+SHIPPING_INFO_CHECK_TIMEOUT = int(os.environ.get('SHIPPING_INFO_CHECK_TIMEOUT', 3600))
+# seconds between checks of the scheduler for a check for shipping info started in the admin
+SHIPPING_INFO_CHECK_POLL_INTERVAL = int(os.environ.get('SHIPPING_INFO_CHECK_POLL_INTERVAL', 5))
+
+# seconds between refreshes of the order statistics shown on the dashboard in the admin; 0 to not refresh them
+ORDER_STATISTICS_REFRESH_INTERVAL = int(os.environ.get('ORDER_STATISTICS_REFRESH_INTERVAL', 300))
+# number of days for which orders placed and shipped per day are shown on the dashboard
+ORDER_STATISTICS_DAYS = int(os.environ.get('ORDER_STATISTICS_DAYS', 30))
+
+# seconds between checks for shipping info of an order that has just been placed
+GBF_POLL_MIN_INTERVAL = int(os.environ.get('GBF_POLL_MIN_INTERVAL', 3600))
+# longest time in seconds between two checks for shipping info of an order
+GBF_POLL_MAX_INTERVAL = int(os.environ.get('GBF_POLL_MAX_INTERVAL', 604_800))
+# the time between checks is multiplied by this factor every time GBF returns no shipping info for an order
+GBF_POLL_BACKOFF_FACTOR = float(os.environ.get('GBF_POLL_BACKOFF_FACTOR', 2))
+# orders are not checked more often than once per this fraction of their age (e.g. 0.1: a 10 day old order at most once a day)
+GBF_POLL_AGE_FACTOR = float(os.environ.get('GBF_POLL_AGE_FACTOR', 0.1))
+
+# number of orders updated per database transaction when storing shipping info
+ORDER_UPDATE_CHUNK_SIZE = int(os.environ.get('ORDER_UPDATE_CHUNK_SIZE', 500))
+
+# number of records sent to REDCap per request when storing tracking info
+REDCAP_IMPORT_CHUNK_SIZE = int(os.environ.get('REDCAP_IMPORT_CHUNK_SIZE', 100))
+# number of import requests that are sent to REDCap at the same time
+REDCAP_IMPORT_MAX_WORKERS = int(os.environ.get('REDCAP_IMPORT_MAX_WORKERS', 2))
+# how often sending a batch of tracking info is attempted if REDCap cannot be reached or returns a server error
+REDCAP_IMPORT_MAX_ATTEMPTS = int(os.environ.get('REDCAP_IMPORT_MAX_ATTEMPTS', 3))
+# seconds to wait before a failed batch is sent again (multiplied by the number of attempts)
+REDCAP_IMPORT_RETRY_DELAY = float(os.environ.get('REDCAP_IMPORT_RETRY_DELAY', 2))
+
+# if set, the metrics endpoint requires the header "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# number of log lines kept in memory per log before they are written to the database
+LOG_BUFFER_MAX_LINES = int(os.environ.get('LOG_BUFFER_MAX_LINES', 200))
@@ -26,5 +26,6 @@ urlpatterns = [
         path('admin/', admin.site.urls),
         re_path(r'^$', views.index, name="home"),
         re_path(r'^api/order/create', api.initiate_order),
+        path('metrics', views.metrics_view, name="metrics"),
     ]))
 ]  + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
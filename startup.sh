@@ -3,5 +3,6 @@
 source .env_app
 python -m pip install -r requirements.txt
 python manage.py migrate
+python manage.py createcachetable
 python manage.py collectstatic --noinput
 python manage.py runserver 0.0.0.0:8000
\ No newline at end of file
@@ -1,9 +1,15 @@
 from django.contrib import admin
 from track.models import *
-from django.http import HttpResponseRedirect
-from django.urls import path
+from django.contrib import messages
+from django.http import HttpResponseRedirect, HttpResponseNotAllowed, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.db.models import Avg, Count
+from django.utils.html import format_html, format_html_join
 import logging
-from track import orders
+from track import orders, statistics
+from track.utils import Percentile
 
 logger = logging.getLogger(__name__)
 
@@ -14,27 +20,162 @@ class OrderAdmin(admin.ModelAdmin):
 
     list_display = ["record_id", "order_number", "tracking_nrs", "return_tracking_nrs", "tube_serials", "order_status", "ship_date"]
 
+def log_entries_link(obj, parent_field):
+    url = reverse("admin:track_logentry_changelist") + f"?{parent_field}__id__exact={obj.id}"
+    return format_html('<a href="{}">View {} log entries</a>', url, obj.entries.count())
+
 class ConfirmationCheckLogAdmin(admin.ModelAdmin):
-    list_display = ["id", "job_id", "start_time", "end_time", "is_complete"]
-    fields = ("job_id", "apscheduler", "orders", "gbf", "redcap", "end_time", "is_complete")
+    change_list_template = "track/check_orders.html"
+    list_display = ["id", "job_id", "start_time", "end_time", "is_complete", "chunks_done", "orders_updated", "redcap_batches"]
+    fields = ("job_id", "entries_link", "apscheduler", "orders", "gbf", "redcap", "end_time", "is_complete",
+              "chunks_total", "chunks_done", "orders_updated", "redcap_batches")
+    readonly_fields = ["entries_link", "chunks_total", "chunks_done", "orders_updated", "redcap_batches"]
+
+    @admin.display(description="Log entries")
+    def entries_link(self, obj):
+        return log_entries_link(obj, "confirmation_log")
     
     def get_urls(self):
         urls = super().get_urls()
         my_urls = [
-            path('check_order_status/', self.call_check_order_status),
+            path('check_order_status/', self.admin_site.admin_view(self.call_check_order_status), name='track_check_order_status'),
+            path('check_order_status/<int:log_id>/', self.admin_site.admin_view(self.check_order_status_progress),
+                 name='track_check_order_status_progress'),
+            path('check_order_status/<int:log_id>/status/', self.admin_site.admin_view(self.check_order_status_status),
+                 name='track_check_order_status_status'),
         ]
         return my_urls + urls
     
     def call_check_order_status(self, request):
-        logger.info("Initiatied check for tracking info") 
-        orders.check_orders_shipping_info()
-        logger.info("Tracking info check completed.")
-        return HttpResponseRedirect("../")
+        """
+        Requests a check for tracking info, which the scheduler runs, and shows its progress. If a
+        check is already running, the progress of that check is shown instead.
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+
+        log = orders.request_shipping_info_check()
+        if log:
+            logger.info(f"Requested check for tracking info (log {log.id}).")
+        else:
+            log = ConfirmationCheckLog.objects.filter(is_complete=False).order_by('-pk').first()
+            messages.warning(request, "A check for tracking info is already running.")
+            if not log:
+                return HttpResponseRedirect(reverse("admin:track_confirmationchecklog_changelist"))
+        return HttpResponseRedirect(reverse("admin:track_check_order_status_progress", args=[log.id]))
+
+    def check_order_status_progress(self, request, log_id):
+        log = get_object_or_404(ConfirmationCheckLog, pk=log_id)
+        context = dict(
+            self.admin_site.each_context(request),
+            title=f"Check for tracking info {log.id}",
+            log=log,
+            opts=self.model._meta,
+        )
+        return TemplateResponse(request, "track/check_order_status.html", context)
+
+    def check_order_status_status(self, request, log_id):
+        """
+        Returns the progress of a check for tracking info as json, polled by the progress page.
+        """
+        progress = (ConfirmationCheckLog.objects.filter(pk=log_id)
+                    .values('is_complete', 'chunks_total', 'chunks_done', 'orders_updated', 'redcap_batches').first())
+        if progress is None:
+            return JsonResponse({'error': "Log not found."}, status=404)
+        return JsonResponse(progress)
 
 class OrderLogAdmin(admin.ModelAdmin):
     list_display = ["id", "order_number", "start_time", "end_time", "is_complete"]
-    fields = ("order_number", "redcap", "orders", "gbf", "end_time", "is_complete")
+    fields = ("order_number", "entries_link", "waterfall", "redcap", "orders", "gbf", "end_time", "is_complete")
+    readonly_fields = ["entries_link", "waterfall"]
+
+    @admin.display(description="Log entries")
+    def entries_link(self, obj):
+        return log_entries_link(obj, "order_log")
+
+    @admin.display(description="Timing")
+    def waterfall(self, obj):
+        """
+        Shows the timing spans of the order placement as bars, positioned relative to the whole placement.
+        """
+        spans = list(obj.spans.all())
+        if not spans:
+            return "-"
+        total = max(span.start_offset + span.duration for span in spans) or 1
+        rows = format_html_join("",
+            '<tr><td style="padding-left:{}em">{}</td><td style="text-align:right">{} ms</td>'
+            '<td style="width:400px"><div style="margin-left:{}%;width:{}%;min-width:1px;height:1em;background:#79aec8"></div></td></tr>',
+            ((span.depth * 1.5, span.name, f"{span.duration * 1000:.1f}", f"{span.start_offset / total * 100:.1f}",
+              f"{span.duration / total * 100:.1f}") for span in spans))
+        return format_html('<table>{}</table>', rows)
+
+class LogEntryAdmin(admin.ModelAdmin):
+    list_display = ["timestamp", "level", "source", "message", "order_log", "confirmation_log"]
+    list_filter = ["level", "source", "timestamp"]
+    search_fields = ["message"]
+    date_hierarchy = "timestamp"
+    list_select_related = ["order_log", "confirmation_log"]
+    list_per_page = 100
+    # counting all entries for every page is slow once there are many entries
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+class TimingSpanAdmin(admin.ModelAdmin):
+    change_list_template = "track/timing_spans.html"
+    list_display = ["name", "depth", "duration", "start_offset", "order_log"]
+    list_filter = ["name", "order_log__start_time"]
+    list_select_related = ["order_log"]
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        """
+        Shows the median and 95th percentile duration of each stage for the spans that match the current filters.
+        """
+        response = super().changelist_view(request, extra_context)
+        if hasattr(response, 'context_data') and 'cl' in response.context_data:
+            queryset = response.context_data['cl'].queryset.order_by()
+            response.context_data['stage_stats'] = (queryset.values('name')
+                .annotate(count=Count('id'), avg=Avg('duration'), p50=Percentile('duration', 0.5), p95=Percentile('duration', 0.95))
+                .order_by('-p95'))
+        return response
+
+class OrderStatisticAdmin(admin.ModelAdmin):
+    """
+    Dashboard of the order statistics precomputed by the scheduler (see `track/statistics.py`).
+    """
+    change_list_template = "track/order_dashboard.html"
+    list_display = ["name", "key", "value", "refreshed_at"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = dict(extra_context or {}, title="Order dashboard", dashboard=statistics.get_dashboard())
+        return super().changelist_view(request, extra_context)
+
+class OrderJobAdmin(admin.ModelAdmin):
+    list_display = ["id", "record_id", "action", "status", "attempts", "created_at", "finished_at", "duration", "latency"]
+    list_filter = ["status", "action"]
+    readonly_fields = ["created_at", "started_at", "finished_at", "duration", "latency"]
 
 admin.site.register(Order, OrderAdmin)
 admin.site.register(OrderLog, OrderLogAdmin)
 admin.site.register(ConfirmationCheckLog, ConfirmationCheckLogAdmin)
+admin.site.register(OrderJob, OrderJobAdmin)
+admin.site.register(LogEntry, LogEntryAdmin)
+admin.site.register(TimingSpan, TimingSpanAdmin)
+admin.site.register(OrderStatistic, OrderStatisticAdmin)
@@ -1,16 +1,29 @@
 from django.http import JsonResponse, HttpResponse
 from http import HTTPStatus
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
 from django.views.decorators.csrf import csrf_exempt
+from django.core.handlers.asgi import ASGIRequest
 from django.conf import settings
 from track.models import *
-import track.orders as orders
-from track.exceptions import REDCapError
+from track.exceptions import OrderNotClaimedError, OrderNumberNotStoredError
+import track.jobs as jobs
+from track import http_client, metrics, orders
 
 import logging
 logger = logging.getLogger(__name__)
 
 @csrf_exempt
-def initiate_order(request):
+@metrics.timed_view('edrop_webhook_duration_seconds')
+async def initiate_order(request):
+    """
+    Endpoint for the REDCap webhook. The view is async, so when served through ASGI, a worker can keep
+    many webhook calls open while they wait for REDCap and GBF (see ORDER_PLACEMENT_MODE).
+
+    REDCap calls the webhook on every save of the contact instrument. Calls for a record that has been
+    handled in the last WEBHOOK_DEDUPE_TTL seconds, or that is still being handled by another worker,
+    return right away (see `_claim_record`).
+    """
     if request.method != 'POST':
         return HttpResponse(status=HTTPStatus.METHOD_NOT_ALLOWED)
     
@@ -25,23 +38,90 @@ def initiate_order(request):
         return HttpResponse(status=HTTPStatus.OK)
     
     record_id = request.POST.get('record')
-    order = Order.objects.filter(record_id=record_id).first()
+    if not record_id:
+        logger.error("Endpoint was called without a record id.")
+        return HttpResponse(status=HTTPStatus.BAD_REQUEST)
+
+    duplicate = await _claim_record(record_id)
+    if duplicate:
+        logger.debug(f"Webhook for record {record_id} is a duplicate ({duplicate}).")
+        metrics.inc('edrop_webhook_deduplicated_total', reason=duplicate)
+        return JsonResponse({'status': 'duplicate'}, status=HTTPStatus.OK)
+
+    try:
+        return await _handle_record(request, record_id)
+    finally:
+        await cache.adelete(_in_flight_key(record_id))
+        # without ASGI every call runs in its own event loop, so its clients would never be used again
+        if not isinstance(request, ASGIRequest):
+            await http_client.close_async_clients()
+
+async def _handle_record(request, record_id):
+    order = await Order.objects.filter(record_id=record_id).afirst()
     if order and order.order_number and order.order_status != Order.PENDING:
         # order has already been placed, so do nothing
         logger.debug("An order has already been placed.")
         return HttpResponse(status=HTTPStatus.OK)
+
+    project_id = request.POST.get('project_id')
+    project_url = request.POST.get('project_url')
+    if settings.ORDER_PLACEMENT_MODE == 'webhook':
+        response = await _place_order(record_id, project_id, project_url)
+        if response:
+            return response
     
-    # create a new order only if no order exists
-    try:
-        order = orders.place_order(record_id, request.POST.get('project_id'), request.POST.get('project_url'))
-    except REDCapError as e:
-        return HttpResponse(status=HTTPStatus.INTERNAL_SERVER_ERROR)
-    
-    if not order:
-        logger.error("Endpoint was called with contact_complete = 2 but REDCap order actually does not have contact_complete = 2.")
-        return HttpResponse(status=HTTPStatus.BAD_REQUEST)
+    # placing the order happens in the order worker, so REDCap does not have to wait for GBF
+    job = await sync_to_async(jobs.enqueue_order)(record_id, project_id, project_url)
 
-    logger.debug(f"Order initiated for record {request.POST.get('record', None)}")
+    logger.debug(f"Order queued for record {record_id} (job {job.id}).")
     
-    return JsonResponse({'status':'ok'})
- 
\ No newline at end of file
+    return JsonResponse({'status': 'queued', 'job': job.id}, status=HTTPStatus.ACCEPTED)
+
+def _recent_key(record_id):
+    return f"webhook:recent:{record_id}"
+
+def _in_flight_key(record_id):
+    return f"webhook:in-flight:{record_id}"
+
+async def _claim_record(record_id):
+    """
+    Marks the record as being handled, using the cache shared by all workers. `cache.add` only
+    succeeds for the first caller, so only one call per record is handled at a time. The in-flight
+    marker is removed once the call has been handled and expires after WEBHOOK_IN_FLIGHT_TIMEOUT
+    seconds in case a worker dies; the recent marker expires after WEBHOOK_DEDUPE_TTL seconds.
+
+    Returns:
+    - None if the call should be handled, otherwise why it is a duplicate ('in_flight' or 'recent')
+    """
+    if not await cache.aadd(_in_flight_key(record_id), True, timeout=settings.WEBHOOK_IN_FLIGHT_TIMEOUT):
+        return 'in_flight'
+    if not await cache.aadd(_recent_key(record_id), True, timeout=settings.WEBHOOK_DEDUPE_TTL):
+        await cache.adelete(_in_flight_key(record_id))
+        return 'recent'
+    return None
+
+async def _place_order(record_id, project_id, project_url):
+    """
+    Places the order while REDCap waits for the response. Orders that could not be claimed or that GBF
+    did not accept (including failed requests to GBF) are queued to be placed by the order worker. If GBF
+    accepted the order, but its order number could not be stored in REDCap, only storing the order number is queued.
+
+    Returns:
+    - the response to REDCap, or None if the order could not be placed and should be queued for the order worker
+    """
+    try:
+        order, _ = await orders.async_place_order(record_id, project_id, project_url)
+    except OrderNotClaimedError:
+        logger.exception(f"Could not place order for record {record_id}.")
+        return None
+    except OrderNumberNotStoredError as e:
+        order, _ = e.results[record_id]
+        job = await sync_to_async(jobs.enqueue_order_number)(record_id, project_id, project_url)
+        logger.error(f"Order {order.order_number} has been placed, but its order number could not be stored in REDCap (job {job.id}).")
+        return JsonResponse({'status': 'placed', 'order': order.order_number, 'job': job.id}, status=HTTPStatus.CREATED)
+
+    if not order:
+        return HttpResponse(status=HTTPStatus.OK)
+    if order.order_status == Order.PENDING:
+        return None
+    return JsonResponse({'status': 'placed', 'order': order.order_number}, status=HTTPStatus.CREATED)
@@ -0,0 +1,190 @@
+"""
+Benchmarks of the order and confirmation hot paths. GBF and REDCap are replaced by the stand-in
+servers from `track.standin`, which run in this process. Every benchmark runs in its own database
+transaction that is rolled back afterwards, so no data is changed.
+
+See `track/management/commands/runbenchmarks.py`.
+"""
+from contextlib import contextmanager
+import gc, json, logging, time, tracemalloc
+
+from django.db import transaction
+from django.test import override_settings
+
+from track.models import *
+from track import gbf, http_client, orders, redcap, standin
+from track.utils import chunked, count_queries
+
+logger = logging.getLogger(__name__)
+
+
+class Rollback(Exception):
+    pass
+
+
+def _seed_orders(size, status, shipped=False):
+    """
+    Creates `size` orders for the record ids 1 to `size` with one bulk insert per 5000 orders.
+    """
+    seeded = []
+    for i in range(1, size + 1):
+        order = Order(record_id=str(i), project_id="bench", order_number=f"BENCH-{i:06d}", order_status=status)
+        if shipped:
+            order.ship_date = "2025-01-01"
+            order.tracking_nrs = [f"TRACK{i}"]
+            order.return_tracking_nrs = [f"RETURN{i}"]
+            order.tube_serials = [f"TUBE{i}"]
+        seeded.append(order)
+    Order.objects.bulk_create(seeded, batch_size=5000)
+
+
+def _prepare_place_order(size):
+    def run():
+        for i in range(1, size + 1):
+            orders.place_order(str(i), "bench", "")
+    return run, size
+
+
+def _prepare_check_orders_shipping_info(size):
+    _seed_orders(size, Order.INITIATED)
+    ConfirmationCheckLog.objects.filter(is_complete=False).update(is_complete=True)
+    ConfirmationCheckLog.objects.create(job_id="benchmark")
+    return orders.check_orders_shipping_info, 0
+
+
+def _prepare_check_shipping_info_in_micro_batches(size):
+    run, records = _prepare_check_orders_shipping_info(size)
+    def run_pipeline():
+        with override_settings(SHIPPING_INFO_CHECK_MODE='pipeline'):
+            run()
+    return run_pipeline, records
+
+
+def _generate_confirmation_data(size):
+    """
+    Returns:
+    - the data GBF sends in `dataArray[0].data` for `size` shipped orders
+    """
+    now = time.time()
+    return json.dumps({"ShippingConfirmations": [standin._generate_confirmation(f"BENCH-{i:06d}", now) for i in range(1, size + 1)]})
+
+
+def _prepare_extract_tracking_info(size):
+    data = _generate_confirmation_data(size)
+    return lambda: gbf._extract_tracking_info(data), 0
+
+
+def _prepare_iter_confirmations(size):
+    data = _generate_confirmation_data(size)
+    def run():
+        for chunk in chunked(gbf.iter_confirmations(data), 1000):
+            pass
+    return run, 0
+
+
+def _prepare_set_tracking_info(size):
+    _seed_orders(size, Order.SHIPPED, shipped=True)
+    ConfirmationCheckLog.objects.filter(is_complete=False).update(is_complete=True)
+    ConfirmationCheckLog.objects.create(job_id="benchmark")
+    return lambda: redcap.set_tracking_info(Order.objects.filter(project_id="bench")), 0
+
+
+# name -> function that seeds the data for a size and returns a tuple of the function
+# to measure and the number of REDCap records the stand-in server needs
+BENCHMARKS = {
+    "orders.place_order": _prepare_place_order,
+    "orders.check_orders_shipping_info": _prepare_check_orders_shipping_info,
+    "orders.check_orders_shipping_info:pipeline": _prepare_check_shipping_info_in_micro_batches,
+    "gbf._extract_tracking_info": _prepare_extract_tracking_info,
+    "gbf.iter_confirmations": _prepare_iter_confirmations,
+    "redcap.set_tracking_info": _prepare_set_tracking_info,
+}
+
+
+@contextmanager
+def _quiet_logging():
+    # writing hundreds of thousands of log lines to the console would dominate the timings,
+    # log lines are still written to the log tables
+    logging.disable(logging.INFO)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def _count_requests():
+    return sum(stats['requests'] for stats in http_client.get_stats().values())
+
+
+def run_benchmark(name, size, memory=True):
+    """
+    Runs the benchmark with the given name for `size` orders. Tracing memory allocations slows
+    Python down considerably, so if `memory` is true, the benchmark is run a second time to
+    measure peak memory.
+
+    Returns:
+    - a dictionary with the wall time in seconds, the number of database queries, the peak
+      memory allocated by Python in bytes (None if not measured), and the number of requests
+      made to GBF and REDCap
+    """
+    result = {"path": name, "size": size}
+    result.update(_run(name, size, trace_memory=False))
+    result["peak_memory"] = _run(name, size, trace_memory=True)["peak_memory"] if memory else None
+    return result
+
+
+def _run(name, size, trace_memory):
+    result = {}
+    try:
+        with transaction.atomic(), _quiet_logging():
+            server = None
+            try:
+                function, records = BENCHMARKS[name](size)
+                server = standin.start_server(records=records)
+                with override_settings(GBF_URL=server.gbf_url, REDCAP_URL=server.redcap_url):
+                    gc.collect()
+                    requests_before = _count_requests()
+                    if trace_memory:
+                        tracemalloc.start()
+                    start = time.perf_counter()
+                    with count_queries() as counter:
+                        function()
+                    result["wall_time"] = time.perf_counter() - start
+                    if trace_memory:
+                        result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+                    result["queries"] = counter.count
+                    result["requests"] = _count_requests() - requests_before
+            finally:
+                if tracemalloc.is_tracing():
+                    tracemalloc.stop()
+                if server:
+                    server.shutdown()
+                    server.server_close()
+                http_client.close_sessions()
+            raise Rollback()
+    except Rollback:
+        pass
+    return result
+
+
+def compare(results, baseline):
+    """
+    Compares the results of a run with the results of an earlier run.
+
+    Returns:
+    - a list of tuples of path, size, metric, baseline value, current value, and ratio for all
+      metrics that are in both runs
+    """
+    baseline_results = {(result["path"], result["size"]): result for result in baseline["results"]}
+    comparison = []
+    for result in results["results"]:
+        previous = baseline_results.get((result["path"], result["size"]))
+        if not previous:
+            continue
+        for metric in ["wall_time", "queries", "peak_memory", "requests"]:
+            before, after = previous.get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            ratio = after / before if before else (1.0 if not after else float('inf'))
+            comparison.append((result["path"], result["size"], metric, before, after, ratio))
+    return comparison
@@ -5,4 +5,26 @@ class REDCapError(Exception):
 
     def __init__(self, message="There was an issue with connecting to REDCap."):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+class OrderNumberNotStoredError(REDCapError):
+    """
+    Exception raised when orders have been placed with GBF, but their order numbers
+    could not be stored in REDCap. The orders must not be placed again, only their
+    order numbers have to be stored.
+    """
+
+    def __init__(self, record_ids, results=None, message=None):
+        # ids of the records whose order numbers could not be stored
+        self.record_ids = record_ids
+        # the results of the call that placed the orders (see `orders.place_orders`)
+        self.results = results
+        super().__init__(message or f"Could not store the order numbers of records {record_ids} in REDCap.")
+
+
+class OrderNotClaimedError(Exception):
+    """
+    Exception raised when placing an order failed before the order was claimed, e.g. because the
+    record could not be exported from REDCap. Nothing has been sent to GBF, so the order can be
+    placed again.
+    """
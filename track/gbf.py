@@ -1,42 +1,140 @@
 from django.conf import settings
-import requests, json
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import requests, json, re
 from http import HTTPStatus
 import logging, inspect
 
 from track.models import *
 from track.log_manager import LogManager
+from track import http_client, spans
 
 logger = logging.getLogger(__name__)
 log_manager = LogManager()
 
+# used to parse the order confirmations one at a time (see `iter_confirmations`)
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
 
+
+@spans.span("gbf.create_order")
 def create_order(order, adress_data):
     """
-    Generates an order number and saves it in the order object. Then places an order with GBF.
+    Places an order with GBF. The order must have been claimed by `orders.place_order`, which saves
+    its order number and starts its log.
 
     Returns:
      - true if placing the order was successful, false otherwise
     """
-    order_number = _generate_order_number(order)
-    order.order_number = order_number
-    order.save()
-
-    log_manager.start_order_log(order_number)
+    order_number = order.order_number
     # generate order json
-    order_json = _generate_order_json(order, adress_data)
+    with spans.span("gbf._generate_order_json"):
+        order_json = _generate_order_json(order, adress_data)
 
     # we cannot store PII (which the shipping address is, 
     # so this is here just for testing purposes and should not be executed in production)
     #logger.error(order_json)
 
-    message = f"Placing order {order.order_number} with GBF."
-    log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, message, order_number)
-    logger.info(message)
+    _log_placing_order(order_number)
     
     # make order with GBF
-    order_response = _place_order_with_GBF(order_json, order_number)
+    with spans.span("gbf._place_order_with_GBF"):
+        order_response = _place_order_with_GBF(order_json, order_number)
+
+    with spans.span("gbf._check_order_response"):
+        return _check_order_response(order_response, order_number)
+
+async def async_create_order(order, adress_data):
+    """
+    Same as `create_order`, but waits for GBF without blocking the thread. At most
+    GBF_MAX_CONCURRENT_REQUESTS orders are sent to GBF at the same time.
+
+    Returns:
+     - true if placing the order was successful, false otherwise
+    """
+    with spans.span("gbf.create_order"):
+        order_number = order.order_number
+        with spans.span("gbf._generate_order_json"):
+            order_json = _generate_order_json(order, adress_data)
+
+        await sync_to_async(_log_placing_order)(order_number)
+
+        with spans.span("gbf._place_order_with_GBF"):
+            order_response = await _async_post_order_to_GBF(order_json)
+            await sync_to_async(_log_order_response)(order_response, order_number)
+
+        with spans.span("gbf._check_order_response"):
+            return await sync_to_async(_check_order_response)(order_response, order_number)
+
+def _log_placing_order(order_number):
+    message = f"Placing order {order_number} with GBF."
+    log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, message, order_number)
+    logger.info(message)
+
+def create_orders(orders_with_address):
+    """
+    Places several orders with GBF in a single request. Expects a list of tuples of an order object
+    and the address data of the order. The orders must have been claimed by `orders.place_orders`, which saves
+    their order numbers and starts their logs.
+
+    If GBF lists the outcome of each order in its response, that outcome is used. Otherwise a successful
+    response means that all orders have been placed. If the request fails in any other way, it is not known
+    which orders GBF has stored, so all orders are reported as failed and none of them is sent again, which
+    could order a kit twice.
+
+    Returns:
+     - a dictionary with the order number of each order as key and true or false as value, 
+       depending on whether the order was placed successfully
+    """
+    order_numbers = [order.order_number for order, _ in orders_with_address]
+    for order_number in order_numbers:
+        message = f"Placing order {order_number} with GBF in a batch of {len(order_numbers)} orders."
+        log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, message, order_number)
+    logger.info(f"Placing orders {order_numbers} with GBF.")
+
+    order_json = _generate_orders_json(orders_with_address)
+    try:
+        response = _post_order_to_GBF(order_json)
+    except requests.exceptions.RequestException as e:
+        message = f"Could not send batch of orders {order_numbers} to GBF: {e}"
+        logger.error(message)
+        for order_number in order_numbers:
+            log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, message, order_number)
+        return {order_number: False for order_number in order_numbers}
 
-    return _check_order_response(order_response, order_number)
+    response_body = _get_response_body(response)
+    results = _get_order_results(response, response_body, order_numbers)
+
+    for order_number, placed in results.items():
+        if placed:
+            log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, f'Order {order_number} has been successfully placed with GBF!', order_number)
+            log_manager.complete_log(order_number)
+        else:
+            message = f"GBF did not accept order {order_number} of batch {order_numbers}: {response.status_code} {response_body}"
+            log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, message, order_number)
+    failed = [order_number for order_number, placed in results.items() if not placed]
+    if failed:
+        logger.error(f"GBF did not accept orders {failed}: {response.status_code} {response_body}")
+    if len(failed) < len(order_numbers):
+        logger.info(f"Orders {[order_number for order_number in order_numbers if results[order_number]]} have been successfully placed with GBF!")
+    return results
+
+def _get_order_results(response, response_body, order_numbers):
+    """
+    Maps the response to a batch of orders to the outcome of each order. If the response has a list
+    of orders with their order number and whether they were placed, that list is used, and orders that
+    are not in it have not been placed. Otherwise all orders have been placed if the response is successful.
+
+    Returns:
+     - a dictionary with the order number as key and whether the order has been placed as value
+    """
+    entries = response_body.get("orders") if isinstance(response_body, dict) else None
+    if isinstance(entries, list):
+        placed = {entry.get("orderNumber"): entry.get("success") == True for entry in entries if isinstance(entry, dict)}
+        return {order_number: placed.get(order_number, False) for order_number in order_numbers}
+
+    successful = _is_successful(response, response_body)
+    return {order_number: successful for order_number in order_numbers}
 
 def _generate_order_number(order):
     """
@@ -45,37 +143,45 @@ def _generate_order_number(order):
     return "EDROP-%05d"%(order.pk)
 
 def _generate_order_json(order, address_data):
+    return _generate_orders_json([(order, address_data)])
+
+def _generate_orders_json(orders_with_address):
+    """
+    Generates the json for a GBF order request containing all given orders. Expects a list of
+    tuples of an order object and the address data of the order.
+    """
     order_json = {
         "test": settings.GBF_TEST_FLAG,
-        "orders": [
+        "orders": [_generate_order_entry(order, address_data) for order, address_data in orders_with_address]
+    }
+
+    return json.dumps(order_json)
+
+def _generate_order_entry(order, address_data):
+    return {
+        "orderNumber": order.order_number,
+        "shippingInfo": {
+            "address": {
+                "company": f"{address_data['first_name'] if 'first_name' in address_data else ''} {address_data['last_name'] if 'last_name' in address_data else ''}",
+                "addressLine1": address_data['street_1'] if 'street_1' in address_data else '',
+                "addressLine2": address_data['street_2'] if 'street_2' in address_data else '', # in case we add this to redcap, we need to add
+                "city": address_data['city'] if 'city' in address_data else '',
+                "state": address_data['state'] if 'state' in address_data else '',
+                "zipCode": address_data['zip'] if 'zip' in address_data else '',
+                "country": settings.GBF_SHIPPING_COUNTRY,
+                "phone": address_data['phone'] if 'phone' in address_data else '',
+                "residential": True # see GitHub discussion #19 (shipping address)
+            },
+            "shipMethod": settings.GBF_SHIPPING_METHOD,
+        },
+        "lineItems": [
             {
-                "orderNumber": order.order_number,
-                "shippingInfo": {
-                    "address": {
-                        "company": f"{address_data['first_name'] if 'first_name' in address_data else ''} {address_data['last_name'] if 'last_name' in address_data else ''}",
-                        "addressLine1": address_data['street_1'] if 'street_1' in address_data else '',
-                        "addressLine2": address_data['street_2'] if 'street_2' in address_data else '', # in case we add this to redcap, we need to add
-                        "city": address_data['city'] if 'city' in address_data else '',
-                        "state": address_data['state'] if 'state' in address_data else '',
-                        "zipCode": address_data['zip'] if 'zip' in address_data else '',
-                        "country": settings.GBF_SHIPPING_COUNTRY,
-                        "phone": address_data['phone'] if 'phone' in address_data else '',
-                        "residential": True # see GitHub discussion #19 (shipping address)
-                    },
-                    "shipMethod": settings.GBF_SHIPPING_METHOD,
-                },
-                "lineItems": [
-                    {
-                    "itemNumber": settings.GBF_ITEM_NR,
-                    "itemQuantity": settings.GBF_ITEM_QUANTITY,
-                    }
-                ]
+            "itemNumber": settings.GBF_ITEM_NR,
+            "itemQuantity": settings.GBF_ITEM_QUANTITY,
             }
         ]
     }
 
-    return json.dumps(order_json)
-
 def _place_order_with_GBF(order_json, order_number):
     """
     Makes a POST request to the GBF endpoint /oap/api/order with the proper
@@ -88,21 +194,39 @@ def _place_order_with_GBF(order_json, order_number):
     # make post request to GBF
     # By default requests should be made as "test" via an environment variable.
     # Once we go live, the environemnt variable needs to be set to true explictly.
-    headers = {
-        'Authorization': f'Bearer {settings.GBF_TOKEN}',
-        'Content-Type': 'application/json'
-        }
+    response = _post_order_to_GBF(order_json)
+    _log_order_response(response, order_number)
+    return response
 
-    response = requests.post(f"{settings.GBF_URL}oap/api/order", data=order_json, headers=headers)
-    
+def _log_order_response(response, order_number):
     message = "Response from GBF:"
     log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, message, order_number)
     logger.info(message)
 
     log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, response, order_number)
     logger.info(response)
-    
-    return response
+
+def _get_order_headers():
+    return {
+        'Authorization': f'Bearer {settings.GBF_TOKEN}',
+        'Content-Type': 'application/json'
+        }
+
+def _post_order_to_GBF(order_json):
+    return http_client.post(f"{settings.GBF_URL}oap/api/order", endpoint="gbf:oap/api/order", data=order_json, headers=_get_order_headers())
+
+async def _async_post_order_to_GBF(order_json):
+    return await http_client.async_post(f"{settings.GBF_URL}oap/api/order", endpoint="gbf:oap/api/order", max_concurrency=settings.GBF_MAX_CONCURRENT_REQUESTS,
+                                        content=order_json, headers=_get_order_headers())
+
+def _get_response_body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+def _is_successful(response, response_body):
+    return response.status_code == HTTPStatus.OK and bool(response_body) and response_body.get("success") == True
 
 def _check_order_response(response, order_number):
     response_body = response.json()
@@ -117,7 +241,7 @@ def _check_order_response(response, order_number):
         log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, message, order_number)
         logger.error(message)
         
-        message = {response_body}
+        message = response_body
         log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, message, order_number)
         logger.error(message)
         return False
@@ -138,13 +262,18 @@ def _check_order_response(response, order_number):
     log_manager.complete_log(order_number)
     return True
 
-def get_order_confirmations(order_numbers):
+def get_order_confirmations(order_numbers, chunk_size=None, max_workers=None):
     """
     This method gets shipping confirmations from GBF for the given order numbers and returns:
     - date kit was shipped
     - tracking numbers
     - return tracking numbers
 
+    The order numbers are split into chunks of `chunk_size` (default GBF_CONFIRMATION_CHUNK_SIZE)
+    order numbers. Confirmations for up to `max_workers` (default GBF_CONFIRMATION_MAX_WORKERS) chunks 
+    are requested at the same time. If the request for a chunk fails, the confirmations of the other
+    chunks are still returned.
+
     GBF sends json like this:
     {
         "success": True,
@@ -167,21 +296,78 @@ def get_order_confirmations(order_numbers):
         }
     }
     """
-    message = f"Getting GBF Order Confirmations for the following order numbers: {order_numbers}"
-    log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, message)
-    logger.info(message)
+    chunk_size = chunk_size or settings.GBF_CONFIRMATION_CHUNK_SIZE
+    chunks = [order_numbers[i:i + chunk_size] for i in range(0, len(order_numbers), chunk_size)]
+
+    if not chunks:
+        message = "No orders to get GBF Order Confirmations for."
+        log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, message)
+        logger.info(message)
+        return None
+
+    tracking_info = None
+    for _, chunk_tracking_info in iter_order_confirmations(chunks, max_workers):
+        if chunk_tracking_info is not None:
+            tracking_info = tracking_info or {}
+            tracking_info.update(chunk_tracking_info)
+
+    return tracking_info
+
+def iter_order_confirmations(chunks, max_workers=None):
+    """
+    Requests the order confirmations for each of the given chunks of order numbers with up to `max_workers`
+    (default GBF_CONFIRMATION_MAX_WORKERS) requests at the same time. A chunk is only read from `chunks` once
+    its request can be sent, so `chunks` can be a generator that loads the order numbers as they are needed.
+
+    Yields:
+    - tuples of the order numbers of a chunk and their tracking info (see `get_order_confirmations`), or None
+      if the request failed or there are no confirmations, in the order in which GBF responds
+    """
+    max_workers = max_workers or settings.GBF_CONFIRMATION_MAX_WORKERS
+    # only the requests are made in parallel, logging happens here, so that only one thread writes to the log
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for chunk in chunks:
+            message = f"Getting GBF Order Confirmations for the following order numbers: {chunk}"
+            log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, message)
+            logger.info(message)
+            futures[executor.submit(_request_order_confirmations, chunk)] = chunk
 
+            # don't read more chunks than can be requested
+            if len(futures) >= max_workers:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    order_numbers = futures.pop(future)
+                    tracking_info = _get_tracking_info_from_response(future, order_numbers)
+                    log_manager.add_progress(chunks_done=1)
+                    yield order_numbers, tracking_info
+
+        for future in as_completed(futures):
+            tracking_info = _get_tracking_info_from_response(future, futures[future])
+            log_manager.add_progress(chunks_done=1)
+            yield futures[future], tracking_info
+
+def _request_order_confirmations(order_numbers):
     headers = {'Authorization': f'Bearer {settings.GBF_TOKEN}'}
     content = {'orderNumbers': order_numbers, 'format': 'json'}
     logger.debug('Sending to GBF:')
     logger.debug(content)
-    log_manager.append_to_gbf_log(LogManager.LEVEL_DEBUG, content)
+    response = http_client.post(f"{settings.GBF_URL}oap/api/confirm2", endpoint="gbf:oap/api/confirm2", data=content, headers=headers)
+    response.raise_for_status()  # Raises an exception for bad status codes
+    return response
+
+def _get_tracking_info_from_response(future, order_numbers):
+    """
+    Checks the GBF response for one chunk of order numbers and extracts the tracking info.
+
+    Returns:
+    - the tracking info of the chunk, or None if the request failed or there are no confirmations
+    """
     try:
-        response = requests.post(f"{settings.GBF_URL}oap/api/confirm2", data=content, headers=headers)
-        response.raise_for_status()  # Raises an exception for bad status codes
-        
-        logger.debug(response.json())
-    except requests.exceptions.HTTPError as err:
+        response = future.result()
+        response_body = response.json()
+        logger.debug(response_body)
+    except (requests.exceptions.RequestException, ValueError) as err:
         message = f"Could not get order confirmation from GBF for the following order numbers: {order_numbers}."
         log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, message)
         logger.error(message)
@@ -191,9 +377,8 @@ def get_order_confirmations(order_numbers):
         logger.error(message)
         return None
 
-    response_body = response.json()
     # if for some reason GBF does not return a success response
-    if response_body['success'] != True:
+    if response_body.get('success') != True:
         message = "GBF returned success is false."
         log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, message)
         logger.error(message)
@@ -222,22 +407,95 @@ def get_order_confirmations(order_numbers):
         logger.info(message)
         return None
     
-    confirmations = json.loads(data_object["data"])
+    try:
+        return _extract_tracking_info(data_object["data"])
+    except ValueError as err:
+        message = f"Could not parse order confirmations from GBF for the following order numbers: {order_numbers}."
+        log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, message)
+        logger.error(message)
+        logger.error(err)
+        return None
+
+
+def _extract_tracking_info(data):
+    """
+    Returns:
+    - the tracking info of all confirmations in the data GBF sends in `dataArray[0].data`
+      (see `get_order_confirmations` and `iter_confirmations`)
+    """
+    return dict(iter_confirmations(data))
 
-    return _extract_tracking_info(confirmations)
+def iter_confirmations(data):
+    """
+    Parses the confirmations in the data GBF sends in `dataArray[0].data` (a string containing json,
+    see `get_order_confirmations`) one at a time. Only the confirmation that is being yielded is held
+    in memory as Python objects, so callers that consume the confirmations in chunks (e.g. with
+    `track.utils.chunked`) never hold all of them. Fields other than `ShippingConfirmations` are skipped.
+
+    Raises a ValueError if the data is not valid json.
 
-def _extract_tracking_info(confirmations):
-    tracking_info = {}
-    if "ShippingConfirmations" in confirmations:
-        for shipping_confirmation in confirmations['ShippingConfirmations']:
-            tracking_info[shipping_confirmation['OrderNumber']] = {
-                'date_kit_shipped': shipping_confirmation['ShipDate'] if 'ShipDate' in shipping_confirmation else None,
-                'kit_tracking_n': shipping_confirmation['Tracking'] if 'Tracking' in shipping_confirmation else None,
-                #filter for items with return tracking numbers and returns tracking numbers
-                'return_tracking_n': [return_track if 'Items' in shipping_confirmation else None for item in shipping_confirmation['Items'] if 'ReturnTracking' in item for return_track in item['ReturnTracking']],
-                #filter for items with return tracking numbers and returns tracking numbers
-                'tube_serial_n': [tube_serial if 'Items' in shipping_confirmation else None for item in shipping_confirmation['Items'] if 'TubeSerial' in item for tube_serial in item['TubeSerial']]
-            }  
-    return tracking_info   
+    Yields:
+    - tuples of order number and tracking info, e.g.:
+      ('EDROP-001', {
+          'date_kit_shipped': '2023-01-12', 
+          'kit_tracking_n': ['outbound tracking 1', 'outbound tracking 2'], 
+          'return_tracking_n': ['inbound tracking', 'inbound tracking2'],
+          'tube_serial_n': [tube serial1', 'tube serial2']
+      })
+    """
+    index = _expect(data, _skip_whitespace(data, 0), '{')
+    if data.startswith('}', index):
+        return
+    while True:
+        key, index = _decoder.raw_decode(data, index)
+        index = _expect(data, index, ':')
+        if key == 'ShippingConfirmations' and data.startswith('[', index):
+            index = yield from _iter_confirmation_array(data, index + 1)
+        else:
+            _, index = _decoder.raw_decode(data, index)
+        index = _skip_whitespace(data, index)
+        if data.startswith('}', index):
+            return
+        index = _expect(data, index, ',')
 
+def _iter_confirmation_array(data, index):
+    """
+    Yields the tracking info of each confirmation in the array that starts at the given index
+    (just after the opening bracket).
+
+    Returns:
+    - the index after the closing bracket of the array
+    """
+    index = _skip_whitespace(data, index)
+    if data.startswith(']', index):
+        return index + 1
+    while True:
+        shipping_confirmation, index = _decoder.raw_decode(data, index)
+        yield shipping_confirmation['OrderNumber'], _get_confirmation_tracking_info(shipping_confirmation)
+        index = _skip_whitespace(data, index)
+        if data.startswith(']', index):
+            return index + 1
+        index = _expect(data, index, ',')
 
+def _skip_whitespace(data, index):
+    return _whitespace.match(data, index).end()
+
+def _expect(data, index, char):
+    """
+    Returns:
+    - the index of the next value after the given character, which has to be the next non-whitespace character
+    """
+    index = _skip_whitespace(data, index)
+    if not data.startswith(char, index):
+        raise json.JSONDecodeError(f"Expecting '{char}'", data, index)
+    return _skip_whitespace(data, index + 1)
+
+def _get_confirmation_tracking_info(shipping_confirmation):
+    return {
+        'date_kit_shipped': shipping_confirmation['ShipDate'] if 'ShipDate' in shipping_confirmation else None,
+        'kit_tracking_n': shipping_confirmation['Tracking'] if 'Tracking' in shipping_confirmation else None,
+        #filter for items with return tracking numbers and returns tracking numbers
+        'return_tracking_n': [return_track if 'Items' in shipping_confirmation else None for item in shipping_confirmation['Items'] if 'ReturnTracking' in item for return_track in item['ReturnTracking']],
+        #filter for items with return tracking numbers and returns tracking numbers
+        'tube_serial_n': [tube_serial if 'Items' in shipping_confirmation else None for item in shipping_confirmation['Items'] if 'TubeSerial' in item for tube_serial in item['TubeSerial']]
+    }
@@ -0,0 +1,189 @@
+from urllib.parse import urlsplit
+import asyncio, logging, threading, time, weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from track import metrics
+
+logger = logging.getLogger(__name__)
+
+_sessions = {}
+_stats = {}
+_lock = threading.Lock()
+# event loop -> host -> async client and semaphore limiting the concurrent requests to the host
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_session(url):
+    """
+    Returns the session for the host of the given url. Sessions are created once per host
+    and keep their connections alive, so subsequent requests to the same host do not need
+    a new TCP and TLS handshake.
+    """
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    with _lock:
+        session = _sessions.get(host)
+        if not session:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+            session.mount(f"{parts.scheme}://", adapter)
+            _sessions[host] = session
+    return session
+
+
+def close_sessions():
+    """
+    Closes all pooled connections.
+    """
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def post(url, endpoint=None, timeout=None, **kwargs):
+    """
+    Makes a POST request using the pooled session for the host of the url. Takes the same
+    keyword arguments as `requests.post`. If no timeout is given, HTTP_CONNECT_TIMEOUT and
+    HTTP_READ_TIMEOUT are used.
+
+    `endpoint` is the name under which latency and byte counts of the request are reported
+    (see `get_stats`). It defaults to the url without query string. For requests with `stream=True`,
+    the latency is the time until the headers have been received and the body is left to the caller.
+    """
+    endpoint = endpoint or url.split('?')[0]
+    if timeout is None:
+        timeout = (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+
+    start = time.monotonic()
+    try:
+        response = get_session(url).post(url, timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException:
+        _record(endpoint, time.monotonic() - start, 0, 0, error=True)
+        metrics.observe('edrop_outbound_request_duration_seconds', time.monotonic() - start, endpoint=endpoint, status='error')
+        logger.error(f"Request to {endpoint} failed after {time.monotonic() - start:.3f}s.")
+        raise
+
+    elapsed = time.monotonic() - start
+    bytes_sent = _body_size(response.request.body) if response.request is not None else 0
+    if kwargs.get('stream'):
+        bytes_received = int(response.headers.get('Content-Length') or 0)
+    else:
+        bytes_received = len(response.content or b'')
+    _record(endpoint, elapsed, bytes_sent, bytes_received, error=response.status_code >= 400)
+    metrics.observe('edrop_outbound_request_duration_seconds', elapsed, endpoint=endpoint, status=response.status_code)
+    logger.debug(f"POST {endpoint}: {response.status_code} in {elapsed:.3f}s ({bytes_sent} bytes sent, {bytes_received} bytes received).")
+    return response
+
+
+def get_async_client(url, max_concurrency=None):
+    """
+    Returns the async client for the host of the given url and the semaphore that limits how many
+    requests are sent to the host at the same time. Like sessions, clients are created once per host
+    (and event loop) and keep their connections alive.
+
+    Returns:
+    - a tuple of the client and the semaphore
+    """
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    max_concurrency = max_concurrency or settings.HTTP_POOL_MAXSIZE
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if host not in clients:
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=settings.HTTP_POOL_MAXSIZE)
+        clients[host] = (httpx.AsyncClient(limits=limits), asyncio.Semaphore(max_concurrency))
+    return clients[host]
+
+
+async def close_async_clients():
+    """
+    Closes the pooled connections of the async clients of the running event loop.
+    """
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client, _ in clients.values():
+        await client.aclose()
+
+
+async def async_post(url, endpoint=None, timeout=None, max_concurrency=None, **kwargs):
+    """
+    Same as `post`, but waits for the response without blocking the thread. Takes the same keyword
+    arguments as `httpx.AsyncClient.post`. At most `max_concurrency` (default HTTP_POOL_MAXSIZE)
+    requests are sent to the host of the url at the same time; other requests wait for their turn.
+    """
+    endpoint = endpoint or url.split('?')[0]
+    if timeout is None:
+        timeout = httpx.Timeout(settings.HTTP_READ_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT, pool=None)
+
+    client, semaphore = get_async_client(url, max_concurrency)
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            response = await client.post(url, timeout=timeout, **kwargs)
+        except httpx.HTTPError:
+            _record(endpoint, time.monotonic() - start, 0, 0, error=True)
+            metrics.observe('edrop_outbound_request_duration_seconds', time.monotonic() - start, endpoint=endpoint, status='error')
+            logger.error(f"Request to {endpoint} failed after {time.monotonic() - start:.3f}s.")
+            raise
+
+    elapsed = time.monotonic() - start
+    bytes_sent = len(response.request.content)
+    bytes_received = len(response.content)
+    _record(endpoint, elapsed, bytes_sent, bytes_received, error=response.status_code >= 400)
+    metrics.observe('edrop_outbound_request_duration_seconds', elapsed, endpoint=endpoint, status=response.status_code)
+    logger.debug(f"POST {endpoint}: {response.status_code} in {elapsed:.3f}s ({bytes_sent} bytes sent, {bytes_received} bytes received).")
+    return response
+
+
+def _body_size(body):
+    if not body:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, bytes):
+        return len(body)
+    return 0
+
+
+def _record(endpoint, elapsed, bytes_sent, bytes_received, error=False):
+    with _lock:
+        stats = _stats.setdefault(endpoint, {
+            'requests': 0,
+            'errors': 0,
+            'total_time': 0.0,
+            'max_time': 0.0,
+            'bytes_sent': 0,
+            'bytes_received': 0,
+        })
+        stats['requests'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['total_time'] += elapsed
+        stats['max_time'] = max(stats['max_time'], elapsed)
+        stats['bytes_sent'] += bytes_sent
+        stats['bytes_received'] += bytes_received
+
+
+def get_stats():
+    """
+    Returns the request statistics of this process per endpoint, e.g.:
+    {
+        'gbf:oap/api/order': {
+            'requests': 3,
+            'errors': 0,
+            'total_time': 1.2,
+            'max_time': 0.6,
+            'bytes_sent': 2048,
+            'bytes_received': 210
+        }
+    }
+    """
+    with _lock:
+        return {endpoint: dict(stats) for endpoint, stats in _stats.items()}
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
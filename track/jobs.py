@@ -0,0 +1,368 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging, time
+
+from django.conf import settings
+from django.db import connection, transaction, close_old_connections
+from django.utils import timezone
+
+from track.models import *
+from track import orders, metrics, redcap
+from track.exceptions import OrderNumberNotStoredError
+from track.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_order(record_id, project_id, project_url):
+    """
+    Stores a job to place an order for the given record. If there is already a job
+    waiting or running for the record, no new job is created and the existing job is returned.
+    A record can only have one such job (see the constraints of `OrderJob`), so if two processes
+    enqueue the same record at the same time, both get the same job.
+
+    Returns:
+    - the job that will place the order
+    """
+    job, created = OrderJob.objects.get_or_create(
+        record_id=record_id, status__in=[OrderJob.QUEUED, OrderJob.RUNNING],
+        defaults={'project_id': project_id, 'project_url': project_url})
+    if not created:
+        logger.debug(f"Order job {job.id} for record {record_id} is already queued.")
+        return job
+
+    logger.info(f"Queued order job {job.id} for record {record_id}.")
+    return job
+
+
+def enqueue_order_number(record_id, project_id, project_url):
+    """
+    Stores a job to store the order number of the order of the given record in REDCap, for orders that
+    have been placed with GBF, but whose order number could not be stored. If a job for the record is
+    already waiting, it is changed to only store the order number, so the order is not placed again.
+
+    Returns:
+    - the job that will store the order number
+    """
+    job, created = OrderJob.objects.get_or_create(
+        record_id=record_id, status__in=[OrderJob.QUEUED, OrderJob.RUNNING],
+        defaults={'project_id': project_id, 'project_url': project_url, 'action': OrderJob.STORE_ORDER_NUMBER})
+    if not created and job.action != OrderJob.STORE_ORDER_NUMBER:
+        if OrderJob.objects.filter(pk=job.pk, status=OrderJob.QUEUED).update(action=OrderJob.STORE_ORDER_NUMBER):
+            job.action = OrderJob.STORE_ORDER_NUMBER
+
+    logger.info(f"Queued order job {job.id} to store the order number of record {record_id}.")
+    return job
+
+
+def enqueue_missing_orders(record_ids, project_id, project_url=None):
+    """
+    Stores jobs to place orders for those of the given records that have no order or only a pending one,
+    no job that is waiting or running, and no job that failed in the last RECONCILIATION_FAILED_COOLDOWN
+    seconds, so that records that keep failing are not retried on every run. The records are found and
+    the jobs are stored with one INSERT ... SELECT; records for which another process queues a job at
+    the same time are skipped.
+
+    Returns:
+    - the ids of the records that jobs were stored for
+    """
+    record_ids = list(dict.fromkeys(record_ids))
+    if not record_ids:
+        return []
+
+    now = timezone.now()
+    failed_since = now - timedelta(seconds=settings.RECONCILIATION_FAILED_COOLDOWN)
+    table = OrderJob._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {table} (record_id, project_id, project_url, action, status, attempts, created_at, available_at)
+            SELECT exported.record_id, %s, %s, %s, %s, 0, %s, %s
+            FROM unnest(%s::varchar[]) WITH ORDINALITY AS exported (record_id, position)
+            LEFT JOIN {Order._meta.db_table} o ON o.record_id = exported.record_id
+            WHERE (o.id IS NULL OR o.order_status = %s)
+              AND NOT EXISTS (SELECT 1 FROM {table} j
+                              WHERE j.record_id = exported.record_id
+                                AND (j.status IN (%s, %s) OR (j.status = %s AND j.finished_at >= %s)))
+            ORDER BY exported.position
+            ON CONFLICT (record_id) WHERE status IN ('QU', 'RU') DO NOTHING
+            RETURNING record_id
+        """, [project_id, project_url, OrderJob.PLACE_ORDER, OrderJob.QUEUED, now, now, record_ids, Order.PENDING,
+              OrderJob.QUEUED, OrderJob.RUNNING, OrderJob.FAILED, failed_since])
+        queued = {record_id for record_id, in cursor.fetchall()}
+
+    missing = [record_id for record_id in record_ids if record_id in queued]
+    if missing:
+        logger.info(f"Queued order jobs for records {missing}.")
+    return missing
+
+
+def reconcile_orders(page_size=None):
+    """
+    Queues jobs for records that are complete in REDCap but have not been ordered, e.g. because the
+    webhook call for them failed or never arrived. The ids of the complete records are exported from
+    REDCap in one streamed request and compared to the orders in pages of `page_size` (default
+    RECONCILIATION_PAGE_SIZE) records (see `enqueue_missing_orders`).
+
+    Raises a REDCapError if the records cannot be exported from REDCap.
+
+    Returns:
+    - a tuple of the number of complete records and the number of jobs that were queued
+    """
+    page_size = page_size or settings.RECONCILIATION_PAGE_SIZE
+    project_id = redcap.get_project_id()
+
+    checked = 0
+    queued = 0
+    for page in chunked(redcap.iter_complete_record_ids(), page_size):
+        checked += len(page)
+        queued += len(enqueue_missing_orders(page, project_id))
+    metrics.inc('edrop_orders_reconciled_total', queued)
+    logger.info(f"Checked {checked} complete REDCap records for missing orders, queued {queued} order jobs.")
+    return checked, queued
+
+
+def claim_jobs(limit):
+    """
+    Marks up to `limit` queued jobs that are due as running and returns them. Rows are locked
+    with SKIP LOCKED, so several workers can claim jobs at the same time without getting the same job.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(OrderJob.objects.select_for_update(skip_locked=True)
+                    .filter(status=OrderJob.QUEUED, available_at__lte=now)
+                    .order_by('available_at', 'id')[:limit])
+        for job in jobs:
+            job.status = OrderJob.RUNNING
+            job.attempts += 1
+            job.started_at = now
+        OrderJob.objects.bulk_update(jobs, ['status', 'attempts', 'started_at'])
+    return jobs
+
+
+def requeue_stale_jobs():
+    """
+    Puts jobs back in the queue that have been running for longer than ORDER_JOB_STALE_AFTER seconds,
+    e.g. because the worker processing them was killed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.ORDER_JOB_STALE_AFTER)
+    count = OrderJob.objects.filter(status=OrderJob.RUNNING, started_at__lt=cutoff).update(status=OrderJob.QUEUED)
+    if count:
+        logger.warning(f"Requeued {count} stale order jobs.")
+    return count
+
+
+def run_job(job):
+    """
+    Places the order for the given job and records the outcome of the attempt. Jobs for which the
+    order could not be placed are retried until ORDER_JOB_MAX_ATTEMPTS is reached. If the order has
+    been placed, but its order number could not be stored in REDCap, only storing the order number
+    is retried.
+    """
+    start = time.monotonic()
+    try:
+        if job.action == OrderJob.STORE_ORDER_NUMBER:
+            error, retry = _store_order_number(job)
+        else:
+            order, claimed = orders.place_order(job.record_id, job.project_id, job.project_url)
+            error, retry = _get_outcome(order, claimed, _get_stored_order_numbers([(order, claimed)]))
+    except OrderNumberNotStoredError as e:
+        job.action = OrderJob.STORE_ORDER_NUMBER
+        error, retry = str(e), True
+    except Exception as e:
+        logger.exception(f"Order job {job.id} failed.")
+        error, retry = str(e), True
+
+    _finish_job(job, error, retry, time.monotonic() - start)
+    metrics.flush()
+    return job
+
+
+def run_batch(jobs):
+    """
+    Places the orders of all given jobs with a single GBF request (see `orders.place_orders`)
+    and records the outcome for each job. Jobs that only store an order number are run one by one.
+    """
+    start = time.monotonic()
+    outcomes = {job.id: _store_order_number(job) for job in jobs if job.action == OrderJob.STORE_ORDER_NUMBER}
+    placements = [job for job in jobs if job.action != OrderJob.STORE_ORDER_NUMBER]
+    try:
+        if placements:
+            placed = _place_orders(placements, outcomes)
+            stored = _get_stored_order_numbers(placed.values())
+            for job in placements:
+                outcomes.setdefault(job.id, _get_outcome(*placed[job.record_id], stored))
+    except Exception as e:
+        logger.exception(f"Order jobs {[job.id for job in placements]} failed.")
+        for job in placements:
+            outcomes.setdefault(job.id, (str(e), True))
+
+    duration = time.monotonic() - start
+    for job in jobs:
+        error, retry = outcomes[job.id]
+        _finish_job(job, error, retry, duration)
+    metrics.flush()
+    return jobs
+
+
+def _place_orders(jobs, outcomes):
+    """
+    Places the orders of the given jobs. Jobs whose orders have been placed, but whose order numbers could
+    not be stored in REDCap, are changed to only store the order number, and their outcome is added to `outcomes`.
+
+    Returns:
+    - the results of `orders.place_orders`
+    """
+    try:
+        return orders.place_orders([(job.record_id, job.project_id, job.project_url) for job in jobs])
+    except OrderNumberNotStoredError as e:
+        for job in jobs:
+            if job.record_id in e.record_ids:
+                job.action = OrderJob.STORE_ORDER_NUMBER
+                outcomes[job.id] = (f"Could not store the order number of record {job.record_id} in REDCap.", True)
+        return e.results
+
+
+def _get_stored_order_numbers(results):
+    """
+    Gets the order numbers stored in REDCap for the orders that were not claimed, i.e. that another
+    process is placing or has placed. Expects tuples of order and whether it was claimed.
+
+    Returns:
+    - a dictionary with the record id as key and the order number in REDCap as value
+    """
+    record_ids = [order.record_id for order, claimed in results if order and not claimed]
+    if not record_ids:
+        return {}
+    return redcap.get_order_numbers(record_ids)
+
+
+def _get_outcome(order, claimed, stored_order_numbers):
+    """
+    Returns a tuple of the error message (None if the order was placed) and whether
+    the job should be retried.
+    """
+    if not order:
+        return "REDCap record does not have contact_complete = 2.", False
+    if order.order_status == Order.PENDING:
+        return "Order could not be placed with GBF.", True
+    # an order that was placed by another process is only done once its order number is in REDCap,
+    # otherwise the other process is still placing it or could not store the order number
+    if not claimed and stored_order_numbers.get(order.record_id) != order.order_number:
+        return f"Order {order.order_number} has been claimed by another process, but its order number is not in REDCap.", True
+    return None, False
+
+
+def _store_order_number(job):
+    """
+    Stores the order number of the order of the given job in REDCap.
+
+    Returns:
+    - a tuple of the error message (None if the order number was stored) and whether the job should be retried
+    """
+    order = Order.objects.filter(record_id=job.record_id).first()
+    if not order or not order.order_number:
+        return f"There is no order number for record {job.record_id}.", False
+    try:
+        orders.store_order_number_in_redcap(job.record_id, order)
+    except Exception as e:
+        logger.exception(f"Could not store order number {order.order_number} in REDCap (job {job.id}).")
+        return str(e), True
+    return None, False
+
+
+def _finish_job(job, error, retry, duration):
+    now = timezone.now()
+    job.duration = duration
+    job.last_error = error
+
+    if not error:
+        job.status = OrderJob.DONE
+    elif retry and job.attempts < settings.ORDER_JOB_MAX_ATTEMPTS:
+        job.status = OrderJob.QUEUED
+        job.available_at = now + timedelta(seconds=settings.ORDER_JOB_RETRY_DELAY * job.attempts)
+        logger.warning(f"Order job {job.id} for record {job.record_id} will be retried (attempt {job.attempts}): {error}")
+    else:
+        job.status = OrderJob.FAILED
+        logger.error(f"Order job {job.id} for record {job.record_id} failed after {job.attempts} attempts: {error}")
+
+    metrics.observe('edrop_order_job_duration_seconds', duration, status=OrderJob.CHOICES[job.status].lower())
+    if job.status != OrderJob.QUEUED:
+        job.finished_at = now
+        job.latency = (now - job.created_at).total_seconds()
+        metrics.observe('edrop_order_job_latency_seconds', job.latency, status=OrderJob.CHOICES[job.status].lower())
+        logger.info(f"Order job {job.id} finished with status {job.status} in {job.duration:.2f}s (latency {job.latency:.2f}s).")
+
+    job.save(update_fields=['action', 'status', 'last_error', 'available_at', 'finished_at', 'duration', 'latency'])
+
+
+def _run_job_in_thread(job):
+    # every thread has its own database connection, which needs to be cleaned up
+    close_old_connections()
+    try:
+        return run_job(job)
+    finally:
+        close_old_connections()
+
+
+def _run_batch_in_thread(jobs):
+    close_old_connections()
+    try:
+        return run_batch(jobs)
+    finally:
+        close_old_connections()
+
+
+def is_batch_ready(batch_size, window):
+    """
+    A batch is ready if there are at least `batch_size` jobs due or if the oldest
+    due job has been waiting for more than `window` seconds.
+    """
+    now = timezone.now()
+    due_jobs = OrderJob.objects.filter(status=OrderJob.QUEUED, available_at__lte=now)
+    if due_jobs.count() >= batch_size:
+        return True
+    return due_jobs.filter(available_at__lte=now - timedelta(seconds=window)).exists()
+
+
+def process_jobs(executor, concurrency, flush=False):
+    """
+    Claims as many jobs as there are workers and runs them in the given executor. If GBF_BATCH_SIZE
+    is larger than 1, each worker instead places a batch of up to GBF_BATCH_SIZE orders at once. Batches
+    are only started once they are full or GBF_BATCH_WINDOW has passed, unless `flush` is true.
+
+    Returns:
+    - the number of jobs that were processed
+    """
+    batch_size = settings.GBF_BATCH_SIZE
+    if batch_size <= 1:
+        jobs = claim_jobs(concurrency)
+        if jobs:
+            list(executor.map(_run_job_in_thread, jobs))
+        return len(jobs)
+
+    if not flush and not is_batch_ready(batch_size, settings.GBF_BATCH_WINDOW):
+        return 0
+    jobs = claim_jobs(concurrency * batch_size)
+    batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+    if batches:
+        list(executor.map(_run_batch_in_thread, batches))
+    return len(jobs)
+
+
+def run_worker(concurrency=None, poll_interval=None, once=False):
+    """
+    Drains the job queue with a pool of `concurrency` threads. If `once` is true, the worker stops
+    as soon as the queue is empty, otherwise it waits `poll_interval` seconds and checks again.
+    """
+    concurrency = concurrency or settings.ORDER_WORKER_CONCURRENCY
+    poll_interval = settings.ORDER_WORKER_POLL_INTERVAL if poll_interval is None else poll_interval
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="order-worker") as executor:
+        while True:
+            requeue_stale_jobs()
+            processed = process_jobs(executor, concurrency, flush=once)
+            if not processed:
+                if once:
+                    break
+                close_old_connections()
+                time.sleep(poll_interval)
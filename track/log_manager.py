@@ -1,17 +1,26 @@
-import logging
+from contextlib import contextmanager
+import logging, threading
 
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import F
+from django.utils import timezone
 from django_apscheduler.models import DjangoJobExecution
 
 from track.models import *
 
 logger = logging.getLogger(__name__)
 
+# log lines that have not been written yet, per thread (see LogManager.buffered)
+_local = threading.local()
+
 
 class LogManager:
 
-    LEVEL_INFO = "info"
-    LEVEL_DEBUG = "debug"
-    LEVEL_ERROR = "error"
+    LEVEL_INFO = LogEntry.INFO
+    LEVEL_DEBUG = LogEntry.DEBUG
+    LEVEL_WARNING = LogEntry.WARNING
+    LEVEL_ERROR = LogEntry.ERROR
 
     def start_order_log(self, order_number):
         existing_log = OrderLog.objects.filter(order_number=order_number, is_complete=False).first()
@@ -19,12 +28,41 @@ class LogManager:
             self.complete_log(order_number)
         OrderLog.objects.create(order_number=order_number)
 
-    def start_confirmation_log(self):
+    def start_order_logs(self, order_numbers, check_existing=True):
+        """
+        Same as `start_order_log` for several orders, with one INSERT for all logs. If `check_existing`
+        is false, the orders are known not to have a log that is still open (e.g. new orders).
+        """
+        if check_existing:
+            existing = OrderLog.objects.filter(order_number__in=order_numbers, is_complete=False)
+            for order_number in set(existing.values_list('order_number', flat=True)):
+                self.complete_log(order_number)
+        OrderLog.objects.bulk_create([OrderLog(order_number=order_number) for order_number in order_numbers])
+
+    def start_confirmation_log(self, job_id=None):
+        """
+        Starts a new confirmation check log. If no `job_id` is given, the id of the latest execution of the
+        tracking info job is used.
+
+        Returns:
+        - the new log
+        """
         existing_log = ConfirmationCheckLog.objects.filter(is_complete=False).first()
         if existing_log:
             self.complete_log()
-        job_id = DjangoJobExecution.objects.filter(job='check_for_tracking_numbers_job').latest('run_time').id
-        ConfirmationCheckLog.objects.create(job_id=job_id)
+        if job_id is None:
+            job_id = DjangoJobExecution.objects.filter(job='check_for_tracking_numbers_job').latest('run_time').id
+        return ConfirmationCheckLog.objects.create(job_id=job_id)
+
+    def add_progress(self, **counts):
+        """
+        Adds the given counts to the progress fields of the incomplete confirmation check log with one UPDATE,
+        e.g. `add_progress(chunks_done=1)`. Progress is written right away, so it can be seen while the check runs.
+        """
+        try:
+            ConfirmationCheckLog.objects.filter(is_complete=False).update(**{field: F(field) + count for field, count in counts.items()})
+        except DatabaseError as e:
+            logger.error(f"Could not update the progress of the confirmation check: {e}")
 
     def _get_log(self, order_number=None):
         if order_number:
@@ -50,27 +88,101 @@ class LogManager:
         log = self._get_log(order_number)
         return log.id if log else None
 
+    @contextmanager
+    def buffered(self):
+        """
+        Keeps all log lines appended in this thread in memory until the end of the block, 
+        and then writes them with one INSERT per log. Lines are also written when `flush` or 
+        `complete_log` is called, when LOG_BUFFER_MAX_LINES lines are buffered for a log, and
+        when the block is left because of an exception. Blocks can be nested, in which case
+        lines are written at the end of the outermost block.
+        """
+        depth = getattr(_local, 'depth', 0)
+        if not depth:
+            _local.buffers = {}
+        _local.depth = depth + 1
+        try:
+            yield self
+        finally:
+            _local.depth -= 1
+            if not _local.depth:
+                try:
+                    self.flush()
+                finally:
+                    _local.buffers = None
+
+    def flush(self, order_number=None, all_logs=True):
+        """
+        Writes buffered log lines to the database. If `all_logs` is true, lines of all logs are written,
+        otherwise only the lines for the given order number (or the confirmation check log if no order
+        number is given).
+        """
+        buffers = getattr(_local, 'buffers', None)
+        if not buffers:
+            return
+        keys = list(buffers) if all_logs else [order_number]
+        for key in keys:
+            entries = buffers.pop(key, None)
+            if entries:
+                self._write(key, entries)
+
+    def _write(self, order_number, entries):
+        """
+        Adds the given log entries to the incomplete log for the order number (or the 
+        confirmation check log) with one INSERT.
+        """
+        if order_number:
+            model = OrderLog
+            logs = OrderLog.objects.filter(order_number=order_number, is_complete=False)
+        else:
+            model = ConfirmationCheckLog
+            logs = ConfirmationCheckLog.objects.filter(is_complete=False)
+
+        written = False
+        try:
+            log_id = logs.order_by('pk').values_list('pk', flat=True).first()
+            if log_id:
+                for entry in entries:
+                    setattr(entry, f'{model.entry_parent_field}_id', log_id)
+                LogEntry.objects.bulk_create(entries)
+                written = True
+            else:
+                logger.error(f"{model.__name__} not found.")
+        except DatabaseError as e:
+            logger.error(e)
+            logger.error(f"Could not write to {model.__name__}.")
+
+        # we don't want to lose log lines if they can't be written to the database
+        if not written:
+            for entry in entries:
+                logger.error(f"Unable to write to log: {entry}")
+
+    def _append(self, source, level, message, order_number=None):
+        entry = LogEntry(source=source, level=level, message=str(message), timestamp=timezone.now())
+        buffers = getattr(_local, 'buffers', None)
+        if buffers is None:
+            self._write(order_number, [entry])
+            return
+
+        entries = buffers.setdefault(order_number, [])
+        entries.append(entry)
+        if len(entries) >= settings.LOG_BUFFER_MAX_LINES:
+            self.flush(order_number, all_logs=False)
+
     def append_to_apscheduler_log(self, level, message):
-        log = self._get_log()
-        if log:
-            log.append_to_apscheduler_log(level, message)
+        self._append(LogEntry.SOURCE_APSCHEDULER, level, message)
     
     def append_to_orders_log(self, level, message, order_number=None):
-        log = self._get_log(order_number)
-        if log:
-            log.append_to_orders_log(level, message)
+        self._append(LogEntry.SOURCE_ORDERS, level, message, order_number)
         
     def append_to_gbf_log(self, level, message, order_number=None):
-        log = self._get_log(order_number)
-        if log:
-            log.append_to_gbf_log(level, message)
+        self._append(LogEntry.SOURCE_GBF, level, message, order_number)
     
     def append_to_redcap_log(self, level, message, order_number=None):
-        log = self._get_log(order_number)
-        if log:
-            log.append_to_redcap_log(level, message)
+        self._append(LogEntry.SOURCE_REDCAP, level, message, order_number)
 
     def complete_log(self, order_number=None):
+        self.flush(order_number, all_logs=False)
         log = self._get_log(order_number)
 
         if log:
@@ -0,0 +1,115 @@
+import logging, re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from track.models import *
+from track import orders
+
+logger = logging.getLogger(__name__)
+
+# tables whose indexes are dropped to measure the queries without them
+TABLES = [Order._meta.db_table, OrderLog._meta.db_table, ConfirmationCheckLog._meta.db_table]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Seeds orders and logs and prints EXPLAIN ANALYZE timings of the queries that run for every "
+            "webhook call, cron job, and log entry, with and without indexes. Everything happens in one "
+            "transaction that is rolled back at the end, so no data is changed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, default=1_000_000, help="Number of orders to seed.")
+        parser.add_argument("--runs", type=int, default=5, help="How often each query is run (the fastest run is reported).")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("This benchmark requires PostgreSQL.")
+
+        results = {}
+        try:
+            with transaction.atomic():
+                self._seed(options['orders'])
+                results['after'] = self._run_queries(options['orders'], options['runs'])
+                self._drop_indexes()
+                results['before'] = self._run_queries(options['orders'], options['runs'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+        self.stdout.write("")
+        self.stdout.write(f"{'Query':<45} {'without indexes':>18} {'with indexes':>15}")
+        for name, after in results['after'].items():
+            before = results['before'][name]
+            self.stdout.write(f"{name:<45} {before['time']:>15.3f} ms {after['time']:>12.3f} ms")
+        self.stdout.write("")
+        for name, after in results['after'].items():
+            self.stdout.write(f"{name}:")
+            self.stdout.write(f"  without indexes: {results['before'][name]['plan']}")
+            self.stdout.write(f"  with indexes:    {after['plan']}")
+
+    def _seed(self, count):
+        self.stdout.write(f"Seeding {count} orders...")
+        with connection.cursor() as cursor:
+            # about 1% of orders have not shipped yet, 0.1% have not been placed yet
+            cursor.execute(f"""
+                INSERT INTO {Order._meta.db_table} (project_id, record_id, order_number, order_status)
+                SELECT '1', 'bench-' || g, 'BENCH-' || g,
+                    CASE WHEN g %% 100 = 0 THEN %s WHEN g %% 1000 = 1 THEN %s ELSE %s END
+                FROM generate_series(1, %s) g
+            """, [Order.INITIATED, Order.PENDING, Order.SHIPPED, count])
+            # every order has a log, logs of orders that are not shipped yet are not complete
+            cursor.execute(f"""
+                INSERT INTO {OrderLog._meta.db_table} (order_number, orders, gbf, redcap, is_complete, start_time, end_time)
+                SELECT 'BENCH-' || g, '', '', '', g %% 100 <> 0, now(), now()
+                FROM generate_series(1, %s) g
+            """, [count])
+            # one confirmation check per hour for a year, only the last one is running
+            cursor.execute(f"""
+                INSERT INTO {ConfirmationCheckLog._meta.db_table} (job_id, orders, gbf, redcap, apscheduler, is_complete, start_time, end_time)
+                SELECT g::text, '', '', '', '', g < 8760, now(), now()
+                FROM generate_series(1, 8760) g
+            """)
+            for table in TABLES:
+                cursor.execute(f"ANALYZE {table}")
+
+    def _drop_indexes(self):
+        with connection.cursor() as cursor:
+            for table in TABLES:
+                for name, constraint in connection.introspection.get_constraints(cursor, table).items():
+                    if constraint['primary_key'] or constraint['foreign_key'] or not constraint['index']:
+                        continue
+                    if constraint['unique']:
+                        cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS "{name}"')
+                    cursor.execute(f'DROP INDEX IF EXISTS "{name}"')
+                cursor.execute(f"ANALYZE {table}")
+
+    def _get_queries(self, count):
+        record_id = f"bench-{count // 2 + 7}"
+        initiated_number = f"BENCH-{(count // 200) * 100}"
+        confirmation_numbers = [f"BENCH-{i * 100}" for i in range(1, min(count // 100, 100) + 1)]
+        return {
+            "webhook: order by record_id": Order.objects.filter(record_id=record_id).order_by('pk')[:1],
+            "cron: orders due for polling": orders.get_orders_due_for_polling(timezone.now()),
+            "cron: pending orders": Order.objects.filter(order_status=Order.PENDING).values_list("record_id", flat=True),
+            "confirmation: order by order_number": Order.objects.filter(order_number=initiated_number)[:21],
+            "confirmation: orders by order_number (100)": Order.objects.filter(order_number__in=confirmation_numbers),
+            "log: incomplete OrderLog": OrderLog.objects.filter(order_number=initiated_number, is_complete=False).order_by('pk')[:1],
+            "log: incomplete ConfirmationCheckLog": ConfirmationCheckLog.objects.filter(is_complete=False).order_by('pk')[:1],
+        }
+
+    def _run_queries(self, count, runs):
+        results = {}
+        for name, queryset in self._get_queries(count).items():
+            best = None
+            for _ in range(runs):
+                plan = queryset.explain(analyze=True)
+                time = float(re.search(r"Execution Time: ([\d.]+) ms", plan).group(1))
+                if best is None or time < best['time']:
+                    best = {'time': time, 'plan': plan.splitlines()[0].strip()}
+            results[name] = best
+        return results
@@ -1,12 +1,18 @@
-import logging, inspect
+import logging, inspect, time
+from datetime import timedelta
 from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
 
 from track.models import *
-from track import orders
+from track import orders, metrics, jobs, statistics
+from track.exceptions import REDCapError
 from track.log_manager import LogManager
 
+from apscheduler.events import EVENT_JOB_EXECUTED
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from django.core.management.base import BaseCommand
 from django_apscheduler.jobstores import DjangoJobStore
 from django_apscheduler.models import DjangoJobExecution
@@ -15,8 +21,30 @@ from django_apscheduler import util
 logger = logging.getLogger(__name__)
 log_manager = LogManager()
 
+TRACKING_JOB_ID = "check_for_tracking_numbers_job"
+RECONCILIATION_JOB_ID = "reconcile_orders_job"
+ORDER_STATISTICS_JOB_ID = "refresh_order_statistics_job"
+REQUESTED_CHECK_JOB_ID = "run_requested_shipping_info_check_job"
 
+
+@log_manager.buffered()
 def check_for_tracking_info_job():
+    if not orders.claim_shipping_info_check():
+        logger.info("A check for tracking info is already running (e.g. started in the admin). Skipping this run.")
+        if settings.TRACKING_JOB_MODE == 'adaptive':
+            return timezone.now() + timedelta(seconds=settings.TRACKING_JOB_MIN_INTERVAL)
+        return None
+
+    start = time.monotonic()
+    try:
+        return _check_for_tracking_info()
+    finally:
+        orders.release_shipping_info_check()
+        metrics.set_gauge('edrop_tracking_job_last_duration_seconds', time.monotonic() - start)
+        metrics.set_gauge('edrop_tracking_job_last_run_timestamp_seconds', time.time())
+        metrics.flush()
+
+def _check_for_tracking_info():
     log_manager.start_confirmation_log()
     message = f"Started Cron Job {log_manager.get_job_id()}."
     log_manager.append_to_apscheduler_log(LogManager.LEVEL_INFO, message)
@@ -26,11 +54,61 @@ def check_for_tracking_info_job():
     log_manager.append_to_apscheduler_log(LogManager.LEVEL_INFO, message)
     logger.info(message)
 
-    orders.check_orders_shipping_info()
+    adaptive = settings.TRACKING_JOB_MODE == 'adaptive'
+    orders.check_orders_shipping_info(complete_log=not adaptive)
 
     message = "Tracking info check completed."
     logger.info(message)
 
+    if adaptive:
+        next_run_time = _get_next_run_time()
+        log_manager.complete_log()
+        return next_run_time
+
+def _get_next_run_time():
+    """
+    Picks the time of the next run of the tracking info job based on the number of orders
+    due to be checked (see `orders.get_tracking_check_interval`) and logs it.
+    """
+    now = timezone.now()
+    interval, due_count = orders.get_tracking_check_interval(now)
+    next_run_time = now + timedelta(seconds=interval)
+
+    message = f"{due_count} orders are due to be checked for shipping info. Next check in {interval:.0f} seconds at {next_run_time.isoformat()}."
+    log_manager.append_to_apscheduler_log(LogManager.LEVEL_INFO, message)
+    logger.info(message)
+    return next_run_time
+
+@util.close_old_connections
+def run_requested_shipping_info_check_job():
+    """
+    Runs the check for shipping info requested in the admin, if there is one (see
+    `orders.run_requested_shipping_info_check`).
+    """
+    orders.run_requested_shipping_info_check()
+
+@util.close_old_connections
+def reconcile_orders_job():
+    """
+    Queues orders for complete REDCap records whose webhook call was missed (see `jobs.reconcile_orders`).
+    """
+    try:
+        jobs.reconcile_orders()
+    except REDCapError as e:
+        logger.error(f"Could not reconcile orders with REDCap: {e}")
+    finally:
+        metrics.flush()
+
+@util.close_old_connections
+def refresh_order_statistics_job():
+    """
+    Recalculates the order statistics shown on the dashboard in the admin (see `statistics.refresh`).
+    """
+    try:
+        statistics.refresh()
+    except DatabaseError as e:
+        logger.error(f"Could not refresh order statistics: {e}")
+
 # The `close_old_connections` decorator ensures that database connections, that have become
 # unusable or are obsolete, are closed before and after your job has run. You should use it
 # to wrap any jobs that you schedule that access the Django database in any way. 
@@ -47,6 +125,11 @@ def delete_old_job_executions(max_age=604_800):
     DjangoJobExecution.objects.delete_old_job_executions(max_age)
   
 
+def _reschedule_tracking_job(scheduler, event):
+    if event.job_id == TRACKING_JOB_ID and event.retval:
+        scheduler.modify_job(TRACKING_JOB_ID, next_run_time=event.retval)
+
+
 class Command(BaseCommand):
     help = "Runs APScheduler."
 
@@ -54,16 +137,67 @@ class Command(BaseCommand):
         scheduler = BlockingScheduler(timezone=settings.TIME_ZONE)
         scheduler.add_jobstore(DjangoJobStore(), "default")
 
+        if orders.release_stale_shipping_info_check():
+            log_manager.complete_log()
+            logger.warning("Released the check for shipping info that was running when the scheduler stopped.")
+
+        if settings.TRACKING_JOB_MODE == 'adaptive':
+            # the job runs right away and returns the time of its next run, the interval trigger
+            # only applies if a run fails
+            scheduler.add_job(
+                check_for_tracking_info_job,
+                trigger=IntervalTrigger(seconds=settings.TRACKING_JOB_MAX_INTERVAL),
+                next_run_time=timezone.now(),
+                id=TRACKING_JOB_ID,
+                max_instances=1,
+                replace_existing=True,
+            )
+            scheduler.add_listener(lambda event: _reschedule_tracking_job(scheduler, event), EVENT_JOB_EXECUTED)
+            message = f"Added adaptive job: '{TRACKING_JOB_ID}'."
+        else:
+            scheduler.add_job(
+                check_for_tracking_info_job,
+                trigger=CronTrigger(day=settings.CRON_JOB_FREQUENCY), # set parameter to e.g. second="*/10" to run every 10 seconds
+                id=TRACKING_JOB_ID,  # The `id` assigned to each job MUST be unique
+                max_instances=1,
+                replace_existing=True,
+            )
+            message = f"Added job: '{TRACKING_JOB_ID}'."
+        logger.info(message)
+
         scheduler.add_job(
-            check_for_tracking_info_job,
-            trigger=CronTrigger(day=settings.CRON_JOB_FREQUENCY), # set parameter to e.g. second="*/10" to run every 10 seconds
-            id="check_for_tracking_numbers_job",  # The `id` assigned to each job MUST be unique
+            run_requested_shipping_info_check_job,
+            trigger=IntervalTrigger(seconds=settings.SHIPPING_INFO_CHECK_POLL_INTERVAL),
+            id=REQUESTED_CHECK_JOB_ID,
             max_instances=1,
             replace_existing=True,
         )
-        message = "Added job: 'check_for_tracking_numbers_job'."
+        message = f"Added job: '{REQUESTED_CHECK_JOB_ID}'."
         logger.info(message)
 
+        if settings.RECONCILIATION_JOB_INTERVAL:
+            scheduler.add_job(
+                reconcile_orders_job,
+                trigger=IntervalTrigger(seconds=settings.RECONCILIATION_JOB_INTERVAL),
+                id=RECONCILIATION_JOB_ID,
+                max_instances=1,
+                replace_existing=True,
+            )
+            message = f"Added job: '{RECONCILIATION_JOB_ID}'."
+            logger.info(message)
+
+        if settings.ORDER_STATISTICS_REFRESH_INTERVAL:
+            scheduler.add_job(
+                refresh_order_statistics_job,
+                trigger=IntervalTrigger(seconds=settings.ORDER_STATISTICS_REFRESH_INTERVAL),
+                next_run_time=timezone.now(),
+                id=ORDER_STATISTICS_JOB_ID,
+                max_instances=1,
+                replace_existing=True,
+            )
+            message = f"Added job: '{ORDER_STATISTICS_JOB_ID}'."
+            logger.info(message)
+
         scheduler.add_job(
             delete_old_job_executions,
             trigger=CronTrigger(
@@ -0,0 +1,73 @@
+from datetime import datetime
+import json, logging, subprocess
+from django.core.management.base import BaseCommand, CommandError
+
+from track import benchmarks
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the order and confirmation hot paths against in-process stand-ins for GBF and REDCap. "
+            "Reports wall time, database queries, peak memory, and outbound requests, and saves the results as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,1000,100000",
+                            help="Comma separated numbers of orders to run each benchmark with.")
+        parser.add_argument("--paths", default=",".join(benchmarks.BENCHMARKS),
+                            help=f"Comma separated benchmarks to run (default: all of {', '.join(benchmarks.BENCHMARKS)}).")
+        parser.add_argument("--output", default=None,
+                            help="File the JSON results are written to (default: benchmark-<timestamp>.json).")
+        parser.add_argument("--compare", default=None,
+                            help="JSON results of an earlier run to compare against.")
+        parser.add_argument("--no-memory", action="store_true",
+                            help="Don't measure peak memory, which needs a second run of every benchmark.")
+        parser.add_argument("--threshold", type=float, default=1.2,
+                            help="Ratio above which a metric is reported as a regression when comparing.")
+
+    def handle(self, *args, **options):
+        paths = [path.strip() for path in options['paths'].split(",") if path.strip()]
+        unknown = [path for path in paths if path not in benchmarks.BENCHMARKS]
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {unknown}.")
+        sizes = [int(size) for size in options['sizes'].split(",")]
+
+        results = {
+            "commit": self._get_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "results": [],
+        }
+        self.stdout.write(f"{'Path':<44} {'Size':>8} {'Wall time':>12} {'Queries':>9} {'Peak memory':>13} {'Requests':>9}")
+        for path in paths:
+            for size in sizes:
+                result = benchmarks.run_benchmark(path, size, memory=not options['no_memory'])
+                peak_memory = f"{result['peak_memory'] / 1024 / 1024:>10.1f} MB" if result['peak_memory'] is not None else f"{'-':>13}"
+                results["results"].append(result)
+                self.stdout.write(f"{path:<44} {size:>8} {result['wall_time']:>10.3f} s {result['queries']:>9} "
+                                  f"{peak_memory} {result['requests']:>9}")
+
+        output = options['output'] or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(f"Results written to {output}.")
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            self._print_comparison(benchmarks.compare(results, baseline), options['threshold'])
+
+    def _print_comparison(self, comparison, threshold):
+        self.stdout.write("")
+        self.stdout.write(f"{'Path':<44} {'Size':>8} {'Metric':<12} {'Before':>14} {'After':>14} {'Ratio':>7}")
+        for path, size, metric, before, after, ratio in comparison:
+            line = f"{path:<44} {size:>8} {metric:<12} {before:>14.3f} {after:>14.3f} {ratio:>7.2f}"
+            if ratio > threshold:
+                self.stdout.write(self.style.ERROR(f"{line}  regression"))
+            else:
+                self.stdout.write(line)
+
+    def _get_commit(self):
+        try:
+            return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,28 @@
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from track import jobs
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Runs the worker pool that places queued orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=settings.ORDER_WORKER_CONCURRENCY,
+                            help="Number of orders that are placed at the same time.")
+        parser.add_argument("--poll-interval", type=float, default=settings.ORDER_WORKER_POLL_INTERVAL,
+                            help="Seconds to wait before checking for new jobs when the queue is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Stop once the queue is empty instead of waiting for new jobs.")
+
+    def handle(self, *args, **options):
+        message = f"Starting order worker with {options['concurrency']} threads..."
+        logger.info(message)
+        try:
+            jobs.run_worker(options['concurrency'], options['poll_interval'], options['once'])
+        except KeyboardInterrupt:
+            message = "Stopping order worker..."
+            logger.info(message)
@@ -0,0 +1,50 @@
+import logging, time
+from django.core.management.base import BaseCommand
+
+from track import standin
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Runs stand-in GBF and REDCap servers for load tests and benchmarks. Point GBF_URL and "
+            "REDCAP_URL at the printed urls.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help="Host to listen on.")
+        parser.add_argument("--port", type=int, default=8090, help="Port to listen on.")
+        parser.add_argument("--records", type=int, default=1000,
+                            help="Number of REDCap records (record ids 1 to N).")
+        parser.add_argument("--ship-delay", type=float, default=0,
+                            help="Seconds after which an order placed with GBF has shipped.")
+        parser.add_argument("--shipped-ratio", type=float, default=1.0,
+                            help="Fraction of orders that ship at all.")
+        parser.add_argument("--latency-distribution", choices=standin.LATENCY_DISTRIBUTIONS, default=standin.FIXED,
+                            help="How the latency of each request is drawn.")
+        parser.add_argument("--gbf-latency", type=float, default=0, help="Mean latency of GBF requests in milliseconds.")
+        parser.add_argument("--redcap-latency", type=float, default=0, help="Mean latency of REDCap requests in milliseconds.")
+        parser.add_argument("--gbf-error-rate", type=float, default=0, help="Fraction of GBF requests that fail.")
+        parser.add_argument("--redcap-error-rate", type=float, default=0, help="Fraction of REDCap requests that fail.")
+        parser.add_argument("--error-status", type=int, default=503, help="HTTP status of failed requests.")
+        parser.add_argument("--seed", type=int, default=None, help="Seed for latencies and errors.")
+
+    def handle(self, *args, **options):
+        gbf = standin.ServiceConfig(options['gbf_latency'] / 1000, options['latency_distribution'],
+                                    options['gbf_error_rate'], options['error_status'])
+        redcap = standin.ServiceConfig(options['redcap_latency'] / 1000, options['latency_distribution'],
+                                       options['redcap_error_rate'], options['error_status'])
+        server = standin.start_server(options['host'], options['port'], records=options['records'], gbf=gbf,
+                                      redcap=redcap, ship_delay=options['ship_delay'],
+                                      shipped_ratio=options['shipped_ratio'], seed=options['seed'])
+
+        self.stdout.write(f"GBF_URL={server.gbf_url}")
+        self.stdout.write(f"REDCAP_URL={server.redcap_url}")
+        try:
+            while True:
+                time.sleep(60)
+                logger.info(f"Requests served: {server.request_counts}")
+        except KeyboardInterrupt:
+            message = "Stopping stand-in servers..."
+            logger.info(message)
+            server.shutdown()
+            server.server_close()
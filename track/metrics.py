@@ -0,0 +1,226 @@
+"""
+Metrics in the Prometheus text format. The connector runs in several processes (gunicorn workers,
+the order worker, and the scheduler), so metrics are not kept in memory only. Each process adds up
+what it records and writes it to the Metric table with one upsert at the end of each unit of work
+(see `flush`), which adds the recorded values to the values stored by all processes. Metrics can be
+recorded in any thread, but are only flushed by the thread that runs the unit of work (e.g. not by the
+threads that send requests to REDCap), so no other database connections are opened. Gauges for the
+order backlog are calculated when the metrics are requested.
+"""
+from functools import wraps
+import inspect, logging, threading, time
+
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from track.models import *
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+WEBHOOK_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+REQUEST_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+JOB_BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+JOB_LATENCY_BUCKETS = [1, 5, 10, 30, 60, 300, 600, 1800, 3600, 21600, 86400]
+
+# name -> type, help text, histogram buckets
+METRICS = {
+    'edrop_webhook_duration_seconds': (HISTOGRAM, "Time it took to respond to the REDCap webhook.", WEBHOOK_BUCKETS),
+    'edrop_webhook_deduplicated_total': (COUNTER, "Webhook calls that were ignored because the record was already being or had just been handled.", None),
+    'edrop_orders_reconciled_total': (COUNTER, "Order jobs queued for complete REDCap records that had not been ordered.", None),
+    'edrop_outbound_request_duration_seconds': (HISTOGRAM, "Duration of requests to GBF and REDCap.", REQUEST_BUCKETS),
+    'edrop_order_job_duration_seconds': (HISTOGRAM, "Time it took to process an order job.", JOB_BUCKETS),
+    'edrop_order_job_latency_seconds': (HISTOGRAM, "Time between an order job being queued and being finished.", JOB_LATENCY_BUCKETS),
+    'edrop_orders_placed_total': (COUNTER, "Orders placed with GBF.", None),
+    'edrop_orders_failed_total': (COUNTER, "Orders that could not be placed with GBF.", None),
+    'edrop_orders_shipped_total': (COUNTER, "Orders for which shipping info has been received.", None),
+    'edrop_tracking_job_last_duration_seconds': (GAUGE, "Duration of the last run of the tracking info job.", None),
+    'edrop_tracking_job_last_run_timestamp_seconds': (GAUGE, "Time the last run of the tracking info job finished.", None),
+    # calculated when the metrics are requested
+    'edrop_orders': (GAUGE, "Number of orders per status.", None),
+    'edrop_orders_due_for_polling': (GAUGE, "Number of initiated orders that are due to be checked for shipping info.", None),
+    'edrop_order_jobs': (GAUGE, "Number of order jobs per status.", None),
+}
+
+ORDER_STATUS_LABELS = {
+    Order.PENDING: 'pending',
+    Order.INITIATED: 'initiated',
+    Order.SHIPPED: 'shipped',
+    Order.DONE: 'done',
+}
+
+_lock = threading.Lock()
+# (name, labels, le) -> value to add
+_increments = {}
+# (name, labels, le) -> value to set
+_gauges = {}
+
+
+def _format_labels(labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def inc(name, amount=1, **labels):
+    """
+    Increases the counter with the given name and labels.
+    """
+    with _lock:
+        key = (name, _format_labels(labels), '')
+        _increments[key] = _increments.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, _format_labels(labels), '')] = value
+
+
+def observe(name, value, **labels):
+    """
+    Adds an observation to the histogram with the given name and labels.
+    """
+    buckets = METRICS[name][2]
+    label_string = _format_labels(labels)
+    with _lock:
+        for bound in buckets:
+            if value <= bound:
+                key = (f"{name}_bucket", label_string, repr(float(bound)))
+                _increments[key] = _increments.get(key, 0) + 1
+        for key, amount in [((f"{name}_bucket", label_string, '+Inf'), 1), ((f"{name}_sum", label_string, ''), value),
+                            ((f"{name}_count", label_string, ''), 1)]:
+            _increments[key] = _increments.get(key, 0) + amount
+
+
+def timed_view(name):
+    """
+    Decorator for views that records how long the view took in the histogram with the given name,
+    labeled with the status code of the response. Metrics are written once the view has returned.
+    Works for sync and async views.
+    """
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                start = time.monotonic()
+                status = 500
+                try:
+                    response = await view(request, *args, **kwargs)
+                    status = response.status_code
+                    return response
+                finally:
+                    observe(name, time.monotonic() - start, status=status)
+                    await sync_to_async(flush)()
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            start = time.monotonic()
+            status = 500
+            try:
+                response = view(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                observe(name, time.monotonic() - start, status=status)
+                flush()
+        return wrapper
+    return decorator
+
+
+def flush():
+    """
+    Writes the metrics recorded in this process to the database with one statement for counters
+    and histograms, which are added to the stored values, and one for gauges, which replace them.
+    """
+    with _lock:
+        increments = dict(_increments)
+        gauges = dict(_gauges)
+        _increments.clear()
+        _gauges.clear()
+        
+    try:
+        # a savepoint, so that a failing write does not break the transaction of the caller
+        with transaction.atomic():
+            _upsert(increments, f"{Metric._meta.db_table}.value + EXCLUDED.value")
+            _upsert(gauges, "EXCLUDED.value")
+    except DatabaseError as e:
+        logger.error(f"Could not write metrics: {e}")
+
+
+def _upsert(values, new_value):
+    if not values:
+        return
+    # rows are always written in the same order, so that processes writing at the same time don't deadlock
+    rows = sorted(values.items())
+    now = timezone.now()
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    params = [param for (name, labels, le), value in rows for param in (name, labels, le, value, now)]
+    table = Metric._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {table} (name, labels, le, value, updated_at) VALUES {placeholders}
+            ON CONFLICT (name, labels, le) DO UPDATE SET value = {new_value}, updated_at = EXCLUDED.updated_at
+        """, params)
+
+
+def _get_backlog():
+    """
+    Returns:
+    - a list of tuples of name, labels, and value of the gauges for the order backlog
+    """
+    now = timezone.now()
+    series = []
+    order_counts = dict(Order.objects.values_list('order_status').annotate(count=Count('id')).values_list('order_status', 'count'))
+    for status, label in ORDER_STATUS_LABELS.items():
+        series.append(('edrop_orders', _format_labels({'status': label}), order_counts.get(status, 0)))
+    due_count = Order.objects.filter(Q(next_poll_at__isnull=True) | Q(next_poll_at__lte=now), order_status=Order.INITIATED).count()
+    series.append(('edrop_orders_due_for_polling', '', due_count))
+    job_counts = dict(OrderJob.objects.values_list('status').annotate(count=Count('id')).values_list('status', 'count'))
+    for status in OrderJob.CHOICES:
+        series.append(('edrop_order_jobs', _format_labels({'status': OrderJob.CHOICES[status].lower()}), job_counts.get(status, 0)))
+    return series
+
+
+def _format_series(name, labels, le, value):
+    if le:
+        labels = f'{labels},le="{le}"' if labels else f'le="{le}"'
+    return f"{name}{{{labels}}} {value!r}" if labels else f"{name} {value!r}"
+
+
+def render():
+    """
+    Returns:
+    - the metrics of all processes in the Prometheus text format
+    """
+    flush()
+    stored = {}
+    for name, labels, le, value in Metric.objects.values_list('name', 'labels', 'le', 'value'):
+        stored.setdefault(name, []).append((labels, le, float(value)))
+    for name, labels, value in _get_backlog():
+        stored.setdefault(name, []).append((labels, '', float(value)))
+
+    lines = []
+    for name, (kind, help_text, bounds) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == HISTOGRAM:
+            # only buckets that an observation fell into are stored, the others are 0
+            buckets = {(labels, le): value for labels, le, value in stored.get(f"{name}_bucket", [])}
+            sums = {labels: value for labels, _, value in stored.get(f"{name}_sum", [])}
+            for labels, _, count in sorted(stored.get(f"{name}_count", [])):
+                for le in [repr(float(bound)) for bound in bounds] + ['+Inf']:
+                    lines.append(_format_series(f"{name}_bucket", labels, le, buckets.get((labels, le), 0.0)))
+                lines.append(_format_series(f"{name}_sum", labels, '', sums.get(labels, 0.0)))
+                lines.append(_format_series(f"{name}_count", labels, '', count))
+        else:
+            for labels, le, value in sorted(stored.get(name, [])):
+                lines.append(_format_series(name, labels, le, value))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,33 @@
+# Generated by Django 5.1 on 2026-10-17 18:03
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0035_orderjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.CharField(choices=[('debug', 'Debug'), ('info', 'Info'), ('warning', 'Warning'), ('error', 'Error')], max_length=10)),
+                ('source', models.CharField(choices=[('orders', 'Orders'), ('gbf', 'GBF'), ('redcap', 'REDCap'), ('apscheduler', 'APScheduler')], max_length=20)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('message', models.TextField()),
+                ('confirmation_log', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='track.confirmationchecklog')),
+                ('order_log', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='track.orderlog')),
+            ],
+            options={
+                'verbose_name_plural': 'log entries',
+                'ordering': ['timestamp', 'id'],
+                'indexes': [models.Index(fields=['order_log', 'timestamp'], name='track_logen_order_l_2e5075_idx'), models.Index(fields=['confirmation_log', 'timestamp'], name='track_logen_confirm_a73dd7_idx'), models.Index(fields=['level', 'timestamp'], name='track_logen_level_5478b9_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('confirmation_log__isnull', True), ('order_log__isnull', False)), models.Q(('confirmation_log__isnull', False), ('order_log__isnull', True)), _connector='OR'), name='logentry_has_one_parent')],
+            },
+        ),
+    ]
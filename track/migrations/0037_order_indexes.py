@@ -0,0 +1,39 @@
+# Generated by Django 5.1 on 2026-10-17 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0036_logentry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='record_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='confirmationchecklog',
+            index=models.Index(condition=models.Q(('is_complete', False)), fields=['id'], name='confcheck_incomplete_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('order_status', 'IN')), fields=['order_number'], name='order_initiated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('order_status', 'PE')), fields=['record_id'], name='order_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderlog',
+            index=models.Index(condition=models.Q(('is_complete', False)), fields=['order_number'], name='orderlog_incomplete_idx'),
+        ),
+    ]
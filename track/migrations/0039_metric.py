@@ -0,0 +1,27 @@
+# Generated by Django 5.1 on 2026-10-17 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0038_order_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Metric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('labels', models.CharField(blank=True, default='', max_length=1000)),
+                ('le', models.CharField(blank=True, default='', max_length=50)),
+                ('value', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('name', 'labels', 'le'), name='metric_unique_series')],
+            },
+        ),
+    ]
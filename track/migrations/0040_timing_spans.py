@@ -0,0 +1,44 @@
+# Generated by Django 5.1 on 2026-10-17 18:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0039_metric'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimingSpan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('depth', models.PositiveSmallIntegerField(default=0)),
+                ('start_offset', models.FloatField()),
+                ('duration', models.FloatField()),
+            ],
+            options={
+                'ordering': ['order_log', 'start_offset', 'id'],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='orderlog',
+            name='orderlog_incomplete_idx',
+        ),
+        migrations.AddIndex(
+            model_name='orderlog',
+            index=models.Index(fields=['order_number', 'is_complete'], name='orderlog_order_number_idx'),
+        ),
+        migrations.AddField(
+            model_name='timingspan',
+            name='order_log',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='spans', to='track.orderlog'),
+        ),
+        migrations.AddIndex(
+            model_name='timingspan',
+            index=models.Index(fields=['name', 'duration'], name='track_timin_name_6141ca_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1 on 2026-10-17 18:39
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicate_records(apps, schema_editor):
+    # duplicate orders have to be resolved by hand, we don't want to guess which one GBF knows about
+    Order = apps.get_model('track', 'Order')
+    duplicates = list(Order.objects.values_list('record_id').annotate(count=Count('id')).filter(count__gt=1).values_list('record_id', flat=True))
+    if duplicates:
+        raise RuntimeError(f"There are several orders for the records {duplicates}. Remove the duplicates before migrating.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0040_timing_spans'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_records, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='record_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
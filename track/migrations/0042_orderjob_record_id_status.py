@@ -0,0 +1,17 @@
+# Generated by Django 5.1 on 2026-10-17 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0041_order_record_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='orderjob',
+            index=models.Index(fields=['record_id', 'status'], name='track_order_record__947bae_idx'),
+        ),
+    ]
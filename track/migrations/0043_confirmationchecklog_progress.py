@@ -0,0 +1,33 @@
+# Generated by Django 5.1 on 2026-10-17 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0042_orderjob_record_id_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='confirmationchecklog',
+            name='chunks_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='confirmationchecklog',
+            name='chunks_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='confirmationchecklog',
+            name='orders_updated',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='confirmationchecklog',
+            name='redcap_batches',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1 on 2026-10-17 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0043_confirmationchecklog_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderStatistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=50)),
+                ('value', models.FloatField()),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('name', 'key'), name='orderstatistic_unique_key')],
+            },
+        ),
+    ]
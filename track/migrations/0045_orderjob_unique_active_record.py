@@ -0,0 +1,31 @@
+# Generated by Django 5.1 on 2026-10-17 19:29
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fail_duplicate_jobs(apps, schema_editor):
+    # only the oldest waiting or running job of a record is kept, the others would place the same order again
+    OrderJob = apps.get_model('track', 'OrderJob')
+    kept = set()
+    duplicates = []
+    for job_id, record_id in OrderJob.objects.filter(status__in=['QU', 'RU']).order_by('id').values_list('id', 'record_id'):
+        if record_id in kept:
+            duplicates.append(job_id)
+        kept.add(record_id)
+    OrderJob.objects.filter(id__in=duplicates).update(status='FA', last_error="Duplicate of an older job for the record.", finished_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0044_orderstatistic'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_duplicate_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='orderjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['QU', 'RU'])), fields=('record_id',), name='orderjob_unique_active_record'),
+        ),
+    ]
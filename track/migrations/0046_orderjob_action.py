@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-17 19:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('track', '0045_orderjob_unique_active_record'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderjob',
+            name='action',
+            field=models.CharField(choices=[('PO', 'Place order'), ('SO', 'Store order number')], default='PO', max_length=3),
+        ),
+    ]
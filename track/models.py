@@ -4,6 +4,7 @@ import pytz
 
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField
 
 logger = logging.getLogger(__name__)
@@ -16,8 +17,8 @@ class Order(models.Model):
     initiated_by = models.CharField(max_length=255, blank=True, null=True) # REDCap user who initiated the order
     redcap_url = models.CharField(max_length=255, blank=True, null=True)
     project_url = models.CharField(max_length=255, blank=True, null=True)
-    record_id = models.CharField(max_length=255) # which record was created/modified
-    order_number = models.CharField(max_length=255, blank=True, null=True)
+    record_id = models.CharField(max_length=255, unique=True) # which record was created/modified
+    order_number = models.CharField(max_length=255, blank=True, null=True, unique=True)
 
     # GBF data
     ship_date = models.CharField(max_length=255, blank=True, null=True)
@@ -39,8 +40,25 @@ class Order(models.Model):
     }
     order_status = models.CharField(max_length=3, choices=CHOICES, blank=True, null=True)
 
+    # when the order was placed with GBF and when GBF should be asked for shipping info next
+    # (see `orders.get_next_poll_at`), orders without a next poll time are checked on the next run
+    initiated_at = models.DateTimeField(blank=True, null=True)
+    next_poll_at = models.DateTimeField(blank=True, null=True)
+    # number of times GBF was asked for shipping info of this order without the kit having shipped
+    poll_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # orders that are checked for shipping info
+            models.Index(fields=['next_poll_at'], condition=models.Q(order_status='IN'), name='order_poll_due_idx'),
+            # orders that still need to be placed
+            models.Index(fields=['record_id'], condition=models.Q(order_status='PE'), name='order_pending_idx'),
+        ]
+
 
 class Log(models.Model):
+    # log lines are stored as LogEntry objects, these fields contain the log lines of logs written 
+    # before LogEntry was introduced
     orders = models.TextField(default='', blank=True, null=True)
     gbf = models.TextField(default='', blank=True, null=True)
     redcap = models.TextField(default='', blank=True, null=True)
@@ -48,24 +66,21 @@ class Log(models.Model):
     start_time = models.DateTimeField(auto_now_add=True)
     end_time = models.DateTimeField(default=datetime.now(pytz.timezone(settings.REQUEST_TIMEZONE)))
 
+    # name of the field on LogEntry that references this kind of log
+    entry_parent_field = None
+
     def append_to_orders_log(self, level, message):
-        if not self.is_complete:
-            self.orders += f'{level.upper()}: {message}\n'
-            self.save(update_fields=['orders'])
-        else:
-            logger.error('Log has already been completed. Unable to append to log.')
+        self._append_entry(LogEntry.SOURCE_ORDERS, level, message)
 
     def append_to_gbf_log(self, level, message):
-        if not self.is_complete:
-            self.gbf += f'{level.upper()}: {message}\n'
-            self.save(update_fields=['gbf'])
-        else:
-            logger.error('Log has already been completed. Unable to append to log.')
+        self._append_entry(LogEntry.SOURCE_GBF, level, message)
 
     def append_to_redcap_log(self, level, message):
+        self._append_entry(LogEntry.SOURCE_REDCAP, level, message)
+
+    def _append_entry(self, source, level, message):
         if not self.is_complete:
-            self.redcap += f'{level.upper()}: {message}\n'
-            self.save(update_fields=['redcap'])
+            LogEntry.objects.create(source=source, level=level, message=str(message), **{self.entry_parent_field: self})
         else:
             logger.error('Log has already been completed. Unable to append to log.')
 
@@ -84,13 +99,199 @@ class Log(models.Model):
 class OrderLog(Log):
     order_number = models.CharField(max_length=255, blank=True, null=True)
 
+    entry_parent_field = 'order_log'
+
+    class Meta:
+        indexes = [
+            # used to find the incomplete log of an order and the log to store timing spans with
+            models.Index(fields=['order_number', 'is_complete'], name='orderlog_order_number_idx'),
+        ]
+
 class ConfirmationCheckLog(Log):
     job_id = models.CharField(max_length=255, blank=True, null=True)
     apscheduler = models.TextField(default='', blank=True, null=True)
 
+    # progress of the check, updated while it runs (see `LogManager.add_progress`)
+    chunks_total = models.PositiveIntegerField(default=0) # requests to GBF for order confirmations
+    chunks_done = models.PositiveIntegerField(default=0)
+    orders_updated = models.PositiveIntegerField(default=0)
+    redcap_batches = models.PositiveIntegerField(default=0) # batches of tracking info sent to REDCap
+
+    entry_parent_field = 'confirmation_log'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(is_complete=False), name='confcheck_incomplete_idx'),
+        ]
+
     def append_to_apscheduler_log(self, level, message):
-        if not self.is_complete:
-            self.apscheduler += f'{level.upper()}: {message}\n'
-            self.save(update_fields=['apscheduler'])
-        else:
-            logger.error('Log has already been completed. Unable to append to log.')
+        self._append_entry(LogEntry.SOURCE_APSCHEDULER, level, message)
+
+
+class LogEntry(models.Model):
+    """
+    A single log line of an OrderLog or a ConfirmationCheckLog. Entries are only ever added, never changed.
+    """
+    # the indexes on (log, timestamp) below are used for lookups by log
+    order_log = models.ForeignKey(OrderLog, on_delete=models.CASCADE, blank=True, null=True, related_name='entries', db_index=False)
+    confirmation_log = models.ForeignKey(ConfirmationCheckLog, on_delete=models.CASCADE, blank=True, null=True, related_name='entries', db_index=False)
+
+    DEBUG = 'debug'
+    INFO = 'info'
+    WARNING = 'warning'
+    ERROR = 'error'
+
+    LEVELS = {
+        DEBUG: "Debug",
+        INFO: "Info",
+        WARNING: "Warning",
+        ERROR: "Error"
+    }
+    level = models.CharField(max_length=10, choices=LEVELS)
+
+    SOURCE_ORDERS = 'orders'
+    SOURCE_GBF = 'gbf'
+    SOURCE_REDCAP = 'redcap'
+    SOURCE_APSCHEDULER = 'apscheduler'
+
+    SOURCES = {
+        SOURCE_ORDERS: "Orders",
+        SOURCE_GBF: "GBF",
+        SOURCE_REDCAP: "REDCap",
+        SOURCE_APSCHEDULER: "APScheduler"
+    }
+    source = models.CharField(max_length=20, choices=SOURCES)
+
+    timestamp = models.DateTimeField(default=timezone.now)
+    message = models.TextField()
+
+    def __str__(self):
+        return f'{self.level.upper()}: {self.message}'
+
+    class Meta:
+        verbose_name_plural = "log entries"
+        ordering = ['timestamp', 'id']
+        indexes = [
+            models.Index(fields=['order_log', 'timestamp']),
+            models.Index(fields=['confirmation_log', 'timestamp']),
+            models.Index(fields=['level', 'timestamp']),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(order_log__isnull=False, confirmation_log__isnull=True) | models.Q(order_log__isnull=True, confirmation_log__isnull=False),
+                name='logentry_has_one_parent',
+            ),
+        ]
+
+
+class TimingSpan(models.Model):
+    """
+    How long one stage of placing an order took (see `track/spans.py`). Spans are nested, `depth` is 0 for
+    the span around the whole order placement, and `start_offset` is the number of seconds between the start
+    of the order placement and the start of the span.
+    """
+    order_log = models.ForeignKey(OrderLog, on_delete=models.CASCADE, related_name='spans')
+    name = models.CharField(max_length=255)
+    depth = models.PositiveSmallIntegerField(default=0)
+    start_offset = models.FloatField()
+    duration = models.FloatField()
+
+    class Meta:
+        ordering = ['order_log', 'start_offset', 'id']
+        indexes = [
+            models.Index(fields=['name', 'duration']),
+        ]
+
+
+class OrderJob(models.Model):
+    """
+    A request to place an order for a REDCap record, or to store the order number of an order that
+    has been placed in REDCap. Jobs are created by the REDCap webhook and processed by the order
+    worker (see `track/management/commands/runorderworker.py`).
+    """
+    record_id = models.CharField(max_length=255)
+    project_id = models.CharField(max_length=255, blank=True, null=True)
+    project_url = models.CharField(max_length=255, blank=True, null=True)
+
+    QUEUED = 'QU'
+    RUNNING = 'RU'
+    DONE = 'DO'
+    FAILED = 'FA'
+
+    CHOICES = {
+        QUEUED: "Queued",
+        RUNNING: "Running",
+        DONE: "Done",
+        FAILED: "Failed"
+    }
+    status = models.CharField(max_length=3, choices=CHOICES, default=QUEUED)
+
+    PLACE_ORDER = 'PO'
+    # the order has been placed with GBF, but its order number still has to be stored in REDCap
+    STORE_ORDER_NUMBER = 'SO'
+
+    ACTIONS = {
+        PLACE_ORDER: "Place order",
+        STORE_ORDER_NUMBER: "Store order number",
+    }
+    action = models.CharField(max_length=3, choices=ACTIONS, default=PLACE_ORDER)
+
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    # jobs that failed are retried once this time has passed
+    available_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    # seconds the last attempt took
+    duration = models.FloatField(blank=True, null=True)
+    # seconds between the job being queued and it being finished
+    latency = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+            # used to find records without a waiting, running or recently failed job (see `jobs.enqueue_missing_orders`)
+            models.Index(fields=['record_id', 'status']),
+        ]
+        constraints = [
+            # a record has at most one job that is waiting or running (see `jobs.enqueue_order`)
+            models.UniqueConstraint(fields=['record_id'], condition=models.Q(status__in=['QU', 'RU']), name='orderjob_unique_active_record'),
+        ]
+
+
+class Metric(models.Model):
+    """
+    The value of one metric series, shared by all processes (see `track/metrics.py`). Histograms are 
+    stored as one row per bucket (with the upper bound in `le`) plus one row for the sum and the count.
+    """
+    name = models.CharField(max_length=255)
+    # rendered labels, e.g. endpoint="gbf:oap/api/order",status="200"
+    labels = models.CharField(max_length=1000, blank=True, default='')
+    le = models.CharField(max_length=50, blank=True, default='')
+    value = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'labels', 'le'], name='metric_unique_series'),
+        ]
+
+
+class OrderStatistic(models.Model):
+    """
+    A precomputed statistic about the orders, shown on the order dashboard in the admin. All rows are
+    replaced by the scheduler at once (see `track/statistics.py`), so the dashboard never reads the orders.
+    """
+    # e.g. "status", "initiated_per_day", "days_to_ship"
+    name = models.CharField(max_length=50)
+    # e.g. the order status, the day, or the percentile
+    key = models.CharField(max_length=50)
+    value = models.FloatField()
+    refreshed_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'key'], name='orderstatistic_unique_key'),
+        ]
@@ -2,74 +2,558 @@ from track.models import *
 from track import redcap   
 from track import gbf
 from django.conf import settings
-import logging, inspect
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from datetime import timedelta
+import logging, inspect, math
 
 from track.models import *
 from track.log_manager import LogManager
+from track.exceptions import REDCapError, OrderNumberNotStoredError, OrderNotClaimedError
+from track.utils import chunked, count_queries
+from track import metrics, spans
 
 logger = logging.getLogger(__name__)
 log_manager = LogManager()
 
+# cache key that is set while a check for shipping info is running (see `claim_shipping_info_check`)
+SHIPPING_INFO_CHECK_KEY = 'shipping-info-check:running'
+# cache key that is set while a check started in the admin waits for the scheduler to run it
+SHIPPING_INFO_CHECK_REQUEST_KEY = 'shipping-info-check:requested'
+# job id of the confirmation check logs of checks started in the admin
+ADMIN_JOB_ID = 'admin'
+
 
 def place_order(record_id, project_id, project_url):
-    address_data = redcap.get_record_info(record_id)
+    """
+    Places an order for the given record if the record has contact_complete = 2 in REDCap. The
+    time each stage takes is stored with the OrderLog of the order (see `track/spans.py`).
+
+    Raises an OrderNumberNotStoredError if GBF accepted the order, but its order number could
+    not be stored in REDCap.
+
+    Returns:
+    - a tuple of the order (None if no order was placed because the record is not complete) and
+      whether this call claimed the order, i.e. the order was not already being placed or placed
+    """
+    with spans.trace("orders.place_order") as trace:
+        order, claimed = _place_order(record_id, project_id, project_url)
+    # the spans of a call that did not claim the order would be stored with the log of another call
+    if claimed:
+        trace.save(order.order_number)
+    return order, claimed
+
+
+@log_manager.buffered()
+def _place_order(record_id, project_id, project_url):
+    with spans.span("redcap.get_record_info"):
+        address_data = redcap.get_record_info(record_id)
     # we need to make sure that the original request actually came from REDCap, so we make sure
     # that the record in REDCap is indeed set to contact_complete = 2 (complete)
     if address_data[settings.REDCAP_FIELD_TO_BE_COMPLETE] != '2':
-        return None
-    
-    order = Order.objects.filter(record_id=record_id).first()
-    if not order:
-        order = Order.objects.create(record_id=record_id, project_id=project_id, project_url=project_url,order_status=Order.PENDING)
+        return None, False
     
-    # to be safe, we'll first set it to initiated in case two process for whatever reason do the samething
-    # we don't want to order two kits
-    order.order_status = Order.INITIATED
-    order.save()
+    with spans.span("db.save_order"):
+        order, claimed = _claim_order(record_id, project_id, project_url)
+    if not claimed:
+        logger.info(f"Order for record {record_id} is already being placed or has been placed.")
+        return order, False
 
-    success = gbf.create_order(order, address_data)
+    try:
+        success = gbf.create_order(order, address_data)
+    except Exception:
+        # the order has been claimed, so it has to be set back to pending to be placed again
+        metrics.inc('edrop_orders_failed_total')
+        with spans.span("db.reset_order"):
+            _reset_order(order)
+        raise
     
     if success:
+        metrics.inc('edrop_orders_placed_total')
         # post order number back to redcap
-        store_order_number_in_redcap(record_id, order)
+        with spans.span("redcap.set_order_number"):
+            try:
+                store_order_number_in_redcap(record_id, order)
+            except Exception as e:
+                logger.error(f"Could not store order number {order.order_number} in REDCap: {e}")
+                raise OrderNumberNotStoredError([record_id], {record_id: (order, True)}) from e
     else:
+        metrics.inc('edrop_orders_failed_total')
         # set order status back to pending, so we can try again.
-        order.order_status = Order.PENDING
-        order.save()
+        with spans.span("db.reset_order"):
+            _reset_order(order)
+
+    return order, True
+
+
+async def async_place_order(record_id, project_id, project_url):
+    """
+    Same as `place_order`, but waits for REDCap and GBF without blocking the thread, so that one process
+    can place many orders at the same time. Database work is run in Django's thread for synchronous code.
+
+    Raises an OrderNotClaimedError if the record could not be looked up in REDCap or the order could not
+    be claimed, and an OrderNumberNotStoredError if GBF accepted the order, but its order number could
+    not be stored in REDCap.
+
+    Returns:
+    - a tuple of the order (None if no order was placed because the record is not complete) and
+      whether this call claimed the order
+    """
+    with spans.trace("orders.place_order") as trace:
+        try:
+            with spans.span("redcap.get_record_info"):
+                address_data = await redcap.async_get_record_info(record_id)
+            if address_data[settings.REDCAP_FIELD_TO_BE_COMPLETE] != '2':
+                return None, False
+
+            with spans.span("db.save_order"):
+                order, claimed = await sync_to_async(_claim_order)(record_id, project_id, project_url)
+        except Exception as e:
+            raise OrderNotClaimedError(f"Could not claim the order for record {record_id}: {e}") from e
+        if not claimed:
+            logger.info(f"Order for record {record_id} is already being placed or has been placed.")
+            return order, False
+
+        try:
+            success = await gbf.async_create_order(order, address_data)
+        except Exception:
+            # the order is set back to pending below, so it can be placed again (e.g. by the order worker)
+            logger.exception(f"Could not send order {order.order_number} to GBF.")
+            success = False
+
+        if success:
+            metrics.inc('edrop_orders_placed_total')
+            with spans.span("redcap.set_order_number"):
+                try:
+                    await redcap.async_set_order_number(record_id, order.order_number)
+                except Exception as e:
+                    logger.error(f"Could not store order number {order.order_number} in REDCap: {e}")
+                    raise OrderNumberNotStoredError([record_id], {record_id: (order, True)}) from e
+        else:
+            metrics.inc('edrop_orders_failed_total')
+            with spans.span("db.reset_order"):
+                await sync_to_async(_reset_order)(order)
+
+    await sync_to_async(trace.save)(order.order_number)
+    return order, True
+
+
+def _claim_order(record_id, project_id, project_url):
+    """
+    Returns:
+    - a tuple of the order of the record and whether it was claimed (see `_claim_orders`)
+    """
+    return _claim_orders([(record_id, project_id, project_url)])[record_id]
+
+
+def _claim_orders(records):
+    """
+    Gets or creates the orders of the given records (tuples of record id, project id, and project url)
+    and sets the orders that are pending to initiated, so that no other process places them as well
+    (we don't want to order two kits). Claimed orders get an order number, and their OrderLog is
+    opened in the same transaction.
+
+    Orders for new records are created already initiated and with their order number with one INSERT
+    (see `_insert_initiated_orders`). Existing orders are locked, so if several processes place the
+    same order at the same time, only one of them claims it.
+
+    Returns:
+    - a dictionary with the record id as key and a tuple of the order and whether it was claimed as value
+    """
+    record_ids = list(dict.fromkeys(record_id for record_id, _, _ in records))
+    now = timezone.now()
+    with transaction.atomic():
+        inserted_ids = _insert_initiated_orders(records, now)
+        orders = list(Order.objects.filter(record_id__in=record_ids).order_by('pk'))
+        # orders that already existed are locked in the order of their primary key, so that processes
+        # claiming several orders don't deadlock
+        existing_ids = [order.pk for order in orders if order.pk not in inserted_ids]
+        if existing_ids:
+            locked = Order.objects.select_for_update().filter(pk__in=existing_ids).order_by('pk').in_bulk()
+            orders = [locked.get(order.pk, order) for order in orders]
 
-    return order
+        claimed = [order for order in orders if order.pk in inserted_ids or order.order_status in (Order.PENDING, None)]
+        retried = [order for order in claimed if order.pk not in inserted_ids]
+        for order in retried:
+            _set_initiated(order, now)
+            order.order_number = order.order_number or gbf._generate_order_number(order)
+        if retried:
+            Order.objects.bulk_update(retried, ['order_status', 'initiated_at', 'next_poll_at', 'poll_count', 'order_number'])
+        if claimed:
+            log_manager.start_order_logs([order.order_number for order in claimed], check_existing=bool(retried))
+
+    claimed_ids = {order.pk for order in claimed}
+    return {order.record_id: (order, order.pk in claimed_ids) for order in orders}
+
+
+def _insert_initiated_orders(records, now):
+    """
+    Creates initiated orders for the records that don't have an order yet with one INSERT. The order number
+    is derived from the primary key, which is taken from the sequence of the table in the same statement,
+    so the orders don't have to be updated afterwards. Records that already have an order are skipped.
+
+    Returns:
+    - the primary keys of the created orders
+    """
+    rows = list({record_id: (record_id, project_id, project_url) for record_id, project_id, project_url in records}.values())
+    if not rows:
+        return set()
+
+    table = Order._meta.db_table
+    next_poll_at = get_next_poll_at(Order(initiated_at=now, poll_count=0), now)
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+    params = [param for position, row in enumerate(rows) for param in (position, *row)]
+    with connection.cursor() as cursor:
+        # the order number has the same format as gbf._generate_order_number ("EDROP-%05d")
+        cursor.execute(f"""
+            WITH new_orders (position, record_id, project_id, project_url) AS (VALUES {values}),
+            numbered AS (
+                SELECT nextval(pg_get_serial_sequence('{table}', 'id')) AS id, record_id, project_id, project_url
+                FROM new_orders
+                WHERE NOT EXISTS (SELECT 1 FROM {table} o WHERE o.record_id = new_orders.record_id)
+                ORDER BY position
+            )
+            INSERT INTO {table} (id, record_id, project_id, project_url, order_number, order_status, initiated_at, next_poll_at, poll_count)
+            SELECT id, record_id, project_id, project_url, 'EDROP-' || lpad(id::text, greatest(5, length(id::text)), '0'), %s, %s, %s, 0
+            FROM numbered
+            ON CONFLICT (record_id) DO NOTHING
+            RETURNING id
+        """, params + [Order.INITIATED, now, next_poll_at])
+        return {row[0] for row in cursor.fetchall()}
+
+
+def _reset_order(order):
+    order.order_status = Order.PENDING
+    order.save()
+
+
+@log_manager.buffered()
+def place_orders(records):
+    """
+    Places orders for several records with a single request to GBF. Expects a list of tuples
+    of record id, project id, and project url. Like `place_order`, orders are only placed for
+    records that have contact_complete = 2 in REDCap.
+
+    Raises an OrderNumberNotStoredError once all orders have been handled if the order numbers of
+    some orders GBF accepted could not be stored in REDCap. The results are set on the exception.
+
+    Returns:
+    - a dictionary with the record id as key and a tuple of the order (None if no order was placed
+      because the record is not complete) and whether this call claimed the order as value
+    """
+    # a record that is in the batch more than once is only placed once
+    records = list({record_id: (record_id, project_id, project_url) for record_id, project_id, project_url in records}.values())
+    results = {}
+    complete_records = []
+    orders_with_address = []
+    records_info = redcap.get_records_info([record_id for record_id, _, _ in records])
+    for record_id, project_id, project_url in records:
+        address_data = records_info.get(record_id)
+        if not address_data or address_data[settings.REDCAP_FIELD_TO_BE_COMPLETE] != '2':
+            results[record_id] = (None, False)
+            continue
+
+        complete_records.append((record_id, project_id, project_url))
+
+    claims = _claim_orders(complete_records)
+    for record_id, (order, claimed) in claims.items():
+        results[record_id] = (order, claimed)
+        if claimed:
+            orders_with_address.append((order, records_info[record_id]))
+        else:
+            logger.info(f"Order for record {record_id} is already being placed or has been placed.")
+
+    if not orders_with_address:
+        return results
+
+    orders = [order for order, _ in orders_with_address]
+    placed = gbf.create_orders(orders_with_address)
+
+    failed_orders = []
+    not_stored = []
+    for order in orders:
+        if placed.get(order.order_number):
+            # the kit has been ordered, so a failing REDCap update should not affect the other orders
+            try:
+                store_order_number_in_redcap(order.record_id, order)
+            except Exception as e:
+                logger.error(f"Could not store order number {order.order_number} in REDCap: {e}")
+                not_stored.append(order.record_id)
+        else:
+            order.order_status = Order.PENDING
+            failed_orders.append(order)
+    Order.objects.bulk_update(failed_orders, ['order_status'])
+    metrics.inc('edrop_orders_placed_total', len(orders) - len(failed_orders))
+    metrics.inc('edrop_orders_failed_total', len(failed_orders))
+
+    if not_stored:
+        raise OrderNumberNotStoredError(not_stored, results)
+    return results
 
 
 def store_order_number_in_redcap(record_id, order):
     redcap.set_order_number(record_id, order.order_number)
 
 
-def check_orders_shipping_info():
+def _set_initiated(order, now):
+    """
+    Sets the order status to initiated and schedules the first check for shipping info without saving the order.
+    """
+    order.order_status = Order.INITIATED
+    order.initiated_at = now
+    order.poll_count = 0
+    order.next_poll_at = get_next_poll_at(order, now)
+
+
+def get_next_poll_at(order, now):
+    """
+    Calculates when GBF should next be asked for the shipping info of the given order. The time between
+    two checks starts at GBF_POLL_MIN_INTERVAL and is multiplied by GBF_POLL_BACKOFF_FACTOR for every check
+    that did not return shipping info. Orders are also not checked more often than once per GBF_POLL_AGE_FACTOR
+    of their age. The time between checks is never longer than GBF_POLL_MAX_INTERVAL.
+
+    Returns:
+    - the time of the next check
+    """
+    min_interval = settings.GBF_POLL_MIN_INTERVAL
+    max_interval = settings.GBF_POLL_MAX_INTERVAL
+    # the exponent is capped, so that orders that have been polled very often don't overflow the float
+    interval = min_interval * settings.GBF_POLL_BACKOFF_FACTOR ** min(order.poll_count, 64)
+    if order.initiated_at:
+        age = (now - order.initiated_at).total_seconds()
+        interval = max(interval, age * settings.GBF_POLL_AGE_FACTOR)
+    interval = min(max(interval, min_interval), max_interval)
+    return now + timedelta(seconds=interval)
+
+
+def get_orders_due_for_polling(now):
+    """
+    Returns:
+    - the initiated orders whose next check for shipping info is due, with only the fields
+      needed for scheduling loaded
+    """
+    return Order.objects.filter(
+        Q(next_poll_at__isnull=True) | Q(next_poll_at__lte=now),
+        order_status=Order.INITIATED,
+    ).only('id', 'order_number', 'initiated_at', 'poll_count').order_by('next_poll_at', 'id')
+
+
+def get_tracking_check_interval(now):
+    """
+    Picks the time until the next check for shipping info based on the number of orders that are due. The
+    next check starts once TRACKING_JOB_TARGET_DUE_ORDERS orders are due, but not sooner than 
+    TRACKING_JOB_MIN_INTERVAL and not later than TRACKING_JOB_MAX_INTERVAL seconds from now.
+
+    Returns:
+    - a tuple of the number of seconds until the next check and the number of orders due now
+    """
+    min_interval = settings.TRACKING_JOB_MIN_INTERVAL
+    max_interval = settings.TRACKING_JOB_MAX_INTERVAL
+    target = settings.TRACKING_JOB_TARGET_DUE_ORDERS
+
+    initiated_orders = Order.objects.filter(order_status=Order.INITIATED)
+    due_count = get_orders_due_for_polling(now).count()
+    if due_count >= target:
+        return min_interval, due_count
+
+    # the time at which the target number of orders will be due
+    position = target - due_count - 1
+    poll_times = list(initiated_orders.filter(next_poll_at__gt=now).order_by('next_poll_at')
+                      .values_list('next_poll_at', flat=True)[position:position + 1])
+    interval = (poll_times[0] - now).total_seconds() if poll_times else max_interval
+    return min(max(interval, min_interval), max_interval), due_count
+
+
+def claim_shipping_info_check():
+    """
+    Marks a check for shipping info as running, using the cache shared by all processes, so that the
+    scheduled job and checks started in the admin don't run at the same time. The mark is removed by
+    `release_shipping_info_check`, by `release_stale_shipping_info_check` when the scheduler starts, and
+    expires after SHIPPING_INFO_CHECK_TIMEOUT seconds.
+
+    Returns:
+    - True if no other check is running
+    """
+    return cache.add(SHIPPING_INFO_CHECK_KEY, True, timeout=settings.SHIPPING_INFO_CHECK_TIMEOUT)
+
+def release_shipping_info_check():
+    cache.delete(SHIPPING_INFO_CHECK_KEY)
+
+def request_shipping_info_check():
+    """
+    Requests a check for shipping info (see `check_orders_shipping_info`), which the scheduler starts within
+    SHIPPING_INFO_CHECK_POLL_INTERVAL seconds (see `run_requested_shipping_info_check`), and returns right
+    away. The check is marked as running right away, so that the scheduled job does not start another one in
+    the meantime. Its progress is stored in its confirmation check log.
+
+    Returns:
+    - the confirmation check log of the check, or None if a check is already running or requested
+    """
+    if not claim_shipping_info_check():
+        return None
+    try:
+        log = log_manager.start_confirmation_log(job_id=ADMIN_JOB_ID)
+        cache.set(SHIPPING_INFO_CHECK_REQUEST_KEY, log.id, timeout=settings.SHIPPING_INFO_CHECK_TIMEOUT)
+    except Exception:
+        release_shipping_info_check()
+        raise
+    return log
+
+def run_requested_shipping_info_check():
+    """
+    Runs the check for shipping info requested by `request_shipping_info_check`, if there is one.
+
+    Returns:
+    - True if a check was run
+    """
+    if not cache.delete(SHIPPING_INFO_CHECK_REQUEST_KEY):
+        return False
+    try:
+        check_orders_shipping_info()
+    except Exception as e:
+        message = f"Check for shipping info failed: {e}"
+        log_manager.append_to_orders_log('error', message)
+        logger.exception(message)
+        log_manager.complete_log()
+    finally:
+        release_shipping_info_check()
+        metrics.flush()
+    return True
+
+def release_stale_shipping_info_check():
+    """
+    Removes the running mark of a check for shipping info that was left behind when the scheduler stopped.
+    Checks only run in the scheduler, so none can be running when it starts. A requested check that
+    has not been started yet keeps its mark and is run by the scheduler.
+
+    Returns:
+    - True if a mark was removed
+    """
+    if cache.get(SHIPPING_INFO_CHECK_REQUEST_KEY) is not None:
+        return False
+    return cache.delete(SHIPPING_INFO_CHECK_KEY)
+
+@log_manager.buffered()
+def check_orders_shipping_info(complete_log=True):
     """
     Method to check the shipping status of all orders not yet shipped. This method will retrieve all orders
     from the database with status "INITIATED", which are kits that are ordered but not shipped yet. It will
     request order confirmations for all these order from GBF. If shipping information is provided (ship date and tracking
     numbers), then this information will be stored in the database and send to REDCap.
+
+    Only orders whose next check is due are requested (see `get_next_poll_at`). Orders that have not shipped yet
+    are scheduled for their next check.
+
+    If `complete_log` is false, the confirmation check log is left open, so the caller can add to it.
+
+    If SHIPPING_INFO_CHECK_MODE is "pipeline", the orders are checked in micro-batches instead
+    (see `_check_shipping_info_in_micro_batches`).
     """
-    # find ids of all orders that have not been shipped yet
-    orders_initiated = Order.objects.filter(order_status=Order.INITIATED).values_list("order_number", flat=True)
-    
-    order_numbers = list(orders_initiated)
+    now = timezone.now()
+    if settings.SHIPPING_INFO_CHECK_MODE == 'pipeline':
+        _check_shipping_info_in_micro_batches(now)
+    else:
+        _check_shipping_info(now)
+    if complete_log:
+        log_manager.complete_log()
+
+def _check_shipping_info(now):
+    # find all orders that have not been shipped yet and are due to be checked
+    due_orders = list(get_orders_due_for_polling(now))
+    order_numbers = [order.order_number for order in due_orders]
+
+    message = f"{len(order_numbers)} initiated orders are due to be checked for shipping info."
+    log_manager.append_to_orders_log('info', message)
+    logger.info(message)
+    log_manager.add_progress(chunks_total=math.ceil(len(order_numbers) / settings.GBF_CONFIRMATION_CHUNK_SIZE))
+
     # get order confirmation from gbf
     tracking_info = gbf.get_order_confirmations(order_numbers)
+    # write the buffered log lines after each step, so progress can be seen in the admin
+    log_manager.flush()
     
     shipped_orders = _update_orders_with_shipping_info(tracking_info)
+    _schedule_next_polls(due_orders, shipped_orders, now)
+    log_manager.flush()
 
     #retrieve the updated order objects
     order_objects = Order.objects.filter(order_number__in=shipped_orders)
 
     redcap.set_tracking_info(order_objects)
-    log_manager.complete_log()
+
+def _check_shipping_info_in_micro_batches(now):
+    """
+    Checks the due orders in micro-batches of GBF_CONFIRMATION_CHUNK_SIZE orders. As soon as GBF has responded
+    for a batch, its orders are updated and their tracking info is sent to REDCap, while the requests for the
+    next batches are running. Due orders are read from the database as batches are sent, so only the batches
+    that are in flight are held in memory.
+
+    Raises the first REDCapError once all batches have been processed if tracking info could not be sent to REDCap.
+    """
+    chunk_size = settings.GBF_CONFIRMATION_CHUNK_SIZE
+    log_manager.add_progress(chunks_total=math.ceil(get_orders_due_for_polling(now).count() / chunk_size))
+    due_orders = get_orders_due_for_polling(now).iterator(chunk_size=chunk_size)
+    # order number -> order, for the batches that have been requested from GBF but not processed yet
+    in_flight = {}
+
+    def order_number_chunks():
+        for chunk in chunked(due_orders, chunk_size):
+            in_flight.update((order.order_number, order) for order in chunk)
+            yield [order.order_number for order in chunk]
+
+    checked_count = 0
+    shipped_count = 0
+    errors = []
+    for order_numbers, tracking_info in gbf.iter_order_confirmations(order_number_chunks()):
+        batch = [in_flight.pop(order_number) for order_number in order_numbers]
+        shipped_orders = _update_orders_with_shipping_info(tracking_info)
+        _schedule_next_polls(batch, shipped_orders, now)
+        if shipped_orders:
+            try:
+                redcap.set_tracking_info(Order.objects.filter(order_number__in=shipped_orders))
+            except REDCapError as e:
+                errors.append(e)
+        # write the buffered log lines after each batch, so progress can be seen in the admin
+        log_manager.flush()
+        checked_count += len(batch)
+        shipped_count += len(shipped_orders)
+
+    message = f"Checked {checked_count} initiated orders for shipping info, {shipped_count} have shipped."
+    log_manager.append_to_orders_log('info', message)
+    logger.info(message)
+
+    if errors:
+        raise errors[0]
+
+def _schedule_next_polls(due_orders, shipped_orders, now):
+    """
+    Counts the check for all given orders that have not shipped and sets the time of their next check.
+    """
+    shipped_orders = set(shipped_orders)
+    polled_orders = [order for order in due_orders if order.order_number not in shipped_orders]
+    for order in polled_orders:
+        order.poll_count += 1
+        order.next_poll_at = get_next_poll_at(order, now)
+
+    chunk_size = settings.ORDER_UPDATE_CHUNK_SIZE
+    for i in range(0, len(polled_orders), chunk_size):
+        with transaction.atomic():
+            Order.objects.bulk_update(polled_orders[i:i + chunk_size], ['poll_count', 'next_poll_at'])
+
+    if polled_orders:
+        message = f"Scheduled the next check for shipping info of {len(polled_orders)} orders that have not shipped yet."
+        log_manager.append_to_orders_log('info', message)
+        logger.info(message)
+
 
 def _update_orders_with_shipping_info(tracking_info):
     """
     This method takes a dictionary with order confirmation information and updates the order
-    objects in the database accordingly.
+    objects in the database accordingly. All orders are loaded with one query and only changed fields
+    are written, using one bulk update per ORDER_UPDATE_CHUNK_SIZE orders.
 
     Expected tracking info dictionary:
     {
@@ -85,46 +569,97 @@ def _update_orders_with_shipping_info(tracking_info):
         - a list of all order numbers that have shipping date and tracking information
     """
     shipped_orders = []
-    if tracking_info:
-        for order_number in tracking_info:
-            try:
-                order = Order.objects.get(order_number=order_number)
-            except Exception as e:
-                message = e
-                log_manager.append_to_orders_log('error', message)
-                logger.error(message)
+    if not tracking_info:
+        return shipped_orders
 
-                message = f"Order {order_number} not found."
+    with count_queries() as counter:
+        orders_by_number = {}
+        for order in Order.objects.filter(order_number__in=list(tracking_info)):
+            if order.order_number in orders_by_number:
+                message = f"There is more than one order with order number {order.order_number}."
                 log_manager.append_to_orders_log('error', message)
                 logger.error(message)
+                orders_by_number[order.order_number] = None
                 continue
+            orders_by_number[order.order_number] = order
+
+        missing_orders = [order_number for order_number in tracking_info if order_number not in orders_by_number]
+        if missing_orders:
+            message = f"Orders {missing_orders} not found."
+            log_manager.append_to_orders_log('error', message)
+            logger.error(message)
 
-            # if order has not shipped yet, we don't need to continue
-            if not tracking_info[order.order_number]['date_kit_shipped']:
-                logger.warning(f'Order {order.order_number} has no shipped date.') 
+        updated_orders = []
+        newly_shipped = 0
+        for order_number, order in orders_by_number.items():
+            if not order:
                 continue
+            changed_fields = _apply_shipping_info(order, tracking_info[order_number])
+            if changed_fields:
+                updated_orders.append((order, changed_fields))
+            if 'order_status' in changed_fields:
+                newly_shipped += 1
+            if order.order_status == Order.SHIPPED:
+                shipped_orders.append(order.order_number)
+
+        chunk_size = settings.ORDER_UPDATE_CHUNK_SIZE
+        for i in range(0, len(updated_orders), chunk_size):
+            chunk = updated_orders[i:i + chunk_size]
+            fields = set().union(*[changed_fields for _, changed_fields in chunk])
+            with transaction.atomic():
+                Order.objects.bulk_update([order for order, _ in chunk], sorted(fields))
+            log_manager.add_progress(orders_updated=len(chunk))
+
+            shipped = [order.order_number for order, changed_fields in chunk if 'order_status' in changed_fields]
+            if shipped:
+                message = f"Updated order status for order numbers {shipped} to Shipped."
+                log_manager.append_to_orders_log('info', message)
+                logger.info(message)
+            changed = [order.order_number for order, changed_fields in chunk if 'order_status' not in changed_fields]
+            if changed:
+                message = f"Updated shipping info of already shipped orders {changed}."
+                log_manager.append_to_orders_log('info', message)
+                logger.info(message)
+
+    metrics.inc('edrop_orders_shipped_total', newly_shipped)
+    message = f"Updated {len(updated_orders)} orders with shipping info using {counter.count} queries."
+    log_manager.append_to_orders_log('info', message)
+    logger.info(message)
 
-            order.ship_date = tracking_info[order.order_number]['date_kit_shipped']
-            order.order_status = Order.SHIPPED
-            shipped_orders.append(order.order_number)
-
-            message = f"Updated order status for order number {order.id} to Shipped."
-            log_manager.append_to_orders_log('info', message)
-            logger.info(message)
-
-            if tracking_info[order.order_number]['kit_tracking_n']:
-                order.tracking_nrs = tracking_info[order.order_number]['kit_tracking_n']
-            else:
-                logger.warning(f'Order {order.order_number} has no tracking numbers.') 
-            if tracking_info[order.order_number]['return_tracking_n']:
-                order.return_tracking_nrs = tracking_info[order.order_number]['return_tracking_n']
-            else:
-                logger.warning(f'Order {order.order_number} has no return tracking numbers.')
-            if tracking_info[order.order_number]['tube_serial_n']:
-                order.tube_serials = tracking_info[order.order_number]['tube_serial_n']
-            else:
-                logger.warning(f'Order {order.order_number} has no tube serial numbers.')
-            order.save()
-            
     return shipped_orders
-        
\ No newline at end of file
+
+def _apply_shipping_info(order, shipping_info):
+    """
+    Sets the shipping info on the order object without saving it.
+
+    Returns:
+        - a list of the fields that changed
+    """
+    # if order has not shipped yet, we don't need to continue
+    if not shipping_info['date_kit_shipped']:
+        logger.warning(f'Order {order.order_number} has no shipped date.') 
+        return []
+
+    values = {
+        'ship_date': shipping_info['date_kit_shipped'],
+        'order_status': Order.SHIPPED,
+    }
+    if shipping_info['kit_tracking_n']:
+        values['tracking_nrs'] = shipping_info['kit_tracking_n']
+    else:
+        logger.warning(f'Order {order.order_number} has no tracking numbers.') 
+    if shipping_info['return_tracking_n']:
+        values['return_tracking_nrs'] = shipping_info['return_tracking_n']
+    else:
+        logger.warning(f'Order {order.order_number} has no return tracking numbers.')
+    if shipping_info['tube_serial_n']:
+        values['tube_serials'] = shipping_info['tube_serial_n']
+    else:
+        logger.warning(f'Order {order.order_number} has no tube serial numbers.')
+
+    changed_fields = []
+    for field, value in values.items():
+        if getattr(order, field) != value:
+            setattr(order, field, value)
+            changed_fields.append(field)
+    return changed_fields
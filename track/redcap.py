@@ -1,6 +1,7 @@
-import requests
 from django.conf import settings
-import logging, inspect
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import codecs, json, logging, inspect, io, re, time
+import requests
 from http import HTTPStatus
 import xml.etree.ElementTree as ET
 from datetime import datetime
@@ -9,10 +10,15 @@ import pytz
 from track.models import *
 from track.log_manager import LogManager
 from track.exceptions import REDCapError
+from track import http_client
 
 logger = logging.getLogger(__name__)
 log_manager = LogManager()
 
+# used to parse exported records as they are received (see `iter_complete_record_ids`)
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
 
 def get_record_info(record_id):
     """
@@ -45,7 +51,203 @@ def get_record_info(record_id):
         'contact_complete': '2'
     }
     """
+    records = _export_records([record_id], _get_address_fields())
+    # Since we are requested only one record, REDCap will return a list of dictionaries,
+    # with only one dictionary.
+    if records:
+        return records[0]
+    
+    return None
+
+async def async_get_record_info(record_id):
+    """
+    Same as `get_record_info`, but waits for REDCap without blocking the thread. At most
+    REDCAP_MAX_CONCURRENT_REQUESTS requests are sent to REDCap at the same time.
+    """
+    records = await _async_export_records([record_id], _get_address_fields())
+    if records:
+        return records[0]
+    
+    return None
+
+def get_records_info(record_ids, chunk_size=None, max_workers=None):
+    """
+    Gets the same information as `get_record_info` for many records. The record ids are
+    split into chunks of `chunk_size` (default REDCAP_EXPORT_CHUNK_SIZE) records, which are
+    exported with up to `max_workers` (default REDCAP_EXPORT_MAX_WORKERS) requests at a time.
+
+    Raises a REDCapError if any of the chunks cannot be exported.
+
+    Returns a dictionary with the record id as key and the record information as value, e.g.:
+    {
+        '1': {
+            'record_id': '1', 
+            'first_name': 'Scissors', 
+            ...
+            'contact_complete': '2'
+        }
+    }
+    Records that do not exist in REDCap are not included.
+    """
+    chunk_size = chunk_size or settings.REDCAP_EXPORT_CHUNK_SIZE
+    max_workers = max_workers or settings.REDCAP_EXPORT_MAX_WORKERS
+
+    record_ids = list(dict.fromkeys(record_ids))
+    chunks = [record_ids[i:i + chunk_size] for i in range(0, len(record_ids), chunk_size)]
+    fields = _get_address_fields()
+
+    records_info = {}
+    if not chunks:
+        return records_info
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        for records in executor.map(lambda chunk: _export_records(chunk, fields), chunks):
+            for record in records:
+                # for repeating instruments REDCap returns several rows per record,
+                # the first one contains the fields we need
+                records_info.setdefault(record[settings.REDCAP_RECORD_ID], record)
+
+    logger.debug(f"Exported {len(records_info)} of {len(record_ids)} records from REDCap in {len(chunks)} requests.")
+    return records_info
+
+def get_order_numbers(record_ids):
+    """
+    Gets the order numbers stored in REDCap for the given records with one request.
+
+    Returns a dictionary with the record id as key and the order number as value (an empty
+    string if no order number has been stored for the record). Records that do not exist
+    in REDCap are not included.
+    """
+    records = _export_records(list(dict.fromkeys(record_ids)), [settings.REDCAP_RECORD_ID, settings.REDCAP_KIT_ORDER_N])
+    order_numbers = {}
+    for record in records:
+        order_numbers.setdefault(record[settings.REDCAP_RECORD_ID], record.get(settings.REDCAP_KIT_ORDER_N, ''))
+    return order_numbers
+
+def get_project_id():
+    """
+    Returns:
+    - the id of the REDCap project that REDCAP_TOKEN belongs to
+    """
+    data = {
+        'token': settings.REDCAP_TOKEN,
+        'content': 'project',
+        'format': 'json',
+        'returnFormat': 'json'
+    }
+    r = http_client.post(settings.REDCAP_URL, endpoint="redcap:project:export", data=data)
+    return str(_get_exported_records(r)['project_id'])
+
+def iter_complete_record_ids():
+    """
+    Exports the ids of all records whose REDCAP_FIELD_TO_BE_COMPLETE is 2. Only the record id is exported,
+    and the response is parsed while it is being received, so the ids of large projects are never held
+    in memory all at once.
+
+    Raises a REDCapError if the records cannot be exported.
+
+    Yields:
+    - record ids, records with repeating instruments can be yielded more than once
+    """
+    data = _get_export_data([], [settings.REDCAP_RECORD_ID])
+    data['filterLogic'] = f'[{settings.REDCAP_FIELD_TO_BE_COMPLETE}] = "2"'
+    try:
+        r = http_client.post(settings.REDCAP_URL, endpoint="redcap:record:export", data=data, stream=True)
+    except requests.exceptions.RequestException as e:
+        raise REDCapError(f"Could not export records from REDCap: {e}")
+
+    with r:
+        if r.status_code != HTTPStatus.OK:
+            logger.error("Could not export complete records from REDCap.")
+            logger.error(f'REDCap HTTP Status: {str(r.status_code)}')
+            raise REDCapError(f"REDCap returned {r.status_code}.")
+
+        try:
+            for record in _iter_streamed_records(r):
+                yield record[settings.REDCAP_RECORD_ID]
+        except requests.exceptions.RequestException as e:
+            raise REDCapError(f"Could not export records from REDCap: {e}")
+
+def _iter_streamed_records(r):
+    """
+    Parses the json array of records in the body of a streamed response one record at a time, as the
+    body is received.
+
+    Raises a REDCapError if the body is not a json array of objects.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    # index of the next character to parse, None until the opening bracket has been received
+    index = None
+    expect_separator = False
+    for chunk in r.iter_content(chunk_size=settings.REDCAP_EXPORT_STREAM_CHUNK_SIZE):
+        buffer += decoder.decode(chunk)
+        if index is None:
+            index = _skip_whitespace(buffer, 0)
+            if index == len(buffer):
+                index = None
+                continue
+            if buffer[index] != '[':
+                raise REDCapError("REDCap did not return a list of records.")
+            index += 1
+
+        while True:
+            index = _skip_whitespace(buffer, index)
+            if buffer.startswith(']', index):
+                return
+            if expect_separator:
+                if index == len(buffer):
+                    break
+                if buffer[index] != ',':
+                    raise REDCapError(f"Could not parse the records exported from REDCap at '{buffer[index:index + 20]}'.")
+                index = _skip_whitespace(buffer, index + 1)
+                expect_separator = False
+            try:
+                record, index = _decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                # the record has not been received completely yet
+                break
+            yield record
+            expect_separator = True
+
+        buffer = buffer[index:]
+        index = 0
+
+    raise REDCapError("The records exported from REDCap are incomplete.")
+
+def _skip_whitespace(buffer, index):
+    return _whitespace.match(buffer, index).end()
+
+def _get_address_fields():
     # TODO: put field names in settings
+    return [
+        settings.REDCAP_RECORD_ID,
+        settings.REDCAP_FIRST_NAME,
+        settings.REDCAP_LAST_NAME,
+        settings.REDCAP_CITY,
+        settings.REDCAP_STATE,
+        settings.REDCAP_ZIP,
+        settings.REDCAP_STREET_1,
+        settings.REDCAP_STREET_2,
+        settings.REDCAP_CONSENT_COMPLETE,
+        settings.REDCAP_CONTACT_COMPLETE,
+    ]
+
+def _export_records(record_ids, fields):
+    """
+    Exports the given fields of the given records from REDCap.
+
+    Returns a list of dictionaries, one per record.
+    """
+    r = http_client.post(settings.REDCAP_URL, endpoint="redcap:record:export", data=_get_export_data(record_ids, fields))
+    return _get_exported_records(r)
+
+async def _async_export_records(record_ids, fields):
+    r = await http_client.async_post(settings.REDCAP_URL, endpoint="redcap:record:export", max_concurrency=settings.REDCAP_MAX_CONCURRENT_REQUESTS,
+                                     data=_get_export_data(record_ids, fields))
+    return _get_exported_records(r)
+
+def _get_export_data(record_ids, fields):
     data = {
         'token': settings.REDCAP_TOKEN,
         'content': 'record',
@@ -53,17 +255,6 @@ def get_record_info(record_id):
         'format': 'json',
         'type': 'flat',
         'csvDelimiter': '',
-        'records[0]': record_id,
-        'fields[0]': settings.REDCAP_RECORD_ID,
-        'fields[1]': settings.REDCAP_FIRST_NAME,
-        'fields[2]': settings.REDCAP_LAST_NAME,
-        'fields[3]': settings.REDCAP_CITY,
-        'fields[4]': settings.REDCAP_STATE,
-        'fields[5]': settings.REDCAP_ZIP,
-        'fields[6]': settings.REDCAP_STREET_1,
-        'fields[7]': settings.REDCAP_STREET_2,
-        'fields[8]': settings.REDCAP_CONSENT_COMPLETE,
-        'fields[9]': settings.REDCAP_CONTACT_COMPLETE,
         'rawOrLabel': 'raw',
         'rawOrLabelHeaders': 'raw',
         'exportCheckboxLabel': 'false',
@@ -71,21 +262,21 @@ def get_record_info(record_id):
         'exportDataAccessGroups': 'false',
         'returnFormat': 'json'
     }
-    r = requests.post(settings.REDCAP_URL,data=data)
+    for i, record_id in enumerate(record_ids):
+        data[f'records[{i}]'] = record_id
+    for i, field in enumerate(fields):
+        data[f'fields[{i}]'] = field
+    return data
+
+def _get_exported_records(r):
     logger.debug(f'REDCap HTTP Status: {str(r.status_code)}')
 
-    if r.status_code == HTTPStatus.OK:
-        records = r.json()
-        # Since we are requested only one record, REDCap will return a list of dictionaries,
-        # with only one dictionary.
-        if records:
-            return records[0]
-    else:
+    if r.status_code != HTTPStatus.OK:
         logger.error("Could not get record data from REDCap.")
         logger.error(f'REDCap HTTP Status: {str(r.status_code)}')
         raise REDCapError(f"REDCap returned {r.status_code}.")
-    
-    return None
+
+    return r.json()
 
 def set_order_number(record_id, order_number):
     """ 
@@ -93,7 +284,18 @@ def set_order_number(record_id, order_number):
     the provided record id. It also sets the kit_tracking_complete to one to indicate
     that the order is in progress.
     """
+    r = http_client.post(settings.REDCAP_URL, endpoint="redcap:record:import", data=_get_order_number_data(record_id, order_number))
+    _check_order_number_response(r)
 
+async def async_set_order_number(record_id, order_number):
+    """
+    Same as `set_order_number`, but waits for REDCap without blocking the thread.
+    """
+    r = await http_client.async_post(settings.REDCAP_URL, endpoint="redcap:record:import", max_concurrency=settings.REDCAP_MAX_CONCURRENT_REQUESTS,
+                                     data=_get_order_number_data(record_id, order_number))
+    _check_order_number_response(r)
+
+def _get_order_number_data(record_id, order_number):
     xml = f"""
     <?xml version="1.0" encoding="UTF-8" ?>
     <records>
@@ -119,8 +321,9 @@ def set_order_number(record_id, order_number):
         'returnContent': 'count',
         'returnFormat': 'json'
     }
-    r = requests.post(settings.REDCAP_URL, data=data)
-    
+    return data
+
+def _check_order_number_response(r):
     if r.status_code != HTTPStatus.OK:
         logger.error(f'HTTP Status: {r.status_code}')
         logger.error(r.json())
@@ -144,36 +347,87 @@ def set_tracking_info(order_objects):
             <tubeserial>tube serial1</tubeserial>
         </item>
     </records>
-    """
-    root = ET.Element("records")
 
+    Orders are sent in batches of REDCAP_IMPORT_CHUNK_SIZE records, with up to REDCAP_IMPORT_MAX_WORKERS
+    batches being sent at the same time. Batches that fail because of a connection problem or a server
+    error are retried up to REDCAP_IMPORT_MAX_ATTEMPTS times. The outcome of each batch is logged.
+
+    Raises a REDCapError once all batches have been sent if any of the batches could not be imported.
+    """
     # we only care about the orders that have a ship date
-    order_objects = list(filter(lambda order: order.ship_date, order_objects))
+    if hasattr(order_objects, 'iterator'):
+        order_objects = order_objects.iterator(chunk_size=settings.REDCAP_IMPORT_CHUNK_SIZE)
+    order_objects = (order for order in order_objects if order.ship_date)
+
+    errors = []
+    sent_batches = 0
+    with ThreadPoolExecutor(max_workers=settings.REDCAP_IMPORT_MAX_WORKERS) as executor:
+        futures = {}
+        for record_ids, xml in _generate_tracking_info_batches(order_objects, settings.REDCAP_IMPORT_CHUNK_SIZE):
+            futures[executor.submit(_import_records, xml)] = record_ids
+            # don't read more orders than can be sent
+            if len(futures) >= settings.REDCAP_IMPORT_MAX_WORKERS:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _log_tracking_info_batch(future, futures.pop(future), errors)
+            sent_batches += 1
+
+        for future in as_completed(futures):
+            _log_tracking_info_batch(future, futures[future], errors)
 
-    if not order_objects:
+    if not sent_batches:
         message = "No confirmations received. Nothing to send to REDCap."
         log_manager.append_to_redcap_log(LogManager.LEVEL_INFO, message)
         logger.info(message)
         return
 
+    if errors:
+        raise errors[0]
+
+def _generate_tracking_info_batches(order_objects, chunk_size):
+    """
+    Serializes the tracking info of the given orders one order at a time and yields a tuple
+    of the record ids and the XML string for every `chunk_size` orders.
+    """
+    record_ids = []
+    xml = io.StringIO()
     for order in order_objects:
-        # in case an order has not been shipped yet, we don't update REDcap
-        if not order.ship_date:
-            continue
-              
-        item = ET.SubElement(root, "item")
-        ET.SubElement(item, settings.REDCAP_RECORD_ID).text = order.record_id
-        ET.SubElement(item, settings.REDCAP_DATE_KIT_SHIPPED).text = order.ship_date
-        ET.SubElement(item, settings.REDCAP_KIT_TRACKING_N).text = ", ".join(order.tracking_nrs)
-        # we make sure that the tracking complete field is set to 1 (Unverified)
-        ET.SubElement(item, settings.REDCAP_KIT_TRACKING_COMPLETE).text = settings.REDCAP_KIT_TRACKING_COMPLETE_VAL
-        # we set the kitstatus to "In Transit"
-        ET.SubElement(item, settings.REDCAP_KIT_STATUS).text = settings.REDCAP_KIT_STATUS_TRACK_VAL
-        ET.SubElement(item, settings.REDCAP_KIT_TRACKING_RETURN_N).text = ", ".join(order.return_tracking_nrs)
-        ET.SubElement(item, settings.REDCAP_TUBESERIAL).text = ", ".join(order.tube_serials)
-
-    xml = ET.tostring(root, encoding="unicode")
+        if not record_ids:
+            xml.write("<records>")
+        xml.write(_generate_tracking_info_item(order))
+        record_ids.append(order.record_id)
+
+        if len(record_ids) >= chunk_size:
+            xml.write("</records>")
+            yield record_ids, xml.getvalue()
+            record_ids = []
+            xml = io.StringIO()
+
+    if record_ids:
+        xml.write("</records>")
+        yield record_ids, xml.getvalue()
 
+def _generate_tracking_info_item(order):
+    item = ET.Element("item")
+    ET.SubElement(item, settings.REDCAP_RECORD_ID).text = order.record_id
+    ET.SubElement(item, settings.REDCAP_DATE_KIT_SHIPPED).text = order.ship_date
+    ET.SubElement(item, settings.REDCAP_KIT_TRACKING_N).text = ", ".join(order.tracking_nrs or [])
+    # we make sure that the tracking complete field is set to 1 (Unverified)
+    ET.SubElement(item, settings.REDCAP_KIT_TRACKING_COMPLETE).text = settings.REDCAP_KIT_TRACKING_COMPLETE_VAL
+    # we set the kitstatus to "In Transit"
+    ET.SubElement(item, settings.REDCAP_KIT_STATUS).text = settings.REDCAP_KIT_STATUS_TRACK_VAL
+    ET.SubElement(item, settings.REDCAP_KIT_TRACKING_RETURN_N).text = ", ".join(order.return_tracking_nrs or [])
+    ET.SubElement(item, settings.REDCAP_TUBESERIAL).text = ", ".join(order.tube_serials or [])
+    return ET.tostring(item, encoding="unicode")
+
+def _import_records(xml):
+    """
+    Imports the given XML into REDCap. Connection errors and server errors are retried
+    up to REDCAP_IMPORT_MAX_ATTEMPTS times, other errors are not.
+
+    Returns:
+    - a tuple of the last response (None if REDCap could not be reached) and the number of attempts
+    """
     data = {
         'token': settings.REDCAP_TOKEN,
         'content': 'record',
@@ -186,19 +440,46 @@ def set_tracking_info(order_objects):
         'returnContent': 'count',
         'returnFormat': 'json'
     }
-    r = requests.post(settings.REDCAP_URL, data=data)
+    response = None
+    for attempt in range(1, settings.REDCAP_IMPORT_MAX_ATTEMPTS + 1):
+        try:
+            response = http_client.post(settings.REDCAP_URL, endpoint="redcap:record:import", data=data)
+            if response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR:
+                return response, attempt
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not connect to REDCap: {e}")
+            response = None
+        if attempt < settings.REDCAP_IMPORT_MAX_ATTEMPTS:
+            time.sleep(settings.REDCAP_IMPORT_RETRY_DELAY * attempt)
+    return response, settings.REDCAP_IMPORT_MAX_ATTEMPTS
 
-    if r.status_code != HTTPStatus.OK:
-        message = f'HTTP Status: {str(r.status_code)}'
+def _log_tracking_info_batch(future, record_ids, errors):
+    """
+    Writes the outcome of importing a batch of tracking info to the log. If the batch
+    failed, a REDCapError is added to `errors`.
+    """
+    r, attempts = future.result()
+
+    if r is None or r.status_code != HTTPStatus.OK:
+        status = r.status_code if r is not None else "no response"
+        message = f'HTTP Status: {str(status)}'
         log_manager.append_to_redcap_log(LogManager.LEVEL_ERROR, message)
         logger.error(message)
 
-        message = r.json()
+        message = f"Could not send tracking information to REDCap after {attempts} attempt(s) for the following records: {record_ids}."
+        if r is not None:
+            message += f" {_get_error_body(r)}"
         log_manager.append_to_redcap_log(LogManager.LEVEL_ERROR, message)
         logger.error(message)
-        raise REDCapError(f"REDCap returned {r.status_code}.")
+        errors.append(REDCapError(f"REDCap returned {status}."))
     else:
-        message = f"Succesfully sent tracking information to REDCap for the following records: {[order.record_id for order in order_objects]}."
+        message = f"Succesfully sent tracking information to REDCap for the following records: {record_ids}."
         log_manager.append_to_redcap_log(LogManager.LEVEL_INFO, message)
         logger.info(message)
-        
\ No newline at end of file
+        log_manager.add_progress(redcap_batches=1)
+
+def _get_error_body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
@@ -0,0 +1,99 @@
+"""
+Timing spans for the stages of placing an order. A trace is started with `trace` around the whole
+order placement. Inside of it, every block wrapped in `span` (which can also be used as a decorator)
+is timed. Spans can be nested. Outside of a trace, `span` does nothing, so functions that are also
+used in other places (e.g. when placing orders in batches) can be instrumented as well. The current
+trace is a context variable, so each thread and each asyncio task has its own.
+
+Spans are kept in memory until the trace is saved with the OrderLog of the order (see `Trace.save`).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging, time
+
+from django.db import DatabaseError
+
+from track.models import *
+
+logger = logging.getLogger(__name__)
+
+# the trace of the current thread or task
+_current_trace = ContextVar('trace', default=None)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.depth = 0
+        # list of name, depth, start offset, and duration, in the order the spans were started
+        self.spans = []
+
+    def save(self, order_number):
+        """
+        Stores the spans with the most recent OrderLog of the given order with one INSERT.
+
+        Returns:
+        - the number of spans that were stored
+        """
+        log_id = OrderLog.objects.filter(order_number=order_number).order_by('-pk').values_list('pk', flat=True).first()
+        if not log_id:
+            logger.error(f"OrderLog for order {order_number} not found. Timing spans are not saved.")
+            return 0
+        try:
+            TimingSpan.objects.bulk_create([
+                TimingSpan(order_log_id=log_id, name=name, depth=depth, start_offset=start_offset, duration=duration)
+                for name, depth, start_offset, duration in self.spans
+            ])
+        except DatabaseError as e:
+            logger.error(f"Could not save timing spans of order {order_number}: {e}")
+            return 0
+        return len(self.spans)
+
+
+@contextmanager
+def span(name):
+    """
+    Times the block as a span with the given name in the current trace.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    index = len(trace.spans)
+    depth = trace.depth
+    trace.spans.append(None)
+    trace.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        trace.depth -= 1
+        trace.spans[index] = (name, depth, start - trace.start, end - start)
+        logger.debug(f"Span {name} took {end - start:.3f}s.")
+
+
+@contextmanager
+def trace(name):
+    """
+    Starts a trace in the current thread or task with a span with the given name around the block. If a trace
+    is already running, the block is added to it as a span instead.
+
+    Yields:
+    - the trace, which can be saved once the block has finished
+    """
+    current = _current_trace.get()
+    if current is not None:
+        with span(name):
+            yield current
+        return
+
+    new_trace = Trace(name)
+    token = _current_trace.set(new_trace)
+    try:
+        with span(name):
+            yield new_trace
+    finally:
+        _current_trace.reset(token)
@@ -0,0 +1,272 @@
+"""
+Stand-in implementations of the GBF and REDCap APIs used by the connector, so that the whole
+pipeline can be run, load-tested, and benchmarked without access to the real services.
+
+GBF is served under `/gbf/` (set GBF_URL to `http://<host>:<port>/gbf/`) and REDCap under
+`/redcap/api/` (set REDCAP_URL to `http://<host>:<port>/redcap/api/`). Only the parts of the
+APIs that `track.gbf` and `track.redcap` use are implemented:
+- GBF `oap/api/order` and `oap/api/confirm2`
+- REDCap record export (json, optionally filtered), record import (xml), and project export
+
+Latency and error rates can be set per service. See `track/management/commands/runstandinservers.py`.
+"""
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json, logging, math, random, re, threading, time, zlib
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+GBF_PREFIX = "/gbf/"
+REDCAP_PREFIX = "/redcap/api/"
+# the project id the stand-in REDCap reports for its project
+PROJECT_ID = "1"
+
+FIXED = 'fixed'
+UNIFORM = 'uniform'
+EXPONENTIAL = 'exponential'
+LOGNORMAL = 'lognormal'
+LATENCY_DISTRIBUTIONS = [FIXED, UNIFORM, EXPONENTIAL, LOGNORMAL]
+
+
+class ServiceConfig:
+    """
+    How one of the stand-in services behaves.
+
+    - `latency`: mean time in seconds a request takes
+    - `distribution`: how the latency of a request is drawn (see LATENCY_DISTRIBUTIONS), uniform draws
+      between 0 and twice the mean, lognormal uses a sigma of 0.5 and has the given mean
+    - `error_rate`: fraction of requests that fail with `error_status`
+    """
+    def __init__(self, latency=0.0, distribution=FIXED, error_rate=0.0, error_status=HTTPStatus.SERVICE_UNAVAILABLE):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {distribution}.")
+        self.latency = latency
+        self.distribution = distribution
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def draw_latency(self, rng):
+        if self.latency <= 0:
+            return 0.0
+        if self.distribution == UNIFORM:
+            return rng.uniform(0, 2 * self.latency)
+        if self.distribution == EXPONENTIAL:
+            return rng.expovariate(1 / self.latency)
+        if self.distribution == LOGNORMAL:
+            sigma = 0.5
+            mu = math.log(self.latency) - sigma ** 2 / 2
+            return rng.lognormvariate(mu, sigma)
+        return self.latency
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    HTTP server that serves the stand-in GBF and REDCap APIs. Records are created for the record ids
+    "1" to `records`, all of them with a completed contact form. Orders placed through the stand-in GBF
+    ship `ship_delay` seconds after they have been placed. Order numbers that GBF does not know (e.g.
+    orders seeded directly into the database) are treated as placed when the server started.
+    `shipped_ratio` is the fraction of orders that ship at all.
+    """
+    daemon_threads = True
+    # load tests open many connections at once, the default backlog of 5 would reset some of them
+    request_queue_size = 128
+
+    def __init__(self, address, records=1000, gbf=None, redcap=None, ship_delay=0.0, shipped_ratio=1.0, seed=None):
+        super().__init__(address, StandInRequestHandler)
+        self.gbf = gbf or ServiceConfig()
+        self.redcap = redcap or ServiceConfig()
+        self.ship_delay = ship_delay
+        self.shipped_ratio = shipped_ratio
+        self.started_at = time.time()
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.records = {str(i): _generate_record(i) for i in range(1, records + 1)}
+        # order number -> time the order was placed
+        self.orders = {}
+        self.request_counts = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def gbf_url(self):
+        return f"{self.url}{GBF_PREFIX}"
+
+    @property
+    def redcap_url(self):
+        return f"{self.url}{REDCAP_PREFIX}"
+
+    def count_request(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def draw(self, config):
+        """
+        Returns a tuple of the latency of a request and whether the request should fail.
+        """
+        with self.lock:
+            return config.draw_latency(self.rng), self.rng.random() < config.error_rate
+
+    def is_shipped(self, order_number, now):
+        # the same order number always gives the same answer
+        if zlib.crc32(order_number.encode()) % 10_000 >= self.shipped_ratio * 10_000:
+            return False
+        with self.lock:
+            placed_at = self.orders.get(order_number, self.started_at)
+        return now - placed_at >= self.ship_delay
+
+
+def _generate_record(i):
+    return {
+        'record_id': str(i),
+        'redcap_repeat_instrument': '',
+        'redcap_repeat_instance': '',
+        'first_name': f'First{i}',
+        'last_name': f'Last{i}',
+        'street_1': f'{i} Main St',
+        'street_2': '',
+        'city': 'Tempe',
+        'state': 'AZ',
+        'zip': f'{85000 + i % 1000}',
+        'consent_complete': '2',
+        'contact_complete': '2',
+    }
+
+
+def _generate_confirmation(order_number, now):
+    serial = zlib.crc32(order_number.encode())
+    return {
+        "OrderNumber": order_number,
+        "Shipper": "",
+        "ShipVia": "FedEx Ground",
+        "ShipDate": time.strftime("%Y-%m-%d", time.gmtime(now)),
+        "ClientID": "",
+        "Tracking": [f"27{serial:010d}"],
+        "Items": [
+            {
+                "ItemNumber": "K-BAN-001",
+                "SerialNumber": f"EV-{serial % 1_000_000:06d}",
+                "ShippedQty": 1,
+                "ReturnTracking": [f"39{serial:010d}"],
+                "TubeSerial": [f"SIH{serial:09d}"]
+            }
+        ]
+    }
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without this every response on a kept alive
+    # connection waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if path == f"{GBF_PREFIX}oap/api/order":
+            self._handle(self.server.gbf, "gbf:order", self._place_orders, body)
+        elif path == f"{GBF_PREFIX}oap/api/confirm2":
+            self._handle(self.server.gbf, "gbf:confirm2", self._get_confirmations, body)
+        elif path == REDCAP_PREFIX:
+            self._handle(self.server.redcap, "redcap", self._handle_redcap, body)
+        else:
+            self._respond(HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint {path}."})
+
+    def _handle(self, config, endpoint, handler, body):
+        self.server.count_request(endpoint)
+        latency, fail = self.server.draw(config)
+        if latency:
+            time.sleep(latency)
+        if fail:
+            self._respond(config.error_status, {"success": False, "error": "Injected error."})
+            return
+        try:
+            status, content = handler(body)
+        except (ValueError, KeyError, ET.ParseError) as e:
+            status, content = HTTPStatus.BAD_REQUEST, {"success": False, "error": str(e)}
+        self._respond(status, content)
+
+    def _place_orders(self, body):
+        orders = json.loads(body)["orders"]
+        now = time.time()
+        with self.server.lock:
+            for order in orders:
+                self.server.orders[order["orderNumber"]] = now
+        return HTTPStatus.OK, {"success": True, "message": f"EDROP_{len(orders)}_{int(now)}.xml"}
+
+    def _get_confirmations(self, body):
+        form = parse_qs(body.decode())
+        now = time.time()
+        confirmations = [_generate_confirmation(number, now) for number in form.get('orderNumbers', [])
+                         if self.server.is_shipped(number, now)]
+        if not confirmations:
+            return HTTPStatus.OK, {"success": True, "dataArray": []}
+        data = json.dumps({"ShippingConfirmations": confirmations})
+        return HTTPStatus.OK, {"success": True, "dataArray": [{"format": "json", "data": data}]}
+
+    def _handle_redcap(self, body):
+        form = parse_qs(body.decode(), keep_blank_values=True)
+        content = form.get('content', [''])[0]
+        action = form.get('action', [''])[0]
+        if content == 'project':
+            return HTTPStatus.OK, {"project_id": PROJECT_ID, "project_title": "Stand-in project"}
+        if content != 'record':
+            return HTTPStatus.BAD_REQUEST, {"error": f"Content {content} is not supported."}
+        if action == 'export':
+            return HTTPStatus.OK, self._export_records(form)
+        if action == 'import':
+            return HTTPStatus.OK, self._import_records(form['data'][0])
+        return HTTPStatus.BAD_REQUEST, {"error": f"Action {action} is not supported."}
+
+    def _export_records(self, form):
+        record_ids = [values[0] for key, values in form.items() if key.startswith('records[')]
+        fields = [values[0] for key, values in form.items() if key.startswith('fields[')]
+        # only filters of the form [field] = "value" are supported
+        filter_logic = re.fullmatch(r'\s*\[(\w+)\]\s*=\s*["\']?([^"\']*)["\']?\s*', form.get('filterLogic', [''])[0])
+        with self.server.lock:
+            records = [self.server.records[record_id] for record_id in record_ids if record_id in self.server.records] \
+                if record_ids else list(self.server.records.values())
+            if filter_logic:
+                field, value = filter_logic.groups()
+                records = [record for record in records if record.get(field, '') == value]
+            return [{field: record.get(field, '') for field in fields} if fields else dict(record) for record in records]
+
+    def _import_records(self, xml):
+        items = ET.fromstring(xml.strip()).findall('item')
+        with self.server.lock:
+            for item in items:
+                values = {child.tag: child.text or '' for child in item}
+                record = self.server.records.setdefault(values['record_id'], {})
+                record.update(values)
+        return {"count": len(items)}
+
+    def _respond(self, status, content):
+        payload = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def start_server(host="127.0.0.1", port=0, **kwargs):
+    """
+    Starts a stand-in server in a background thread. If `port` is 0, a free port is picked. Takes
+    the same keyword arguments as `StandInServer`.
+
+    Returns:
+    - the running server, stop it with `server.shutdown()` and `server.server_close()`
+    """
+    server = StandInServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, name="standin-server", daemon=True)
+    thread.start()
+    logger.info(f"Stand-in GBF and REDCap servers listening on {server.url}.")
+    return server
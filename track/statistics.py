@@ -0,0 +1,98 @@
+"""
+Order statistics for the dashboard in the admin. Counting orders per status and day and calculating
+percentiles reads the whole order table, so it is done by the scheduler (see `refresh`), which stores
+the results in the OrderStatistic table. The dashboard only reads those rows, so it takes the same time
+no matter how many orders there are.
+"""
+from datetime import timedelta
+import logging
+import pytz
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from track.models import *
+
+logger = logging.getLogger(__name__)
+
+STATUS = 'status'
+INITIATED_PER_DAY = 'initiated_per_day'
+SHIPPED_PER_DAY = 'shipped_per_day'
+DAYS_TO_SHIP = 'days_to_ship'
+
+# percentiles of the number of days between an order being placed and the kit being shipped
+DAYS_TO_SHIP_PERCENTILES = [0.5, 0.9, 0.95]
+
+
+def refresh():
+    """
+    Replaces all order statistics with one DELETE and one INSERT ... SELECT in a transaction, so the
+    dashboard never sees a partial refresh. Orders per day are counted for the last ORDER_STATISTICS_DAYS days.
+
+    Returns:
+    - the number of statistics that were stored
+    """
+    now = timezone.now()
+    since = (now - timedelta(days=settings.ORDER_STATISTICS_DAYS)).astimezone(pytz.timezone(settings.REQUEST_TIMEZONE)).date()
+    table = OrderStatistic._meta.db_table
+    orders_table = Order._meta.db_table
+    percentiles = ", ".join(str(percentile) for percentile in DAYS_TO_SHIP_PERCENTILES)
+    # ship dates are strings sent by GBF, only the ones that are dates are used
+    shipped = f"order_status IN (%s, %s) AND ship_date ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}$'"
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f"""
+            INSERT INTO {table} (name, key, value, refreshed_at)
+            SELECT name, key, value, %s FROM (
+                SELECT %s AS name, order_status AS key, count(*)::float AS value
+                FROM {orders_table} WHERE order_status IS NOT NULL GROUP BY order_status
+                UNION ALL
+                SELECT %s, to_char(initiated_at AT TIME ZONE %s, 'YYYY-MM-DD') AS day, count(*)
+                FROM {orders_table} WHERE initiated_at >= %s GROUP BY day
+                UNION ALL
+                SELECT %s, ship_date, count(*)
+                FROM {orders_table} WHERE {shipped} AND ship_date >= %s GROUP BY ship_date
+                UNION ALL
+                SELECT %s, 'p' || (percentile * 100)::int, days
+                FROM (
+                    SELECT unnest(ARRAY[{percentiles}]) AS percentile,
+                           unnest(percentile_cont(ARRAY[{percentiles}]) WITHIN GROUP (
+                               ORDER BY ship_date::date - (initiated_at AT TIME ZONE %s)::date)) AS days
+                    FROM {orders_table} WHERE {shipped} AND initiated_at IS NOT NULL
+                ) days_to_ship WHERE days IS NOT NULL
+            ) statistics
+        """, [now,
+              STATUS,
+              INITIATED_PER_DAY, settings.REQUEST_TIMEZONE, since,
+              SHIPPED_PER_DAY, Order.SHIPPED, Order.DONE, since.isoformat(),
+              DAYS_TO_SHIP, settings.REQUEST_TIMEZONE, Order.SHIPPED, Order.DONE])
+        count = cursor.rowcount
+
+    logger.info(f"Refreshed {count} order statistics.")
+    return count
+
+
+def get_dashboard():
+    """
+    Returns:
+    - a dictionary with the stored statistics: the number of orders per status, a list of days
+      (newest first) with the number of orders placed and shipped, the days to ship per percentile,
+      and when the statistics were last refreshed (None if they never were)
+    """
+    statistics = {}
+    refreshed_at = None
+    for name, key, value, row_refreshed_at in OrderStatistic.objects.values_list('name', 'key', 'value', 'refreshed_at'):
+        statistics.setdefault(name, {})[key] = value
+        refreshed_at = row_refreshed_at
+
+    status_counts = statistics.get(STATUS, {})
+    initiated = statistics.get(INITIATED_PER_DAY, {})
+    shipped = statistics.get(SHIPPED_PER_DAY, {})
+    return {
+        'status_counts': [(label, int(status_counts.get(status, 0))) for status, label in Order.CHOICES.items()],
+        'days': [(day, int(initiated.get(day, 0)), int(shipped.get(day, 0))) for day in sorted(set(initiated) | set(shipped), reverse=True)],
+        'days_to_ship': sorted(statistics.get(DAYS_TO_SHIP, {}).items(), key=lambda item: int(item[0][1:])),
+        'refreshed_at': refreshed_at,
+    }
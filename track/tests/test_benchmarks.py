@@ -0,0 +1,38 @@
+import logging
+from django.test import TestCase
+
+from track import benchmarks
+from track.models import *
+
+logger = logging.getLogger(__name__)
+
+
+class TestBenchmarks(TestCase):
+    def test_run_benchmark(self):
+        """
+        Test that a benchmark reports all metrics and does not leave seeded data behind.
+        """
+        result = benchmarks.run_benchmark("redcap.set_tracking_info", 10)
+
+        self.assertEqual(result["path"], "redcap.set_tracking_info")
+        self.assertEqual(result["requests"], 1)
+        self.assertGreater(result["queries"], 0)
+        self.assertGreater(result["peak_memory"], 0)
+        self.assertGreater(result["wall_time"], 0)
+        self.assertFalse(Order.objects.exists())
+
+    def test_compare(self):
+        baseline = {"results": [{"path": "a", "size": 10, "wall_time": 1.0, "queries": 0, "peak_memory": 100, "requests": 2}]}
+        results = {"results": [
+            {"path": "a", "size": 10, "wall_time": 2.0, "queries": 0, "peak_memory": 50, "requests": 2},
+            {"path": "a", "size": 1000, "wall_time": 2.0, "queries": 0, "peak_memory": 50, "requests": 2},
+        ]}
+
+        comparison = benchmarks.compare(results, baseline)
+
+        self.assertEqual(comparison, [
+            ("a", 10, "wall_time", 1.0, 2.0, 2.0),
+            ("a", 10, "queries", 0, 0, 1.0),
+            ("a", 10, "peak_memory", 100, 50, 0.5),
+            ("a", 10, "requests", 2, 2, 1.0),
+        ])
@@ -2,6 +2,7 @@ import logging
 from unittest.mock import patch, MagicMock
 from django.test import TestCase, override_settings
 import json
+import requests
 
 import track.gbf as gbf
 from track.models import *
@@ -81,7 +82,7 @@ class TestGBF(TestCase):
         self.mock_order_number = "EDROP-00014"
         self.mock_order_json = order_json
         self.mock_order_response = OrderResponse(200, {'success': True, 'message': 'EXM-0000XX_RDQYD_20250115_154237.xml'})
-        self.order_object = Order.objects.create(pk=14, project_id=1, order_number=None)
+        self.order_object = Order.objects.create(pk=14, record_id="14", project_id=1, order_number=None)
         self.address_data = address_data
         self.order_response_json = {'success': True, 'message': 'EXM-0000XX_RDQYD_20250115_154237.xml'}
         self.order_numbers =  ["EDROP-00014", "EDROP-00015"]
@@ -90,20 +91,17 @@ class TestGBF(TestCase):
 
     @patch("track.gbf._place_order_with_GBF")
     @patch("track.gbf._generate_order_json")
-    @patch("track.gbf._generate_order_number")
-    def test_create_order(self, mock_generate_order_number, mock_generate_order_json, mock_place_order_with_GBF):
-        mock_generate_order_number.return_value = self.mock_order_number
+    def test_create_order(self, mock_generate_order_json, mock_place_order_with_GBF):
+        self.order_object.order_number = self.mock_order_number
         mock_generate_order_json.return_value = self.mock_order_json
         mock_place_order_with_GBF.side_effect = lambda json, order_number: self.mock_order_response
 
         result = gbf.create_order(self.order_object, self.address_data)
 
-        updated_order_object = Order.objects.filter(pk=self.order_object.id).first()
-        
-        self.assertEqual(updated_order_object.order_number, "EDROP-00014")
+        mock_place_order_with_GBF.assert_called_once_with(self.mock_order_json, "EDROP-00014")
         self.assertEqual(result, True)
 
-        logger.debug(f'Order {updated_order_object.order_number} was successfully created.')
+        logger.debug(f'Order {self.order_object.order_number} was successfully created.')
 
     def test_generate_order_number(self):
         result = gbf._generate_order_number(self.order_object)
@@ -126,7 +124,7 @@ class TestGBF(TestCase):
         self.assertEqual(result_data['orders'][0]['shippingInfo']['address']['company'], "John Doe")
         self.assertEqual(result_data['orders'][0]['shippingInfo']['address']['zipCode'], "00000")
 
-    @patch("track.gbf.requests.post")
+    @patch("track.gbf.http_client.post")
     def test_place_order_with_GBF_success(self, mock_request):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -144,7 +142,7 @@ class TestGBF(TestCase):
 
         logger.debug(f'Order {self.mock_order_json['orders'][0]['orderNumber']} was successfully placed.')
 
-    @patch("track.gbf.requests.post")
+    @patch("track.gbf.http_client.post")
     def test_place_order_with_GBF_failure(self, mock_request):
         mock_response = MagicMock()
         mock_response.status_code = 400
@@ -159,7 +157,7 @@ class TestGBF(TestCase):
         logger.error('The order was unable to be placed due to a bad request.')
 
     @patch("track.gbf._extract_tracking_info")
-    @patch("track.gbf.requests.post")
+    @patch("track.gbf.http_client.post")
     def test_get_order_confirmations_success(self, mock_request, mock_extract_tracking_info):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -180,7 +178,7 @@ class TestGBF(TestCase):
 
         logger.debug(f'The following order numbers were successfully checked for order confirmation: {self.order_numbers}')
 
-    @patch("track.gbf.requests.post")
+    @patch("track.gbf.http_client.post")
     def test_get_order_confirmations_failure(self, mock_request):
         mock_response = MagicMock()
         mock_response.status_code = 400
@@ -193,3 +191,120 @@ class TestGBF(TestCase):
         self.assertEqual(result, None)
 
         logger.error('The order confirmation failed due to a bad request.')
+
+    @patch("track.gbf.http_client.post")
+    def test_create_orders_batch_success(self, mock_request):
+        self.order_object.order_number = self.mock_order_number
+        second_order = Order.objects.create(pk=15, record_id="15", project_id=1, order_number="EDROP-00015")
+        mock_request.return_value = OrderResponse(200, self.order_response_json)
+
+        result = gbf.create_orders([(self.order_object, self.address_data), (second_order, self.address_data)])
+
+        # both orders are sent in one request
+        mock_request.assert_called_once()
+        sent_orders = json.loads(mock_request.call_args.kwargs["data"])["orders"]
+        self.assertEqual([o["orderNumber"] for o in sent_orders], ["EDROP-00014", "EDROP-00015"])
+        self.assertEqual(result, {"EDROP-00014": True, "EDROP-00015": True})
+
+    @patch("track.gbf.http_client.post")
+    def test_create_orders_batch_failure_is_not_sent_again(self, mock_request):
+        """
+        Test that if GBF does not accept a batch and does not say which orders failed, all orders
+        are reported as failed and none of them is sent again.
+        """
+        self.order_object.order_number = self.mock_order_number
+        second_order = Order.objects.create(pk=15, record_id="15", project_id=1, order_number="EDROP-00015")
+        mock_request.return_value = OrderResponse(500, {"success": False, "error": "Internal Server Error"})
+
+        result = gbf.create_orders([(self.order_object, self.address_data), (second_order, self.address_data)])
+
+        mock_request.assert_called_once()
+        self.assertEqual(result, {"EDROP-00014": False, "EDROP-00015": False})
+
+    @patch("track.gbf.http_client.post")
+    def test_create_orders_per_order_results(self, mock_request):
+        """
+        Test that the outcome of each order is taken from the response if GBF lists it.
+        """
+        self.order_object.order_number = self.mock_order_number
+        second_order = Order.objects.create(pk=15, record_id="15", project_id=1, order_number="EDROP-00015")
+        mock_request.return_value = OrderResponse(400, {"success": False, "orders": [
+            {"orderNumber": "EDROP-00014", "success": True},
+            {"orderNumber": "EDROP-00015", "success": False, "error": "Invalid address"},
+        ]})
+
+        result = gbf.create_orders([(self.order_object, self.address_data), (second_order, self.address_data)])
+
+        mock_request.assert_called_once()
+        self.assertEqual(result, {"EDROP-00014": True, "EDROP-00015": False})
+
+    @patch("track.gbf.http_client.post", side_effect=requests.exceptions.ReadTimeout("Read timed out."))
+    def test_create_orders_request_exception(self, mock_request):
+        """
+        Test that all orders of a batch are reported as failed if the request to GBF fails.
+        """
+        self.order_object.order_number = self.mock_order_number
+
+        result = gbf.create_orders([(self.order_object, self.address_data)])
+
+        self.assertEqual(result, {"EDROP-00014": False})
+
+    @patch("track.gbf.http_client.post")
+    def test_get_order_confirmations_chunks_are_isolated(self, mock_request):
+        """
+        Test that the order numbers are requested in chunks and that a failing chunk
+        does not affect the confirmations of the other chunks.
+        """
+        def fake_post(url, endpoint=None, data=None, headers=None):
+            mock_response = MagicMock()
+            if "EDROP-00014" in data["orderNumbers"]:
+                mock_response.json.return_value = self.confirmation_response_json
+            else:
+                mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError("500 Server Error")
+            return mock_response
+        mock_request.side_effect = fake_post
+
+        result = gbf.get_order_confirmations(["EDROP-00014", "EDROP-00015", "EDROP-00016"], chunk_size=2, max_workers=2)
+
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(result, self.tracking_info)
+
+    @patch("track.gbf.http_client.post")
+    def test_get_order_confirmations_no_order_numbers(self, mock_request):
+        result = gbf.get_order_confirmations([])
+
+        mock_request.assert_not_called()
+        self.assertIsNone(result)
+
+    def test_iter_confirmations(self):
+        """
+        Test that confirmations are parsed one at a time and that other fields of the data are skipped.
+        """
+        data = json.dumps({
+            "Header": {"Count": 3, "ShippingConfirmations": "not these"},
+            "ShippingConfirmations": [
+                json.loads(self.confirmation_response_json["dataArray"][0]["data"])["ShippingConfirmations"][0],
+                {"OrderNumber": "EDROP-00015", "ShipDate": "2025-01-24", "Tracking": ["1"], "Items": []},
+                {"OrderNumber": "EDROP-00016", "Items": [{"TubeSerial": ["TUBE"]}]},
+            ],
+            "Footer": [],
+        }, indent=2)
+
+        confirmations = gbf.iter_confirmations(data)
+
+        self.assertEqual(next(confirmations), ("EDROP-00014", self.tracking_info["EDROP-00014"]))
+        self.assertEqual(dict(confirmations), {
+            "EDROP-00015": {'date_kit_shipped': '2025-01-24', 'kit_tracking_n': ['1'], 'return_tracking_n': [], 'tube_serial_n': []},
+            "EDROP-00016": {'date_kit_shipped': None, 'kit_tracking_n': None, 'return_tracking_n': [], 'tube_serial_n': ['TUBE']},
+        })
+        self.assertEqual(gbf._extract_tracking_info(self.confirmation_response_json["dataArray"][0]["data"]), self.tracking_info)
+        self.assertEqual(gbf._extract_tracking_info('{"ShippingConfirmations": []}'), {})
+
+    @patch("track.gbf.http_client.post")
+    def test_get_order_confirmations_malformed_data(self, mock_request):
+        for data in ['{"ShippingConfirmations": [{"OrderNumber": "EDROP-00014", "Items": []}', '{"ShippingConfirmations": [] "Other": 1}', '[]']:
+            mock_response = MagicMock()
+            mock_response.json.return_value = {"success": True, "dataArray": [{"format": "json", "data": data}]}
+            mock_request.return_value = mock_response
+
+            self.assertIsNone(gbf.get_order_confirmations(self.order_numbers))
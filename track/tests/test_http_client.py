@@ -0,0 +1,86 @@
+import asyncio, logging
+from unittest.mock import patch, MagicMock
+import httpx
+from django.test import SimpleTestCase, override_settings
+
+from track import http_client
+
+logger = logging.getLogger(__name__)
+
+
+def _response(status_code=200, content=b'{"success": true}', body="a=1"):
+    response = MagicMock()
+    response.status_code = status_code
+    response.content = content
+    response.request.body = body
+    return response
+
+
+@override_settings(HTTP_CONNECT_TIMEOUT=2, HTTP_READ_TIMEOUT=10)
+class TestHttpClient(SimpleTestCase):
+    def setUp(self):
+        http_client.close_sessions()
+        http_client.reset_stats()
+
+    def tearDown(self):
+        http_client.close_sessions()
+        http_client.reset_stats()
+
+    def test_session_is_reused_per_host(self):
+        session = http_client.get_session("https://gbf.example.com/oap/api/order")
+
+        self.assertIs(session, http_client.get_session("https://gbf.example.com/oap/api/confirm2"))
+        self.assertIsNot(session, http_client.get_session("https://redcap.example.com/api/"))
+
+    @patch("track.http_client.requests.Session.post")
+    def test_post_uses_configured_timeouts(self, mock_post):
+        mock_post.return_value = _response()
+
+        http_client.post("https://gbf.example.com/oap/api/order", data="a=1")
+
+        args, kwargs = mock_post.call_args
+        self.assertEqual(args[0], "https://gbf.example.com/oap/api/order")
+        self.assertEqual(kwargs["timeout"], (2, 10))
+        self.assertEqual(kwargs["data"], "a=1")
+
+    @patch("track.http_client.requests.Session.post")
+    def test_post_records_stats_per_endpoint(self, mock_post):
+        mock_post.return_value = _response(content=b'12345', body="abc")
+
+        http_client.post("https://gbf.example.com/oap/api/order", endpoint="gbf:order")
+        http_client.post("https://gbf.example.com/oap/api/order", endpoint="gbf:order")
+        mock_post.return_value = _response(status_code=500, content=b'', body=None)
+        http_client.post("https://gbf.example.com/oap/api/order", endpoint="gbf:order")
+
+        stats = http_client.get_stats()["gbf:order"]
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(stats["bytes_sent"], 6)
+        self.assertEqual(stats["bytes_received"], 10)
+
+    async def test_async_post_limits_concurrent_requests(self):
+        """
+        Test that no more than `max_concurrency` requests are sent to a host at the same time.
+        """
+        in_flight = 0
+        max_in_flight = 0
+
+        async def fake_post(client, url, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return httpx.Response(200, content=b'{"success": true}', request=httpx.Request("POST", url, content=b"a=1"))
+
+        with patch("track.http_client.httpx.AsyncClient.post", fake_post):
+            responses = await asyncio.gather(*[
+                http_client.async_post("https://gbf.example.com/oap/api/order", endpoint="gbf:oap/api/order", max_concurrency=3)
+                for _ in range(10)
+            ])
+        await http_client.close_async_clients()
+
+        logger.debug("Most requests in flight at the same time: %s", max_in_flight)
+        self.assertEqual(max_in_flight, 3)
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        self.assertEqual(http_client.get_stats()["gbf:oap/api/order"]["requests"], 10)
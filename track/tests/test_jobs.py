@@ -0,0 +1,358 @@
+import logging
+from datetime import timedelta
+import httpx
+from unittest.mock import patch
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from track.models import Order, OrderJob
+from track.exceptions import REDCapError, OrderNumberNotStoredError
+from track import jobs, metrics
+
+logger = logging.getLogger(__name__)
+
+
+@override_settings(ORDER_JOB_MAX_ATTEMPTS=2, ORDER_JOB_RETRY_DELAY=0)
+class TestJobs(TestCase):
+    def setUp(self):
+        self.record_id = "123"
+        self.project_id = "proj_1"
+        self.project_url = "http://example.com/project"
+
+    def test_enqueue_order_reuses_queued_job(self):
+        """
+        Test that a second webhook call for the same record does not create a second job.
+        """
+        job = jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+        same_job = jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+
+        self.assertEqual(job.id, same_job.id)
+        self.assertEqual(OrderJob.objects.count(), 1)
+
+    def test_one_active_job_per_record(self):
+        """
+        Test that the database rejects a second waiting job for a record, so concurrent webhook calls
+        cannot queue the same order twice, and that a record gets a new job once its job has finished.
+        """
+        job = jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            OrderJob.objects.create(record_id=self.record_id, project_id=self.project_id)
+
+        job.status = OrderJob.FAILED
+        job.save()
+        new_job = jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+        logger.debug("Jobs after the first one failed: %s", list(OrderJob.objects.values_list('id', 'status')))
+        self.assertNotEqual(new_job.id, job.id)
+        self.assertEqual(new_job.status, OrderJob.QUEUED)
+
+    def test_enqueue_missing_orders(self):
+        """
+        Test that jobs are only queued for records without an order or with a pending order, and without
+        a waiting or running job.
+        """
+        Order.objects.create(record_id="1", project_id=self.project_id, order_status=Order.INITIATED, order_number="EDROP-00001")
+        Order.objects.create(record_id="2", project_id=self.project_id, order_status=Order.PENDING)
+        Order.objects.create(record_id="3", project_id=self.project_id, order_status=Order.PENDING)
+        jobs.enqueue_order("3", self.project_id, self.project_url)
+        jobs.enqueue_order("4", self.project_id, self.project_url)
+
+        queued = jobs.enqueue_missing_orders(["5", "1", "2", "3", "4", "5"], self.project_id)
+
+        self.assertEqual(queued, ["5", "2"])
+        self.assertEqual(OrderJob.objects.filter(status=OrderJob.QUEUED).count(), 4)
+        self.assertEqual(jobs.enqueue_missing_orders(["5", "2"], self.project_id), [])
+
+    @override_settings(RECONCILIATION_FAILED_COOLDOWN=3600)
+    def test_enqueue_missing_orders_skips_recently_failed(self):
+        """
+        Test that records whose job failed within the cooldown are not queued again.
+        """
+        now = timezone.now()
+        OrderJob.objects.create(record_id="1", project_id=self.project_id, status=OrderJob.FAILED, finished_at=now - timedelta(minutes=10))
+        OrderJob.objects.create(record_id="2", project_id=self.project_id, status=OrderJob.FAILED, finished_at=now - timedelta(hours=2))
+
+        queued = jobs.enqueue_missing_orders(["1", "2", "3"], self.project_id)
+
+        logger.debug("Jobs after reconciling: %s", list(OrderJob.objects.values_list('record_id', 'status')))
+        self.assertEqual(queued, ["2", "3"])
+
+    def test_claim_jobs(self):
+        """
+        Test that claiming jobs marks them as running and counts the attempt.
+        """
+        jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+        jobs.enqueue_order("456", self.project_id, self.project_url)
+
+        claimed = jobs.claim_jobs(1)
+
+        self.assertEqual(len(claimed), 1)
+        job = OrderJob.objects.get(pk=claimed[0].pk)
+        self.assertEqual(job.status, OrderJob.RUNNING)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(OrderJob.objects.filter(status=OrderJob.QUEUED).count(), 1)
+
+    @patch("track.jobs.orders.place_order")
+    def test_run_job_success(self, mock_place_order):
+        mock_place_order.return_value = (Order(record_id=self.record_id, order_status=Order.INITIATED), True)
+        jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+        job = jobs.claim_jobs(1)[0]
+
+        jobs.run_job(job)
+
+        job.refresh_from_db()
+        mock_place_order.assert_called_once_with(self.record_id, self.project_id, self.project_url)
+        self.assertEqual(job.status, OrderJob.DONE)
+        self.assertIsNotNone(job.duration)
+        self.assertIsNotNone(job.latency)
+
+    @patch("track.jobs.orders.place_order")
+    def test_run_job_retries_until_max_attempts(self, mock_place_order):
+        """
+        Test that a job for which GBF did not accept the order is retried and fails
+        once ORDER_JOB_MAX_ATTEMPTS is reached.
+        """
+        mock_place_order.return_value = (Order(record_id=self.record_id, order_status=Order.PENDING), True)
+        jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+
+        jobs.run_job(jobs.claim_jobs(1)[0])
+        job = OrderJob.objects.get()
+        self.assertEqual(job.status, OrderJob.QUEUED)
+        self.assertIsNone(job.finished_at)
+
+        jobs.run_job(jobs.claim_jobs(1)[0])
+        job.refresh_from_db()
+        self.assertEqual(job.status, OrderJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.last_error, "Order could not be placed with GBF.")
+
+    @patch("track.jobs.orders.place_order")
+    def test_run_job_incomplete_record_is_not_retried(self, mock_place_order):
+        mock_place_order.return_value = (None, False)
+        jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+
+        jobs.run_job(jobs.claim_jobs(1)[0])
+
+        self.assertEqual(OrderJob.objects.get().status, OrderJob.FAILED)
+
+    @patch("track.jobs.redcap.get_order_numbers")
+    @patch("track.jobs.orders.place_order")
+    def test_run_job_order_claimed_by_other_process(self, mock_place_order, mock_get_order_numbers):
+        """
+        Test that a job whose order was claimed by another process is only done once the order number is in REDCap.
+        """
+        mock_place_order.return_value = (Order(record_id=self.record_id, order_status=Order.INITIATED, order_number="EDROP-00001"), False)
+        mock_get_order_numbers.return_value = {self.record_id: ""}
+        jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+
+        jobs.run_job(jobs.claim_jobs(1)[0])
+        job = OrderJob.objects.get()
+        logger.debug("Job after the order number was not found in REDCap: %s", job.last_error)
+        self.assertEqual(job.status, OrderJob.QUEUED)
+        mock_get_order_numbers.assert_called_once_with([self.record_id])
+
+        mock_get_order_numbers.return_value = {self.record_id: "EDROP-00001"}
+        jobs.run_job(jobs.claim_jobs(1)[0])
+        self.assertEqual(OrderJob.objects.get().status, OrderJob.DONE)
+
+    @patch("track.orders.redcap.set_order_number")
+    @patch("track.orders.gbf.create_order", return_value=True)
+    @patch("track.orders.redcap.get_record_info", return_value={"contact_complete": "2"})
+    @override_settings(REDCAP_FIELD_TO_BE_COMPLETE="contact_complete")
+    def test_run_job_only_retries_storing_order_number(self, mock_get_record_info, mock_create_order, mock_set_order_number):
+        """
+        Test that if the order number of a placed order cannot be stored in REDCap, the retry only stores
+        the order number and does not place the order again.
+        """
+        mock_set_order_number.side_effect = [REDCapError("REDCap returned 500."), None]
+        jobs.enqueue_order(self.record_id, self.project_id, self.project_url)
+
+        jobs.run_job(jobs.claim_jobs(1)[0])
+        job = OrderJob.objects.get()
+        self.assertEqual(job.status, OrderJob.QUEUED)
+        self.assertEqual(job.action, OrderJob.STORE_ORDER_NUMBER)
+
+        jobs.run_job(jobs.claim_jobs(1)[0])
+        job.refresh_from_db()
+        order = Order.objects.get()
+        self.assertEqual(job.status, OrderJob.DONE)
+        mock_create_order.assert_called_once()
+        self.assertEqual(mock_set_order_number.call_count, 2)
+        mock_set_order_number.assert_called_with(self.record_id, order.order_number)
+
+    @patch("track.jobs.orders.place_orders")
+    def test_run_batch(self, mock_place_orders):
+        """
+        Test that the outcome of a batch is recorded for each job individually.
+        """
+        mock_place_orders.return_value = {
+            "1": (Order(record_id="1", order_status=Order.INITIATED), True),
+            "2": (Order(record_id="2", order_status=Order.PENDING), True),
+            "3": (None, False),
+        }
+        for record_id in ["1", "2", "3"]:
+            jobs.enqueue_order(record_id, self.project_id, self.project_url)
+
+        jobs.run_batch(jobs.claim_jobs(3))
+
+        mock_place_orders.assert_called_once()
+        self.assertEqual(OrderJob.objects.get(record_id="1").status, OrderJob.DONE)
+        self.assertEqual(OrderJob.objects.get(record_id="2").status, OrderJob.QUEUED)
+        self.assertEqual(OrderJob.objects.get(record_id="3").status, OrderJob.FAILED)
+
+    @patch("track.jobs.orders.store_order_number_in_redcap")
+    @patch("track.jobs.orders.place_orders")
+    def test_run_batch_order_number_not_stored(self, mock_place_orders, mock_store_order_number):
+        """
+        Test that a job in a batch whose order number could not be stored in REDCap is retried without
+        being placed again, while the other jobs of the batch are done.
+        """
+        order = Order.objects.create(record_id="1", project_id=self.project_id, order_status=Order.INITIATED, order_number="EDROP-00001")
+        results = {"1": (order, True), "2": (Order(record_id="2", order_status=Order.INITIATED), True)}
+        mock_place_orders.side_effect = OrderNumberNotStoredError(["1"], results)
+        for record_id in ["1", "2"]:
+            jobs.enqueue_order(record_id, self.project_id, self.project_url)
+
+        jobs.run_batch(jobs.claim_jobs(2))
+        job = OrderJob.objects.get(record_id="1")
+        self.assertEqual((job.action, job.status), (OrderJob.STORE_ORDER_NUMBER, OrderJob.QUEUED))
+        self.assertEqual(OrderJob.objects.get(record_id="2").status, OrderJob.DONE)
+
+        jobs.run_batch(jobs.claim_jobs(2))
+        mock_place_orders.assert_called_once()
+        mock_store_order_number.assert_called_once_with("1", order)
+        self.assertEqual(OrderJob.objects.get(record_id="1").status, OrderJob.DONE)
+
+    @override_settings(GBF_BATCH_WINDOW=60)
+    def test_is_batch_ready(self):
+        jobs.enqueue_order("1", self.project_id, self.project_url)
+        self.assertFalse(jobs.is_batch_ready(2, 60))
+
+        jobs.enqueue_order("2", self.project_id, self.project_url)
+        self.assertTrue(jobs.is_batch_ready(2, 60))
+
+
+@override_settings(REDCAP_INSTRUMENT_ID="contact", REDCAP_FIELD_TO_BE_COMPLETE="contact_complete")
+class TestInitiateOrder(TestCase):
+    def test_initiate_order_queues_job(self):
+        """
+        Test that the webhook stores a job and returns 202 without placing the order.
+        """
+        with patch("track.jobs.orders.place_order") as mock_place_order:
+            response = self.client.post("/api/order/create", {
+                "instrument": "contact",
+                "contact_complete": "2",
+                "record": "123",
+                "project_id": "proj_1",
+            })
+            mock_place_order.assert_not_called()
+
+        self.assertEqual(response.status_code, 202)
+        job = OrderJob.objects.get()
+        self.assertEqual(job.record_id, "123")
+        self.assertEqual(response.json()["job"], job.id)
+
+    def test_initiate_order_missing_record(self):
+        response = self.client.post("/api/order/create", {
+            "instrument": "contact",
+            "contact_complete": "2",
+        })
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(OrderJob.objects.exists())
+
+    def test_initiate_order_ignores_duplicates(self):
+        """
+        Test that repeated webhook calls for a record are not handled again within the TTL.
+        """
+        metrics._increments.clear()
+        data = {"instrument": "contact", "contact_complete": "2", "record": "123", "project_id": "proj_1"}
+
+        self.assertEqual(self.client.post("/api/order/create", data).status_code, 202)
+        with patch("track.api.Order.objects.filter") as mock_filter:
+            response = self.client.post("/api/order/create", data)
+            mock_filter.assert_not_called()
+
+        self.assertEqual(response.json()["status"], "duplicate")
+        self.assertEqual(OrderJob.objects.count(), 1)
+        self.assertIn('edrop_webhook_deduplicated_total{reason="recent"} 1.0', metrics.render())
+
+        # once the TTL has passed, the record is handled again
+        cache.delete("webhook:recent:123")
+        self.assertEqual(self.client.post("/api/order/create", data).status_code, 202)
+
+    def test_initiate_order_single_flight(self):
+        """
+        Test that a call for a record that another worker is handling returns right away and
+        does not release the other worker's claim.
+        """
+        cache.add("webhook:in-flight:123", True)
+
+        response = self.client.post("/api/order/create", {"instrument": "contact", "contact_complete": "2", "record": "123"})
+
+        self.assertEqual(response.json()["status"], "duplicate")
+        self.assertFalse(OrderJob.objects.exists())
+        self.assertTrue(cache.get("webhook:in-flight:123"))
+
+    @override_settings(ORDER_PLACEMENT_MODE="webhook")
+    @patch("track.orders.redcap.async_get_record_info", side_effect=REDCapError("REDCap returned 503."))
+    def test_initiate_order_queues_job_if_order_not_claimed(self, mock_get_record_info):
+        """
+        Test that in webhook mode an order that could not be claimed is queued to be placed by the order worker.
+        """
+        response = self.client.post("/api/order/create", {"instrument": "contact", "contact_complete": "2", "record": "123", "project_id": "proj_1"})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(OrderJob.objects.get().action, OrderJob.PLACE_ORDER)
+
+    @override_settings(ORDER_PLACEMENT_MODE="webhook")
+    @patch("track.orders.redcap.async_set_order_number", side_effect=REDCapError("REDCap returned 503."))
+    @patch("track.orders.gbf.async_create_order", return_value=True)
+    @patch("track.orders.redcap.async_get_record_info", return_value={"contact_complete": "2"})
+    def test_initiate_order_queues_order_number(self, mock_get_record_info, mock_create_order, mock_set_order_number):
+        """
+        Test that in webhook mode an order that GBF accepted, but whose order number could not be stored
+        in REDCap, is not placed again, only storing its order number is queued.
+        """
+        response = self.client.post("/api/order/create", {"instrument": "contact", "contact_complete": "2", "record": "123", "project_id": "proj_1"})
+
+        logger.debug("Response when the order number could not be stored: %s", response.json())
+        self.assertEqual(response.status_code, 201)
+        job = OrderJob.objects.get()
+        self.assertEqual(job.action, OrderJob.STORE_ORDER_NUMBER)
+        self.assertEqual(response.json()["order"], Order.objects.get(record_id="123").order_number)
+        mock_create_order.assert_called_once()
+
+    @override_settings(ORDER_PLACEMENT_MODE="webhook")
+    @patch("track.orders.gbf.async_create_order", side_effect=httpx.ReadTimeout("Read timed out."))
+    @patch("track.orders.redcap.async_get_record_info", return_value={"contact_complete": "2"})
+    def test_initiate_order_queues_job_if_gbf_request_fails(self, mock_get_record_info, mock_create_order):
+        """
+        Test that in webhook mode an order whose request to GBF failed is set back to pending and
+        queued to be placed by the order worker.
+        """
+        response = self.client.post("/api/order/create", {"instrument": "contact", "contact_complete": "2", "record": "123", "project_id": "proj_1"})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(OrderJob.objects.get().action, OrderJob.PLACE_ORDER)
+        self.assertEqual(Order.objects.get(record_id="123").order_status, Order.PENDING)
+
+    @override_settings(ORDER_PLACEMENT_MODE="webhook")
+    @patch("track.api.http_client.close_async_clients")
+    @patch("track.orders.gbf.async_create_order", return_value=False)
+    @patch("track.orders.redcap.async_get_record_info", return_value={"contact_complete": "2"})
+    async def test_initiate_order_closes_clients_without_asgi(self, mock_get_record_info, mock_create_order, mock_close_async_clients):
+        """
+        Test that the async clients are closed after a call that was not served through ASGI, where every
+        call has its own event loop, and kept for the next call under ASGI.
+        """
+        data = {"instrument": "contact", "contact_complete": "2", "record": "123", "project_id": "proj_1"}
+
+        await self.async_client.post("/api/order/create", data)
+        mock_close_async_clients.assert_not_called()
+
+        await cache.adelete("webhook:recent:123")
+        await sync_to_async(self.client.post)("/api/order/create", data)
+        mock_close_async_clients.assert_called_once()
@@ -0,0 +1,101 @@
+import logging
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from track.models import OrderLog, ConfirmationCheckLog, LogEntry
+from track.log_manager import LogManager
+from track.utils import count_queries
+
+logger = logging.getLogger(__name__)
+
+
+def messages(log, source=None):
+    entries = log.entries.all()
+    if source:
+        entries = entries.filter(source=source)
+    return [str(entry) for entry in entries]
+
+
+class TestLogManager(TestCase):
+    def setUp(self):
+        self.log_manager = LogManager()
+        self.order_number = "EDROP-00001"
+        self.order_log = OrderLog.objects.create(order_number=self.order_number)
+        self.confirmation_log = ConfirmationCheckLog.objects.create(job_id="1")
+
+    def test_append_unbuffered(self):
+        self.log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, "Placing order.", self.order_number)
+        self.log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, "Failed.", self.order_number)
+        self.log_manager.append_to_apscheduler_log(LogManager.LEVEL_INFO, "Started.")
+
+        self.assertEqual(messages(self.order_log, LogEntry.SOURCE_GBF), ["INFO: Placing order.", "ERROR: Failed."])
+        self.assertEqual(messages(self.confirmation_log, LogEntry.SOURCE_APSCHEDULER), ["INFO: Started."])
+
+    def test_buffered_writes_once_per_log(self):
+        """
+        Test that buffered log entries are inserted with one query per log at the end of the block,
+        and that the log content is the same as without buffering.
+        """
+        with self.log_manager.buffered():
+            with count_queries() as counter:
+                for i in range(10):
+                    self.log_manager.append_to_orders_log(LogManager.LEVEL_INFO, f"Line {i}", self.order_number)
+                self.log_manager.append_to_redcap_log(LogManager.LEVEL_INFO, "Sent.", self.order_number)
+                self.log_manager.append_to_gbf_log(LogManager.LEVEL_DEBUG, "Request.")
+            self.assertEqual(counter.count, 0)
+            self.assertFalse(LogEntry.objects.exists())
+
+            with count_queries() as counter:
+                self.log_manager.flush()
+            # one lookup of the log and one insert per log
+            self.assertEqual(counter.count, 4)
+
+        self.assertEqual(messages(self.order_log, LogEntry.SOURCE_ORDERS), [f"INFO: Line {i}" for i in range(10)])
+        self.assertEqual(messages(self.order_log, LogEntry.SOURCE_REDCAP), ["INFO: Sent."])
+        self.assertEqual(messages(self.confirmation_log), ["DEBUG: Request."])
+
+    def test_buffered_flushes_on_exception(self):
+        with self.assertRaises(ValueError):
+            with self.log_manager.buffered():
+                self.log_manager.append_to_orders_log(LogManager.LEVEL_ERROR, "Something went wrong.")
+                raise ValueError()
+
+        self.assertEqual(messages(self.confirmation_log), ["ERROR: Something went wrong."])
+
+    @override_settings(LOG_BUFFER_MAX_LINES=3)
+    def test_buffered_flushes_when_full(self):
+        with self.log_manager.buffered():
+            for i in range(4):
+                self.log_manager.append_to_orders_log(LogManager.LEVEL_INFO, f"Line {i}")
+
+            self.assertEqual(messages(self.confirmation_log), ["INFO: Line 0", "INFO: Line 1", "INFO: Line 2"])
+
+    def test_complete_log_writes_buffered_lines(self):
+        with self.log_manager.buffered():
+            self.log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, "Placed.", self.order_number)
+            self.log_manager.complete_log(self.order_number)
+
+        self.order_log.refresh_from_db()
+        self.assertTrue(self.order_log.is_complete)
+        self.assertEqual(messages(self.order_log), ["INFO: Placed.", f"INFO: Log {self.order_log.id}: Complete!"])
+
+    def test_append_to_completed_log(self):
+        self.log_manager.complete_log(self.order_number)
+
+        self.log_manager.append_to_gbf_log(LogManager.LEVEL_INFO, "Too late.", self.order_number)
+
+        self.assertNotIn("INFO: Too late.", messages(self.order_log))
+
+    def test_admin_log_entries(self):
+        self.log_manager.append_to_gbf_log(LogManager.LEVEL_ERROR, "Failed.", self.order_number)
+        self.log_manager.append_to_orders_log(LogManager.LEVEL_INFO, "Other log.")
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+
+        response = self.client.get(f"/admin/track/logentry/?order_log__id__exact={self.order_log.id}&level__exact=error")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Failed.")
+        self.assertNotContains(response, "Other log.")
+
+        response = self.client.get(f"/admin/track/orderlog/{self.order_log.id}/change/")
+        self.assertContains(response, "View 1 log entries")
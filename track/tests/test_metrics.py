@@ -0,0 +1,100 @@
+import logging
+from unittest.mock import patch, MagicMock
+from django.test import TestCase, override_settings
+
+from track import metrics, http_client
+from track.models import *
+
+logger = logging.getLogger(__name__)
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        # metrics recorded by other tests that have not been written yet
+        metrics._increments.clear()
+        metrics._gauges.clear()
+
+    def test_counters_are_added_up_across_flushes(self):
+        """
+        Test that counters written by several processes (i.e. several flushes) are added up.
+        """
+        metrics.inc('edrop_orders_placed_total')
+        metrics.flush()
+        metrics.inc('edrop_orders_placed_total', 2)
+        metrics.flush()
+
+        self.assertEqual(Metric.objects.get(name='edrop_orders_placed_total').value, 3)
+        self.assertIn("edrop_orders_placed_total 3.0\n", metrics.render())
+
+    def test_histogram(self):
+        metrics.observe('edrop_outbound_request_duration_seconds', 0.2, endpoint="gbf:oap/api/order", status=200)
+        metrics.observe('edrop_outbound_request_duration_seconds', 3, endpoint="gbf:oap/api/order", status=200)
+
+        output = metrics.render()
+
+        labels = 'endpoint="gbf:oap/api/order",status="200"'
+        self.assertIn("# TYPE edrop_outbound_request_duration_seconds histogram", output)
+        self.assertIn(f'edrop_outbound_request_duration_seconds_bucket{{{labels},le="0.05"}} 0.0', output)
+        self.assertIn(f'edrop_outbound_request_duration_seconds_bucket{{{labels},le="0.25"}} 1.0', output)
+        self.assertIn(f'edrop_outbound_request_duration_seconds_bucket{{{labels},le="5.0"}} 2.0', output)
+        self.assertIn(f'edrop_outbound_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2.0', output)
+        self.assertIn(f'edrop_outbound_request_duration_seconds_sum{{{labels}}} 3.2', output)
+        self.assertIn(f'edrop_outbound_request_duration_seconds_count{{{labels}}} 2.0', output)
+
+    @patch("track.http_client.get_session")
+    def test_requests_do_not_flush(self, mock_get_session):
+        """
+        Test that requests, which are sent from worker threads, only record metrics and leave writing
+        them to the thread that runs the unit of work.
+        """
+        mock_get_session.return_value.post.return_value = MagicMock(status_code=200)
+
+        with patch("track.metrics.flush") as mock_flush:
+            http_client.post("http://example.com", endpoint="redcap:record:export")
+            mock_flush.assert_not_called()
+
+        self.assertFalse(Metric.objects.exists())
+        self.assertIn(('edrop_outbound_request_duration_seconds_count', 'endpoint="redcap:record:export",status="200"', ''), metrics._increments)
+
+    def test_gauges_are_replaced(self):
+        metrics.set_gauge('edrop_tracking_job_last_duration_seconds', 5)
+        metrics.flush()
+        metrics.set_gauge('edrop_tracking_job_last_duration_seconds', 2)
+        metrics.flush()
+
+        self.assertIn("edrop_tracking_job_last_duration_seconds 2.0\n", metrics.render())
+
+    def test_backlog(self):
+        Order.objects.create(record_id="1", project_id="1", order_status=Order.INITIATED, order_number="EDROP-00001")
+        Order.objects.create(record_id="2", project_id="1", order_status=Order.PENDING)
+
+        output = metrics.render()
+
+        self.assertIn('edrop_orders{status="initiated"} 1.0', output)
+        self.assertIn('edrop_orders{status="pending"} 1.0', output)
+        self.assertIn('edrop_orders{status="shipped"} 0.0', output)
+        self.assertIn("edrop_orders_due_for_polling 1.0", output)
+
+    @patch("track.http_client.get_session")
+    def test_outbound_requests_are_observed(self, mock_get_session):
+        response = MagicMock(status_code=200, content=b'{}')
+        response.request.body = b''
+        mock_get_session.return_value.post.return_value = response
+
+        http_client.post("http://example.com/api/", endpoint="redcap:record:export")
+
+        self.assertIn('edrop_outbound_request_duration_seconds_count{endpoint="redcap:record:export",status="200"} 1.0', metrics.render())
+
+    @override_settings(REDCAP_INSTRUMENT_ID="contact")
+    def test_metrics_endpoint(self):
+        self.client.post("/api/order/create", {"instrument": "other"})
+
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('edrop_webhook_duration_seconds_count{status="200"} 1.0', response.content.decode())
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_metrics_endpoint_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
@@ -1,12 +1,24 @@
-import logging
-from django.test import TestCase, override_settings
+import logging, threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 from unittest.mock import patch, MagicMock
-from track.models import Order
+from track import http_client, standin
+from track.models import Order, OrderLog
+from track.utils import count_queries
 from track.orders import (
     place_order,
+    place_orders,
     store_order_number_in_redcap,
     check_orders_shipping_info,
-    _update_orders_with_shipping_info
+    get_next_poll_at,
+    get_tracking_check_interval,
+    _update_orders_with_shipping_info,
+    _claim_order
 )
 
 # Create a logger for this test module.
@@ -26,18 +38,19 @@ class TestOrders(TestCase):
     def test_place_order_incomplete_record(self, mock_get_record_info):
         """
         Test that if the REDCap record does not have the complete flag (i.e. contact_complete != '2'),
-        place_order returns None.
+        place_order returns no order.
         """
         # Simulate a record with incomplete data.
         logger.debug("Running test_place_order_incomplete_record: Simulating incomplete REDCap record.")
         mock_get_record_info.return_value = {"contact_complete": "1"}
         
         # Attempt to place the order.
-        order = place_order(self.record_id, self.project_id, self.project_url)
+        order, claimed = place_order(self.record_id, self.project_id, self.project_url)
         logger.debug("Order placement result for incomplete record: %s", order)
         
         # Expect no order to be created.
         self.assertIsNone(order)
+        self.assertFalse(claimed)
     
     @patch("track.orders.gbf.create_order")
     @patch("track.orders.redcap.set_order_number")
@@ -72,11 +85,12 @@ class TestOrders(TestCase):
         mock_create_order.side_effect = fake_create_order
 
         # Place the order.
-        order = place_order(self.record_id, self.project_id, self.project_url)
+        order, claimed = place_order(self.record_id, self.project_id, self.project_url)
         logger.debug("Order created: %s", order)
         
         # Verify that an order was created and its status is INITIATED.
         self.assertIsNotNone(order)
+        self.assertTrue(claimed)
         self.assertEqual(order.order_status, Order.INITIATED)
         mock_create_order.assert_called_once()
         logger.debug("GBF.create_order was called successfully.")
@@ -107,7 +121,7 @@ class TestOrders(TestCase):
         mock_get_record_info.return_value = address_data
         mock_create_order.return_value = False  # Simulate failure from GBF
         
-        order = place_order(self.record_id, self.project_id, self.project_url)
+        order, _ = place_order(self.record_id, self.project_id, self.project_url)
         logger.debug("Order created with GBF failure: %s", order)
         
         self.assertIsNotNone(order)
@@ -115,6 +129,18 @@ class TestOrders(TestCase):
         mock_set_order_number.assert_not_called()
         logger.debug("redcap.set_order_number was not called due to GBF failure.")
     
+    @patch("track.orders.gbf.create_order", side_effect=requests.exceptions.ReadTimeout("Read timed out."))
+    @patch("track.orders.redcap.get_record_info", return_value={"contact_complete": "2"})
+    def test_place_order_gbf_exception_resets_order(self, mock_get_record_info, mock_create_order):
+        """
+        Test that an order is set back to pending if the request to GBF fails, so it can be claimed again.
+        """
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            place_order(self.record_id, self.project_id, self.project_url)
+
+        self.assertEqual(Order.objects.get(record_id=self.record_id).order_status, Order.PENDING)
+        self.assertTrue(_claim_order(self.record_id, self.project_id, self.project_url)[1])
+
     @patch("track.orders.redcap.set_order_number")
     def test_store_order_number_in_redcap(self, mock_set_order_number):
         """
@@ -212,4 +238,274 @@ class TestOrders(TestCase):
         self.assertEqual(updated_order.tracking_nrs, ["TRACK999"])
         self.assertEqual(updated_order.return_tracking_nrs, ["RET999"])
         self.assertEqual(updated_order.tube_serials, ["TUBE999"])
-        logger.debug("Order %s successfully updated with shipping info.", updated_order.order_number)
\ No newline at end of file
+        logger.debug("Order %s successfully updated with shipping info.", updated_order.order_number)
+
+    @patch("track.orders.gbf.create_orders")
+    @patch("track.orders.redcap.set_order_number")
+    @patch("track.orders.redcap.get_records_info")
+    def test_place_orders(self, mock_get_records_info, mock_set_order_number, mock_create_orders):
+        """
+        Test that place_orders submits all complete records in one batch and updates
+        each order according to the outcome GBF reported for it.
+        """
+        mock_get_records_info.return_value = {
+            "1": {"contact_complete": "2"},
+            "2": {"contact_complete": "2"},
+            "3": {"contact_complete": "1"},
+        }
+
+        def fake_create_orders(orders_with_address):
+            for order, _ in orders_with_address:
+                order.order_number = "EDROP-%05d" % order.pk
+            return {orders_with_address[0][0].order_number: True, orders_with_address[1][0].order_number: False}
+        mock_create_orders.side_effect = fake_create_orders
+
+        result = place_orders([("1", self.project_id, self.project_url), ("2", self.project_id, self.project_url), ("3", self.project_id, self.project_url)])
+
+        mock_create_orders.assert_called_once()
+        self.assertEqual(result["3"], (None, False))
+        self.assertEqual(Order.objects.get(record_id="1").order_status, Order.INITIATED)
+        self.assertEqual(Order.objects.get(record_id="2").order_status, Order.PENDING)
+        self.assertFalse(Order.objects.filter(record_id="3").exists())
+        mock_set_order_number.assert_called_once_with("1", result["1"][0].order_number)
+
+    @patch("track.orders.gbf.create_orders")
+    @patch("track.orders.redcap.set_order_number")
+    @patch("track.orders.redcap.get_records_info")
+    def test_place_orders_duplicate_record(self, mock_get_records_info, mock_set_order_number, mock_create_orders):
+        """
+        Test that a record that is in a batch twice is only sent to GBF and written back to REDCap once.
+        """
+        mock_get_records_info.return_value = {"1": {"contact_complete": "2"}}
+        mock_create_orders.side_effect = lambda orders_with_address: {order.order_number: True for order, _ in orders_with_address}
+
+        result = place_orders([("1", self.project_id, self.project_url), ("1", self.project_id, self.project_url)])
+
+        mock_get_records_info.assert_called_once_with(["1"])
+        orders_with_address = mock_create_orders.call_args[0][0]
+        logger.debug("Orders sent to GBF: %s", orders_with_address)
+        self.assertEqual(len(orders_with_address), 1)
+        mock_set_order_number.assert_called_once_with("1", result["1"][0].order_number)
+        self.assertEqual(Order.objects.filter(record_id="1").count(), 1)
+
+    def test_claim_new_order_writes(self):
+        """
+        Test that a new order is created initiated and with its order number in one INSERT, and that
+        its log is opened in the same transaction.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            order, claimed = _claim_order(self.record_id, self.project_id, self.project_url)
+
+        writes = [query['sql'] for query in queries if "INSERT INTO" in query['sql'] or query['sql'].lstrip().startswith("UPDATE")]
+        logger.debug("Writes when claiming a new order: %s", writes)
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(claimed)
+        order.refresh_from_db()
+        self.assertEqual(order.order_number, "EDROP-%05d" % order.pk)
+        self.assertEqual(order.order_status, Order.INITIATED)
+        self.assertIsNotNone(order.next_poll_at)
+        self.assertTrue(OrderLog.objects.filter(order_number=order.order_number, is_complete=False).exists())
+
+        # an order that has been claimed is not claimed again
+        self.assertFalse(_claim_order(self.record_id, self.project_id, self.project_url)[1])
+
+    def test_claim_pending_order(self):
+        """
+        Test that an order that could not be placed keeps its order number when it is claimed again.
+        """
+        order = Order.objects.create(record_id=self.record_id, project_id=self.project_id, order_status=Order.PENDING, order_number="EDROP-00007")
+        OrderLog.objects.create(order_number="EDROP-00007")
+
+        claimed_order, claimed = _claim_order(self.record_id, self.project_id, self.project_url)
+
+        self.assertTrue(claimed)
+        self.assertEqual(claimed_order.pk, order.pk)
+        self.assertEqual(claimed_order.order_number, "EDROP-00007")
+        self.assertEqual(Order.objects.get(pk=order.pk).order_status, Order.INITIATED)
+        self.assertEqual(OrderLog.objects.filter(order_number="EDROP-00007", is_complete=False).count(), 1)
+        self.assertEqual(OrderLog.objects.filter(order_number="EDROP-00007", is_complete=True).count(), 1)
+
+    def _create_initiated_orders(self, start, count):
+        tracking_info = {}
+        for i in range(start, start + count):
+            Order.objects.create(record_id=str(i), project_id=self.project_id, order_status=Order.INITIATED, order_number=f"EDROP-{i:05d}")
+            tracking_info[f"EDROP-{i:05d}"] = {
+                "date_kit_shipped": "2025-04-01" if i % 2 else None,
+                "kit_tracking_n": [f"TRACK{i}"],
+                "return_tracking_n": None,
+                "tube_serial_n": [f"TUBE{i}"]
+            }
+        return tracking_info
+
+    def test_update_orders_with_shipping_info_bulk(self):
+        """
+        Test that the number of queries does not grow with the number of orders and that
+        orders that do not exist or have not shipped are skipped.
+        """
+        tracking_info = self._create_initiated_orders(0, 10)
+        tracking_info["EDROP-99999"] = tracking_info["EDROP-00001"]
+        with count_queries() as counter:
+            shipped_orders = _update_orders_with_shipping_info(tracking_info)
+
+        more_tracking_info = self._create_initiated_orders(100, 50)
+        more_tracking_info["EDROP-99998"] = tracking_info["EDROP-00001"]
+        with count_queries() as counter_more_orders:
+            _update_orders_with_shipping_info(more_tracking_info)
+
+        self.assertEqual(counter.count, counter_more_orders.count)
+        self.assertEqual(len(shipped_orders), 5)
+        self.assertNotIn("EDROP-99999", shipped_orders)
+        order = Order.objects.get(order_number="EDROP-00003")
+        self.assertEqual(order.order_status, Order.SHIPPED)
+        self.assertEqual(order.tracking_nrs, ["TRACK3"])
+        self.assertIsNone(order.return_tracking_nrs)
+        self.assertEqual(Order.objects.get(order_number="EDROP-00002").order_status, Order.INITIATED)
+
+    @override_settings(ORDER_UPDATE_CHUNK_SIZE=2)
+    def test_update_orders_with_shipping_info_chunks(self):
+        tracking_info = self._create_initiated_orders(0, 10)
+
+        shipped_orders = _update_orders_with_shipping_info(tracking_info)
+
+        self.assertEqual(len(shipped_orders), 5)
+        self.assertEqual(Order.objects.filter(order_status=Order.SHIPPED).count(), 5)
+
+    def test_update_orders_with_shipping_info_log_messages(self):
+        """
+        Test that orders that are set to shipped and shipped orders whose shipping info changed
+        are reported separately.
+        """
+        tracking_info = self._create_initiated_orders(0, 4)
+        _update_orders_with_shipping_info(tracking_info)
+
+        tracking_info["EDROP-00001"]["kit_tracking_n"] = ["TRACK1-NEW"]
+        tracking_info["EDROP-00002"]["date_kit_shipped"] = "2025-04-02"
+        with self.assertLogs("track.orders", level="INFO") as logs:
+            _update_orders_with_shipping_info(tracking_info)
+
+        logger.debug("Log messages: %s", logs.output)
+        self.assertIn("INFO:track.orders:Updated order status for order numbers ['EDROP-00002'] to Shipped.", logs.output)
+        self.assertIn("INFO:track.orders:Updated shipping info of already shipped orders ['EDROP-00001'].", logs.output)
+
+    @override_settings(GBF_POLL_MIN_INTERVAL=3600, GBF_POLL_MAX_INTERVAL=86400, GBF_POLL_BACKOFF_FACTOR=2, GBF_POLL_AGE_FACTOR=0.1)
+    def test_get_next_poll_at(self):
+        """
+        Test that the time between checks grows with the number of checks and the age of the order
+        and stays between GBF_POLL_MIN_INTERVAL and GBF_POLL_MAX_INTERVAL.
+        """
+        now = timezone.now()
+        order = Order(initiated_at=now, poll_count=0)
+        self.assertEqual(get_next_poll_at(order, now), now + timedelta(hours=1))
+
+        order.poll_count = 3
+        self.assertEqual(get_next_poll_at(order, now), now + timedelta(hours=8))
+
+        order.poll_count = 100
+        self.assertEqual(get_next_poll_at(order, now), now + timedelta(days=1))
+
+        order = Order(initiated_at=now - timedelta(days=5), poll_count=1)
+        self.assertEqual(get_next_poll_at(order, now), now + timedelta(hours=12))
+
+    @patch("track.orders.redcap.set_tracking_info")
+    @patch("track.orders.gbf.get_order_confirmations")
+    def test_check_orders_shipping_info_only_due_orders(self, mock_get_order_confirmations, mock_set_tracking_info):
+        """
+        Test that only orders that are due are checked and that orders that have not shipped are
+        scheduled for their next check.
+        """
+        now = timezone.now()
+        tracking_info = self._create_initiated_orders(0, 4)
+        Order.objects.filter(order_number="EDROP-00003").update(next_poll_at=now + timedelta(days=1))
+        mock_get_order_confirmations.return_value = {number: tracking_info[number] for number in ["EDROP-00000", "EDROP-00001"]}
+
+        check_orders_shipping_info()
+
+        mock_get_order_confirmations.assert_called_once()
+        self.assertCountEqual(mock_get_order_confirmations.call_args.args[0], ["EDROP-00000", "EDROP-00001", "EDROP-00002"])
+        shipped_order = Order.objects.get(order_number="EDROP-00001")
+        self.assertEqual(shipped_order.order_status, Order.SHIPPED)
+        self.assertEqual(shipped_order.poll_count, 0)
+        for order_number in ["EDROP-00000", "EDROP-00002"]:
+            order = Order.objects.get(order_number=order_number)
+            self.assertEqual(order.poll_count, 1)
+            self.assertGreater(order.next_poll_at, now)
+        self.assertEqual(Order.objects.get(order_number="EDROP-00003").poll_count, 0)
+
+    @override_settings(TRACKING_JOB_MIN_INTERVAL=300, TRACKING_JOB_MAX_INTERVAL=86400, TRACKING_JOB_TARGET_DUE_ORDERS=3)
+    def test_get_tracking_check_interval(self):
+        """
+        Test that the next check starts when the target number of orders is due, within the
+        minimum and maximum interval.
+        """
+        now = timezone.now()
+        self.assertEqual(get_tracking_check_interval(now), (86400, 0))
+
+        self._create_initiated_orders(0, 4)
+        Order.objects.filter(order_number__in=["EDROP-00001", "EDROP-00002"]).update(next_poll_at=now + timedelta(hours=2))
+        Order.objects.filter(order_number="EDROP-00003").update(next_poll_at=now + timedelta(hours=1))
+        self.assertEqual(get_tracking_check_interval(now), (7200, 1))
+
+        Order.objects.filter(order_number__in=["EDROP-00001", "EDROP-00003"]).update(next_poll_at=now + timedelta(seconds=10))
+        self.assertEqual(get_tracking_check_interval(now), (300, 1))
+
+        Order.objects.update(next_poll_at=None)
+        self.assertEqual(get_tracking_check_interval(now), (300, 4))
+
+
+@override_settings(REDCAP_INSTRUMENT_ID="contact", REDCAP_FIELD_TO_BE_COMPLETE="contact_complete", ORDER_PLACEMENT_MODE="webhook")
+class TestConcurrentPlacement(TransactionTestCase):
+    """
+    Places the same orders from many threads at the same time (each with its own database connection,
+    like several workers would) against the stand-in servers, and checks that GBF gets each order once.
+    """
+    calls_per_record = 10
+    record_ids = ["1", "2", "3"]
+
+    def setUp(self):
+        self.server = standin.start_server(records=len(self.record_ids), seed=1, gbf=standin.ServiceConfig(latency=0.05))
+        self.settings_override = override_settings(GBF_URL=self.server.gbf_url, REDCAP_URL=self.server.redcap_url)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        http_client.close_sessions()
+
+    def _run_concurrently(self, func):
+        calls = [record_id for record_id in self.record_ids for _ in range(self.calls_per_record)]
+        barrier = threading.Barrier(len(calls))
+
+        def run(record_id):
+            try:
+                barrier.wait()
+                return func(record_id)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+            return list(executor.map(run, calls))
+
+    def test_concurrent_webhooks(self):
+        def post(record_id):
+            return Client().post("/api/order/create", {"instrument": "contact", "contact_complete": "2", "record": record_id, "project_id": "1"})
+
+        responses = self._run_concurrently(post)
+
+        logger.debug("Response status codes: %s", [response.status_code for response in responses])
+        self.assertEqual(sum(response.status_code == 201 for response in responses), len(self.record_ids))
+        self.assertEqual(self.server.request_counts["gbf:order"], len(self.record_ids))
+        self.assertEqual(sorted(self.server.orders), sorted(Order.objects.values_list('order_number', flat=True)))
+
+    def test_concurrent_place_order(self):
+        """
+        Test that orders are placed once even if the webhook de-duplication is bypassed (e.g. the order
+        worker and the webhook placing the same order).
+        """
+        placed = self._run_concurrently(lambda record_id: place_order(record_id, "1", "http://example.com/project"))
+
+        self.assertEqual(Order.objects.count(), len(self.record_ids))
+        self.assertEqual(self.server.request_counts["gbf:order"], len(self.record_ids))
+        self.assertEqual(len(self.server.orders), len(self.record_ids))
+        self.assertTrue(all(order.order_status == Order.INITIATED for order, _ in placed))
+        self.assertEqual(sum(claimed for _, claimed in placed), len(self.record_ids))
@@ -7,6 +7,8 @@ from django.conf import settings
 from track.models import Order
 from track.redcap import (
     get_record_info,
+    get_records_info,
+    iter_complete_record_ids,
     set_order_number,
     set_tracking_info
 )
@@ -50,7 +52,7 @@ class TestRedcapFunctions(TestCase):
         )
         logger.debug("TestRedcapFunctions: Created order_for_shipping with record_id=%s", self.record_id)
 
-    @patch("track.redcap.requests.post")
+    @patch("track.redcap.http_client.post")
     def test_get_record_info_success(self, mock_post):
         """
         Test get_record_info returns a dict when the request is successful (HTTP 200).
@@ -82,7 +84,7 @@ class TestRedcapFunctions(TestCase):
         self.assertEqual(kwargs["data"]["records[0]"], self.record_id)
         logger.debug("test_get_record_info_success completed successfully.")
 
-    @patch("track.redcap.requests.post")
+    @patch("track.redcap.http_client.post")
     def test_get_record_info_failure(self, mock_post):
         """
         Test get_record_info raises REDCapError if the response is not HTTP 200.
@@ -101,7 +103,36 @@ class TestRedcapFunctions(TestCase):
         self.assertEqual(str(context.exception), "REDCap returned 500.")
         logger.debug("test_get_record_info_failure completed successfully.")
 
-    @patch("track.redcap.requests.post")
+    @override_settings(REDCAP_EXPORT_CHUNK_SIZE=2, REDCAP_EXPORT_MAX_WORKERS=2)
+    @patch("track.redcap.http_client.post")
+    def test_get_records_info(self, mock_post):
+        """
+        Test get_records_info exports the records in chunks and returns them keyed by record id.
+        """
+        def fake_post(url, endpoint=None, data=None):
+            record_ids = [value for key, value in data.items() if key.startswith("records[")]
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            mock_response.json.return_value = [{"record_id": record_id, "contact_complete": "2"} for record_id in record_ids if record_id != "4"]
+            return mock_response
+        mock_post.side_effect = fake_post
+
+        result = get_records_info(["1", "2", "3", "4", "1"])
+
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(set(result.keys()), {"1", "2", "3"})
+        self.assertEqual(result["3"]["record_id"], "3")
+
+    @patch("track.redcap.http_client.post")
+    def test_get_records_info_failure(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.status_code = 403
+        mock_post.return_value = mock_response
+
+        with self.assertRaises(REDCapError):
+            get_records_info(["1", "2"])
+
+    @patch("track.redcap.http_client.post")
     def test_set_order_number_success(self, mock_post):
         """
         Test set_order_number logs success on a 200 response.
@@ -129,7 +160,7 @@ class TestRedcapFunctions(TestCase):
         self.assertIn(f"<kit_order_n>{self.order_number}</kit_order_n>", xml_payload)
         logger.debug("test_set_order_number_success completed successfully.")
 
-    @patch("track.redcap.requests.post")
+    @patch("track.redcap.http_client.post")
     def test_set_order_number_failure(self, mock_post):
         """
         Test set_order_number raises REDCapError on a non-200 response.
@@ -147,7 +178,7 @@ class TestRedcapFunctions(TestCase):
         mock_post.assert_called_once()
         logger.debug("test_set_order_number_failure completed successfully.")
 
-    @patch("track.redcap.requests.post")
+    @patch("track.redcap.http_client.post")
     def test_set_tracking_info_success(self, mock_post):
         """
         Test set_tracking_info builds correct XML and sends to REDCap.
@@ -176,7 +207,7 @@ class TestRedcapFunctions(TestCase):
         self.assertIn("<kit_status>TRN</kit_status>", xml_payload)
         logger.debug("test_set_tracking_info_success completed successfully.")
 
-    @patch("track.redcap.requests.post")
+    @patch("track.redcap.http_client.post")
     def test_set_tracking_info_no_orders(self, mock_post):
         """
         Test set_tracking_info does nothing if no shipped orders are provided.
@@ -187,7 +218,7 @@ class TestRedcapFunctions(TestCase):
         mock_post.assert_not_called()
         logger.debug("test_set_tracking_info_no_orders completed successfully.")
 
-    @patch("track.redcap.requests.post")
+    @patch("track.redcap.http_client.post")
     def test_set_tracking_info_failure(self, mock_post):
         """
         Test set_tracking_info raises REDCapError on a non-200 response.
@@ -204,4 +235,70 @@ class TestRedcapFunctions(TestCase):
         
         self.assertEqual(str(context.exception), "REDCap returned 400.")
         mock_post.assert_called_once()
-        logger.debug("test_set_tracking_info_failure completed successfully.")
\ No newline at end of file
+        logger.debug("test_set_tracking_info_failure completed successfully.")
+    @override_settings(REDCAP_IMPORT_CHUNK_SIZE=2, REDCAP_IMPORT_MAX_WORKERS=2)
+    @patch("track.redcap.http_client.post")
+    def test_set_tracking_info_in_batches(self, mock_post):
+        """
+        Test set_tracking_info sends one request per REDCAP_IMPORT_CHUNK_SIZE orders.
+        """
+        for record_id in ["124", "125"]:
+            Order.objects.create(project_id="ABC123", record_id=record_id, order_status=Order.SHIPPED,
+                                 ship_date="2025-02-15", tracking_nrs=["1Z"], return_tracking_nrs=["9"], tube_serials=["T"])
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_post.return_value = mock_response
+
+        set_tracking_info(Order.objects.order_by("record_id"))
+
+        self.assertEqual(mock_post.call_count, 2)
+        payloads = sorted(call.kwargs["data"]["data"] for call in mock_post.call_args_list)
+        self.assertEqual(payloads[0].count("<item>"), 2)
+        self.assertEqual(payloads[1].count("<item>"), 1)
+        self.assertTrue(all(payload.startswith("<records>") and payload.endswith("</records>") for payload in payloads))
+
+    @override_settings(REDCAP_IMPORT_MAX_ATTEMPTS=3, REDCAP_IMPORT_RETRY_DELAY=0)
+    @patch("track.redcap.http_client.post")
+    def test_set_tracking_info_retries_server_errors(self, mock_post):
+        """
+        Test set_tracking_info retries a batch when REDCap returns a server error.
+        """
+        failed_response = MagicMock()
+        failed_response.status_code = 503
+        ok_response = MagicMock()
+        ok_response.status_code = 200
+        mock_post.side_effect = [failed_response, ok_response]
+
+        set_tracking_info(Order.objects.filter(ship_date__isnull=False))
+
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("track.redcap.http_client.post")
+    def test_iter_complete_record_ids(self, mock_post):
+        """
+        Test that records are parsed as the export is received, even if a chunk ends within a record.
+        """
+        body = json.dumps([{"record_id": str(i)} for i in range(1, 4)], indent=1).encode()
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.iter_content.return_value = [body[i:i + 7] for i in range(0, len(body), 7)]
+        mock_post.return_value = mock_response
+
+        record_ids = list(iter_complete_record_ids())
+
+        self.assertEqual(record_ids, ["1", "2", "3"])
+        self.assertEqual(mock_post.call_args.kwargs["data"]["filterLogic"], '[contact_complete] = "2"')
+        self.assertTrue(mock_post.call_args.kwargs["stream"])
+
+    @patch("track.redcap.http_client.post")
+    def test_iter_complete_record_ids_incomplete_export(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.iter_content.return_value = [b'[{"record_id": "1"}, {"record_id": "2"']
+        mock_post.return_value = mock_response
+
+        record_ids = iter_complete_record_ids()
+
+        self.assertEqual(next(record_ids), "1")
+        with self.assertRaises(REDCapError):
+            next(record_ids)
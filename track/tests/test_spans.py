@@ -0,0 +1,86 @@
+import logging
+from unittest.mock import patch
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from track import spans
+from track.models import *
+from track.orders import place_order
+from track.utils import Percentile
+
+logger = logging.getLogger(__name__)
+
+
+class TestSpans(TestCase):
+    def test_nested_spans(self):
+        with spans.trace("outer") as trace:
+            with spans.span("first"):
+                with spans.span("inner"):
+                    pass
+            with spans.span("second"):
+                pass
+
+        logger.debug("Recorded spans: %s", trace.spans)
+        self.assertEqual([(name, depth) for name, depth, _, _ in trace.spans],
+                         [("outer", 0), ("first", 1), ("inner", 2), ("second", 1)])
+        outer, first, inner, second = trace.spans
+        self.assertGreaterEqual(inner[2], first[2])
+        self.assertGreaterEqual(second[2], first[2] + first[3])
+        self.assertGreaterEqual(outer[2] + outer[3], second[2] + second[3])
+
+    def test_span_without_trace(self):
+        @spans.span("not traced")
+        def add(a, b):
+            return a + b
+
+        self.assertEqual(add(1, 2), 3)
+        self.assertIsNone(spans._current_trace.get())
+
+    @override_settings(REDCAP_FIELD_TO_BE_COMPLETE="contact_complete")
+    @patch("track.orders.redcap.set_order_number")
+    @patch("track.gbf._check_order_response", return_value=True)
+    @patch("track.gbf._place_order_with_GBF")
+    @patch("track.orders.redcap.get_record_info")
+    def test_place_order_saves_spans(self, mock_get_record_info, mock_place_order_with_gbf, mock_check_order_response, mock_set_order_number):
+        """
+        Test that the stages of placing an order are stored with the OrderLog of the order.
+        """
+        mock_get_record_info.return_value = {"contact_complete": "2", "first_name": "John", "last_name": "Doe",
+            "street_1": "742 Evergreen Terrace", "street_2": "", "city": "Springfield", "state": "IL", "zip": "62704"}
+
+        order, _ = place_order("123", "1", "http://example.com/project")
+
+        log = OrderLog.objects.filter(order_number=order.order_number).latest('pk')
+        names = list(log.spans.values_list('name', flat=True))
+        logger.debug("Stored spans: %s", names)
+        self.assertEqual(names[0], "orders.place_order")
+        for name in ["redcap.get_record_info", "db.save_order", "gbf.create_order", "gbf._place_order_with_GBF", "redcap.set_order_number"]:
+            self.assertIn(name, names)
+        self.assertEqual(log.spans.get(name="gbf._place_order_with_GBF").depth, 2)
+
+        # placing the order again does not claim it, so no spans are added to its log
+        _, claimed = place_order("123", "1", "http://example.com/project")
+        self.assertFalse(claimed)
+        self.assertEqual(TimingSpan.objects.filter(name="orders.place_order").count(), 1)
+
+    def test_percentile(self):
+        log = OrderLog.objects.create(order_number="EDROP-00001")
+        TimingSpan.objects.bulk_create([TimingSpan(order_log=log, name="stage", depth=0, start_offset=0, duration=d) for d in range(1, 101)])
+
+        stats = TimingSpan.objects.aggregate(p50=Percentile('duration', 0.5), p95=Percentile('duration', 0.95))
+
+        self.assertAlmostEqual(stats['p50'], 50.5)
+        self.assertAlmostEqual(stats['p95'], 95.05)
+
+    def test_admin(self):
+        log = OrderLog.objects.create(order_number="EDROP-00001")
+        TimingSpan.objects.create(order_log=log, name="orders.place_order", depth=0, start_offset=0, duration=0.5)
+        TimingSpan.objects.create(order_log=log, name="gbf.create_order", depth=1, start_offset=0.1, duration=0.25)
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+
+        response = self.client.get(f"/admin/track/orderlog/{log.pk}/change/")
+        self.assertContains(response, "margin-left:20.0%;width:50.0%")
+
+        response = self.client.get("/admin/track/timingspan/")
+        self.assertContains(response, "Duration per stage")
+        self.assertEqual(len(response.context['stage_stats']), 2)
@@ -0,0 +1,201 @@
+import asyncio, logging, random
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from track import gbf, jobs, orders, redcap, standin, http_client
+from track.exceptions import REDCapError
+from track.models import *
+
+logger = logging.getLogger(__name__)
+
+
+def create_initiated_orders(record_ids):
+    """
+    Creates initiated orders with their order numbers, like `orders.place_orders` claims them.
+    """
+    created = [Order.objects.create(record_id=record_id, project_id="1", order_status=Order.INITIATED) for record_id in record_ids]
+    for order in created:
+        order.order_number = gbf._generate_order_number(order)
+    Order.objects.bulk_update(created, ['order_number'])
+    return created
+
+
+class TestStandIn(TestCase):
+    def setUp(self):
+        self.server = standin.start_server(records=5, seed=1)
+        self.settings_override = override_settings(GBF_URL=self.server.gbf_url, REDCAP_URL=self.server.redcap_url,
+                                                   REDCAP_IMPORT_RETRY_DELAY=0)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        http_client.close_sessions()
+
+    def test_pipeline(self):
+        """
+        Test that orders can be placed, confirmed, and written back using the stand-in servers.
+        """
+        records = redcap.get_records_info(["1", "2", "99"])
+        self.assertEqual(sorted(records), ["1", "2"])
+        self.assertEqual(records["1"]["contact_complete"], "2")
+
+        orders = create_initiated_orders(records)
+        placed = gbf.create_orders([(order, records[order.record_id]) for order in orders])
+        self.assertTrue(all(placed.values()))
+
+        tracking_info = gbf.get_order_confirmations([order.order_number for order in orders])
+        self.assertEqual(sorted(tracking_info), sorted(order.order_number for order in orders))
+        self.assertTrue(tracking_info[orders[0].order_number]["date_kit_shipped"])
+
+        orders[0].ship_date = tracking_info[orders[0].order_number]["date_kit_shipped"]
+        orders[0].tracking_nrs = tracking_info[orders[0].order_number]["kit_tracking_n"]
+        redcap.set_tracking_info([orders[0]])
+        self.assertEqual(self.server.records["1"]["kit_tracking_n"], orders[0].tracking_nrs[0])
+        self.assertEqual(self.server.request_counts, {"redcap": 2, "gbf:order": 1, "gbf:confirm2": 1})
+
+    @override_settings(SHIPPING_INFO_CHECK_MODE="pipeline", GBF_CONFIRMATION_CHUNK_SIZE=2, GBF_CONFIRMATION_MAX_WORKERS=2)
+    def test_check_shipping_info_in_micro_batches(self):
+        """
+        Test that in pipeline mode, every batch of orders is updated and sent to REDCap on its own.
+        """
+        placed = create_initiated_orders(self.server.records)
+        gbf.create_orders([(order, self.server.records[order.record_id]) for order in placed])
+        ConfirmationCheckLog.objects.create(job_id="test")
+
+        orders.check_orders_shipping_info()
+
+        self.assertEqual(Order.objects.filter(order_status=Order.SHIPPED).count(), 5)
+        for order in Order.objects.all():
+            self.assertEqual(self.server.records[order.record_id]["kit_tracking_n"], ", ".join(order.tracking_nrs))
+        # three batches of up to two orders, each sent to REDCap on its own
+        self.assertEqual(self.server.request_counts, {"gbf:order": 1, "gbf:confirm2": 3, "redcap": 3})
+
+    @override_settings(RECONCILIATION_PAGE_SIZE=2, REDCAP_EXPORT_STREAM_CHUNK_SIZE=16)
+    def test_reconcile_orders(self):
+        """
+        Test that jobs are queued for complete records that have not been ordered.
+        """
+        self.server.records["4"]["contact_complete"] = "0"
+        Order.objects.create(record_id="1", project_id="1", order_status=Order.INITIATED, order_number="EDROP-00001")
+
+        checked, queued = jobs.reconcile_orders()
+
+        self.assertEqual((checked, queued), (4, 3))
+        self.assertCountEqual(OrderJob.objects.values_list('record_id', 'project_id'), [("2", "1"), ("3", "1"), ("5", "1")])
+        self.assertEqual(self.server.request_counts, {"redcap": 2})
+
+    async def test_async_place_order(self):
+        """
+        Test that several orders can be placed at the same time with the async client.
+        """
+        placed = await asyncio.gather(*[orders.async_place_order(record_id, "1", "http://example.com") for record_id in ["1", "2", "3"]])
+        await http_client.close_async_clients()
+
+        self.assertEqual([order.order_status for order, _ in placed], [Order.INITIATED] * 3)
+        self.assertEqual(self.server.records["2"]["kit_order_n"], placed[1][0].order_number)
+        self.assertEqual(self.server.request_counts, {"redcap": 6, "gbf:order": 3})
+        self.assertEqual(await TimingSpan.objects.filter(order_log__order_number=placed[0][0].order_number).acount(), 8)
+
+    @override_settings(ORDER_PLACEMENT_MODE="webhook", REDCAP_INSTRUMENT_ID="contact", REDCAP_FIELD_TO_BE_COMPLETE="contact_complete")
+    def test_webhook_places_order(self):
+        response = self.client.post("/api/order/create", {"instrument": "contact", "contact_complete": "2", "record": "1", "project_id": "1"})
+
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(record_id="1")
+        self.assertEqual(response.json()["order"], order.order_number)
+        self.assertEqual(order.order_status, Order.INITIATED)
+        self.assertFalse(OrderJob.objects.exists())
+
+    @override_settings(ORDER_PLACEMENT_MODE="webhook", REDCAP_INSTRUMENT_ID="contact", REDCAP_FIELD_TO_BE_COMPLETE="contact_complete")
+    def test_webhook_queues_failed_order(self):
+        self.server.gbf = standin.ServiceConfig(error_rate=1.0)
+
+        response = self.client.post("/api/order/create", {"instrument": "contact", "contact_complete": "2", "record": "1", "project_id": "1"})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Order.objects.get(record_id="1").order_status, Order.PENDING)
+        self.assertEqual(OrderJob.objects.get().record_id, "1")
+
+    def test_ship_delay(self):
+        self.server.ship_delay = 3600
+        order, = create_initiated_orders(["1"])
+        gbf.create_orders([(order, self.server.records["1"])])
+
+        self.assertIsNone(gbf.get_order_confirmations([order.order_number]))
+
+    def test_error_rate(self):
+        self.server.redcap = standin.ServiceConfig(error_rate=1.0)
+
+        with self.assertRaises(REDCapError):
+            redcap.get_records_info(["1"])
+
+    def test_latency_distributions(self):
+        rng = random.Random(1)
+        for distribution in standin.LATENCY_DISTRIBUTIONS:
+            config = standin.ServiceConfig(latency=0.1, distribution=distribution)
+            latencies = [config.draw_latency(rng) for _ in range(2000)]
+            self.assertAlmostEqual(sum(latencies) / len(latencies), 0.1, delta=0.01)
+
+
+@override_settings(GBF_CONFIRMATION_CHUNK_SIZE=2)
+class TestRequestedShippingInfoCheck(TestCase):
+    """
+    Checks started in the admin are only requested by the view and run by the scheduler.
+    """
+    def setUp(self):
+        cache.clear()
+        self.server = standin.start_server(records=5, seed=1)
+        self.settings_override = override_settings(GBF_URL=self.server.gbf_url, REDCAP_URL=self.server.redcap_url)
+        self.settings_override.enable()
+        placed = create_initiated_orders(self.server.records)
+        gbf.create_orders([(order, self.server.records[order.record_id]) for order in placed])
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        http_client.close_sessions()
+
+    def test_check_order_status(self):
+        response = self.client.post(reverse("admin:track_check_order_status"))
+        log = ConfirmationCheckLog.objects.get(job_id=orders.ADMIN_JOB_ID)
+        self.assertRedirects(response, reverse("admin:track_check_order_status_progress", args=[log.id]))
+        self.assertFalse(orders.claim_shipping_info_check())
+        self.assertEqual(self.server.request_counts.get("gbf:confirm2"), None)
+
+        self.assertTrue(orders.run_requested_shipping_info_check())
+
+        status = self.client.get(reverse("admin:track_check_order_status_status", args=[log.id])).json()
+        self.assertEqual(status, {"is_complete": True, "chunks_total": 3, "chunks_done": 3, "orders_updated": 5, "redcap_batches": 1})
+        self.assertEqual(Order.objects.filter(order_status=Order.SHIPPED).count(), 5)
+        self.assertTrue(orders.claim_shipping_info_check())
+        self.assertContains(self.client.get(reverse("admin:track_check_order_status_progress", args=[log.id])), "Finished.")
+
+    def test_check_order_status_already_running(self):
+        self.assertTrue(orders.claim_shipping_info_check())
+        running_log = ConfirmationCheckLog.objects.create(job_id="scheduled")
+
+        response = self.client.post(reverse("admin:track_check_order_status"))
+
+        self.assertRedirects(response, reverse("admin:track_check_order_status_progress", args=[running_log.id]))
+        self.assertEqual(ConfirmationCheckLog.objects.count(), 1)
+        self.assertFalse(orders.run_requested_shipping_info_check())
+        self.assertEqual(self.server.request_counts.get("gbf:confirm2"), None)
+
+    def test_release_stale_check(self):
+        self.assertTrue(orders.claim_shipping_info_check())
+
+        self.assertTrue(orders.release_stale_shipping_info_check())
+        self.assertTrue(orders.claim_shipping_info_check())
+
+    def test_release_stale_check_keeps_requested_check(self):
+        self.client.post(reverse("admin:track_check_order_status"))
+
+        self.assertFalse(orders.release_stale_shipping_info_check())
+        self.assertFalse(orders.claim_shipping_info_check())
+        self.assertTrue(orders.run_requested_shipping_info_check())
@@ -0,0 +1,64 @@
+import logging
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from track import statistics
+from track.models import *
+from track.utils import count_queries
+
+logger = logging.getLogger(__name__)
+
+
+@override_settings(REQUEST_TIMEZONE="UTC", ORDER_STATISTICS_DAYS=30)
+class TestStatistics(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        for i, days_to_ship in enumerate([1, 2, 3, 10]):
+            initiated_at = self.now - timedelta(days=20)
+            Order.objects.create(record_id=str(i), project_id="1", order_status=Order.SHIPPED, initiated_at=initiated_at,
+                                 ship_date=(initiated_at + timedelta(days=days_to_ship)).date().isoformat())
+        Order.objects.create(record_id="10", project_id="1", order_status=Order.INITIATED, initiated_at=self.now)
+        Order.objects.create(record_id="11", project_id="1", order_status=Order.PENDING)
+        # ship dates that aren't dates are not counted
+        Order.objects.create(record_id="12", project_id="1", order_status=Order.DONE, initiated_at=self.now, ship_date="unknown")
+
+    def test_refresh(self):
+        statistics.refresh()
+
+        dashboard = statistics.get_dashboard()
+        self.assertEqual(dashboard['status_counts'], [("Pending", 1), ("Initiated", 1), ("Kit has shipped", 4), ("Completed", 1)])
+        self.assertEqual([percentile for percentile, _ in dashboard['days_to_ship']], ["p50", "p90", "p95"])
+        self.assertAlmostEqual(dict(dashboard['days_to_ship'])["p50"], 2.5)
+        today = self.now.date().isoformat()
+        initiated_day = (self.now - timedelta(days=20)).date().isoformat()
+        self.assertEqual(dashboard['days'][0], (today, 2, 0))
+        self.assertIn((initiated_day, 4, 0), dashboard['days'])
+        self.assertEqual(sum(shipped for _, _, shipped in dashboard['days']), 4)
+        self.assertIsNotNone(dashboard['refreshed_at'])
+
+    def test_refresh_replaces_statistics(self):
+        statistics.refresh()
+        Order.objects.filter(order_status=Order.PENDING).delete()
+        statistics.refresh()
+
+        self.assertEqual(dict(statistics.get_dashboard()['status_counts'])["Pending"], 0)
+
+    def test_dashboard(self):
+        """
+        Test that the dashboard only reads the precomputed statistics, however many orders there are.
+        """
+        statistics.refresh()
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+
+        with count_queries() as counter:
+            response = self.client.get("/admin/track/orderstatistic/")
+        Order.objects.bulk_create([Order(record_id=f"more{i}", project_id="1", order_status=Order.INITIATED) for i in range(100)])
+        statistics.refresh()
+        with count_queries() as more_orders_counter:
+            self.client.get("/admin/track/orderstatistic/")
+
+        self.assertContains(response, "Kit has shipped")
+        self.assertContains(response, "p95")
+        self.assertEqual(counter.count, more_orders_counter.count)
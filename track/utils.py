@@ -0,0 +1,56 @@
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Aggregate, FloatField
+
+
+class QueryCounter:
+    """
+    Counts the queries that are executed on a database connection. Unlike
+    `django.test.utils.CaptureQueriesContext`, this also works when DEBUG is off.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def count_queries(using=DEFAULT_DB_ALIAS):
+    """
+    Context manager that counts the queries executed inside of it, e.g.:
+
+    with count_queries() as counter:
+        Order.objects.count()
+    counter.count  # 1
+    """
+    counter = QueryCounter()
+    with connections[using].execute_wrapper(counter):
+        yield counter
+
+
+class Percentile(Aggregate):
+    """
+    PostgreSQL's continuous percentile, e.g. `Percentile('duration', 0.95)` for the 95th percentile.
+    """
+    function = 'PERCENTILE_CONT'
+    name = 'percentile'
+    output_field = FloatField()
+    template = '%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, percentile=float(percentile), **extra)
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of up to `size` items of the given iterable, without reading more of it than needed
+    for the current list.
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -1,4 +1,9 @@
 from django.shortcuts import render
+from django.http import HttpResponse
+from django.conf import settings
+from http import HTTPStatus
+
+from track import metrics
 
 import logging
 logger = logging.getLogger(__name__)
@@ -18,3 +23,12 @@ def index(request):
         context = {}
 
     return render(request, template, context)
+
+def metrics_view(request):
+    """
+    Returns the metrics of all processes in the Prometheus text format. If METRICS_TOKEN is set,
+    the request needs to have the header "Authorization: Bearer <METRICS_TOKEN>".
+    """
+    if settings.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponse(status=HTTPStatus.UNAUTHORIZED)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")